@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the clients and the StageManager against a local mock dCache.
+
+For every list size it measures metadata requests per second through the REST API and the WebDAV door, the time
+until the first bulk PIN request is submitted, the staging cycle time and the total staging time. Download
+throughput is measured once per parallelism. The results are written as JSON, so runs of different versions can
+be compared.
+
+Usage: python benchmarks/bench_dcache.py [--sizes 1000 10000] [--latency 0.005] [--output results.json]
+       python benchmarks/bench_dcache.py --url http://host:8080  # against a mock_dcache.py started elsewhere
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from mock_dcache import API, MockDcache
+
+import pmgridtools
+import pmgridtools.transfer as transfer
+import pmgridtools.transport as transport
+from pmgridtools.api_dcache import dcacheapy
+from pmgridtools.concurrency import ordered_map
+from pmgridtools.pm_stage_files import (
+    InputPipeline,
+    PollScheduler,
+    StageManager,
+    lookup_records,
+)
+from pmgridtools.stage_state import PENDING, FileRecord
+from pmgridtools.webdav_dcache import WebDav
+
+ROOT: str = "/pnfs/grid.sara.nl/data/bench"
+
+
+def file_list(nfiles: int, files_per_dir: int) -> List[str]:
+    """
+    Paths of the benchmark files, spread over directories of the mock namespace. Every list size gets its own
+    tree, so files staged for one size are still NEARLINE for the next.
+
+    :param nfiles: Number of files
+    :param files_per_dir: Number of files per directory
+    :return: PNFS paths
+    """
+    return [f"{ROOT}/n{nfiles}/dir{i // files_per_dir:05d}/f{i % files_per_dir:08d}" for i in range(nfiles)]
+
+
+def rate(count: int, seconds: float) -> float:
+    """
+    Events per second.
+
+    :param count: Number of events
+    :param seconds: Elapsed time
+    :return: Rate, rounded
+    """
+    return round(count / seconds, 1) if seconds > 0 else 0.0
+
+
+def bench_metadata(dcache: dcacheapy, webdav: WebDav, base: str, paths: List[str], concurrency: int) -> Dict[str, Any]:
+    """
+    Metadata throughput: one REST stat, one HEAD with Want-Digest and one PROPFIND per file.
+
+    :param dcache: REST API client
+    :param webdav: WebDAV client
+    :param base: Base URL of the WebDAV door
+    :param paths: PNFS paths
+    :param concurrency: Number of requests in flight
+    :return: Requests per second per request type
+    """
+    results: Dict[str, Any] = {}
+    start: float = time.perf_counter()
+    count: int = sum(1 for _ in ordered_map(dcache.stat, paths, concurrency))
+    results["rest_stat_rps"] = rate(count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    count = sum(
+        1 for _ in ordered_map(lambda path: transfer.remote_head(webdav.session, base + path), paths, concurrency)
+    )
+    results["webdav_head_rps"] = rate(count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in ordered_map(lambda path: webdav.stat(base + path), paths, concurrency))
+    results["webdav_propfind_rps"] = rate(count, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in webdav.stat_many(base + path for path in paths))
+    results["webdav_stat_many_files_per_s"] = rate(count, time.perf_counter() - start)
+    return results
+
+
+def bench_staging(
+    dcache: dcacheapy, paths: List[str], concurrency: int, filesize: int, budget_files: int, poll_interval: float
+) -> Dict[str, Any]:
+    """
+    Stage all files the way pm_stage_files does, with a staging budget of budget_files files.
+
+    :param dcache: REST API client
+    :param paths: PNFS paths
+    :param concurrency: Number of metadata requests in flight
+    :param filesize: Size the mock reports for every file
+    :param budget_files: Number of files that fit in the staging budget
+    :param poll_interval: Minimum interval between polls of a bulk request
+    :return: Time to the first PIN, cycle times and total staging time
+    """
+    start: float = time.perf_counter()
+    pipeline: InputPipeline[Tuple[FileRecord, bool]] = InputPipeline(
+        lookup_records(dcache, paths, {}, concurrency), maxsize=10000
+    )
+    scheduler = PollScheduler(min_interval=poll_interval, max_interval=poll_interval * 4, jitter=0, slack=0)
+    manager = StageManager(dcache, scheduler, max_stage_gb=budget_files * filesize / 1024**3)
+    first_pin: Optional[float] = None
+    cycles: List[float] = []
+    while True:
+        records = pipeline.take(10000 - len(manager.pending))
+        manager.add_files({record.pnfs: record.size for record, _ in records if record.state == PENDING})
+        cycle_start: float = time.perf_counter()
+        manager.checkstaged()
+        cycles.append(time.perf_counter() - cycle_start)
+        if first_pin is None and manager.requests:
+            first_pin = time.perf_counter() - start
+        if pipeline.finished and manager.remaining == 0:
+            break
+        time.sleep(0.01)
+    return {
+        "time_to_first_pin_s": round(first_pin, 3) if first_pin is not None else None,
+        "stage_total_s": round(time.perf_counter() - start, 3),
+        "stage_cycles": len(cycles),
+        "stage_cycle_ms_mean": round(statistics.mean(cycles) * 1000, 3),
+        "stage_cycle_ms_max": round(max(cycles) * 1000, 3),
+        "stage_failed": len(manager.failed),
+    }
+
+
+def bench_download(webdav: WebDav, base: str, size: int, parallel: int) -> Dict[str, Any]:
+    """
+    Download throughput of one file, including the checksum verification.
+
+    :param webdav: WebDAV client
+    :param base: Base URL of the WebDAV door
+    :param size: File size in bytes
+    :param parallel: Number of range requests in flight
+    :return: Throughput in MB/s
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        localfile: str = os.path.join(tmpdir, "download")
+        start: float = time.perf_counter()
+        webdav.download(f"{base}{ROOT}/download-{size}", localfile, parallel=parallel, segment_size=16 * 1024**2)
+        seconds: float = time.perf_counter() - start
+    return {"parallel": parallel, "size_mb": size / 1e6, "mb_per_s": rate(int(size / 1e6), seconds)}
+
+
+def main() -> None:
+    """Run the benchmarks and write the results as JSON."""
+    parser = argparse.ArgumentParser(description="benchmark dCache clients and staging against a mock dCache")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="numbers of files, up to 1000000")
+    parser.add_argument("--url", default=None, help="base URL of a running mock_dcache.py, started here if not given")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of idempotent requests failing")
+    parser.add_argument("--tape-delay", type=float, default=1, help="seconds until a pinned file is online")
+    parser.add_argument("--files-per-dir", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--budget-fraction", type=float, default=0.25, help="part of the files staged at once")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--download-mb", type=int, default=256)
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--output", default=None, help="JSON file to write, stdout if not given")
+    args = parser.parse_args()
+
+    filesize: int = 1024**3
+    mock: Optional[MockDcache] = None
+    if args.url is None:
+        mock = MockDcache(args.latency, args.error_rate, args.tape_delay, args.files_per_dir, filesize)
+        base: str = mock.start()
+    else:
+        base = args.url.rstrip("/")
+    # the clients read the proxy location even when they are given a session, the mock does not need one
+    os.environ.setdefault("X509_USER_PROXY", "")
+    session: requests.Session = transport.make_session(None, pool_size=max(args.concurrency, max(args.parallel)))
+    dcache = dcacheapy(session=session, api=base + API)
+    webdav = WebDav(session=session)
+
+    results: List[Dict[str, Any]] = []
+    for nfiles in args.sizes:
+        paths: List[str] = file_list(nfiles, args.files_per_dir)
+        result: Dict[str, Any] = {"files": nfiles}
+        result.update(bench_metadata(dcache, webdav, base, paths, args.concurrency))
+        budget: int = max(1, int(nfiles * args.budget_fraction))
+        result.update(bench_staging(dcache, paths, args.concurrency, filesize, budget, args.poll_interval))
+        results.append(result)
+
+    downloads: List[Dict[str, Any]] = [
+        bench_download(webdav, base, args.download_mb * 1024**2, parallel) for parallel in args.parallel
+    ]
+    report: Dict[str, Any] = {
+        "pmgridtools": pmgridtools.__version__,
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "server": (
+            {"mock": True, "latency": args.latency, "error_rate": args.error_rate, "tape_delay": args.tape_delay}
+            if mock is not None
+            else {"mock": False, "url": base}
+        ),
+        "concurrency": args.concurrency,
+        "results": results,
+        "downloads": downloads,
+    }
+    if mock is not None:
+        report["server"]["requests"] = mock.requests
+        report["server"]["errors"] = mock.errors
+        mock.stop()
+
+    output: str = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
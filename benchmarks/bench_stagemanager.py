@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Synthetic benchmark of the StageManager bookkeeping.
+
+A fake dCache client completes the oldest bulk request on every status poll, so every staging cycle releases
+and admits a constant number of files. The released files are replaced by new ones between cycles, so the stage
+list keeps its size however many cycles are timed. The time per cycle should stay flat as the stage list grows.
+
+Usage: python benchmarks/bench_stagemanager.py [--sizes 1000 10000 100000 1000000] [--cycles 50]
+"""
+
+import argparse
+import itertools
+import time
+
+from mock_dcache import FakeDcache
+
+from pmgridtools.pm_stage_files import PollScheduler, StageManager
+
+
+def bench(nfiles: int, cycles: int, filesize: int) -> float:
+    """
+    Run staging cycles on a list of nfiles files.
+
+    :param nfiles: Number of files in the stage list
+    :param cycles: Number of cycles to time
+    :param filesize: Size of every file in bytes
+    :return: Mean time per cycle in seconds
+    """
+    manager = StageManager(FakeDcache("oldest"), PollScheduler(min_interval=0, slack=0))  # type: ignore[arg-type]
+    names = (f"/pnfs/grid.sara.nl/data/bench/{i:08d}" for i in itertools.count())
+    manager.add_files({name: filesize for name in itertools.islice(names, nfiles)})
+    released, _ = manager.checkstaged()  # first cycle only admits files
+    elapsed = 0.0
+    for _ in range(cycles):
+        # refill outside the timed part, without it the list runs empty after nfiles / admitted-per-cycle cycles
+        manager.add_files({name: filesize for name in itertools.islice(names, len(released))})
+        start = time.perf_counter()
+        released, _ = manager.checkstaged()
+        elapsed += time.perf_counter() - start
+        assert released, "a cycle released no files"
+    return elapsed / cycles
+
+
+def main() -> None:
+    """Run the benchmark for every list size and print the time per cycle."""
+    parser = argparse.ArgumentParser(description="benchmark StageManager cycle time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--cycles", type=int, default=50)
+    parser.add_argument("--filesize-gb", type=float, default=1.0)
+    args = parser.parse_args()
+
+    filesize = int(args.filesize_gb * 1024 * 1024 * 1024)
+    print(f"{'files':>10} {'ms/cycle':>10}")
+    for nfiles in args.sizes:
+        print(f"{nfiles:>10} {bench(nfiles, args.cycles, filesize) * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a dCache instance, for benchmarks and manual testing without grid credentials.
+
+It serves plain HTTP and emulates the parts of dCache the clients use:
+
+* the REST API: GET /api/v1/namespace/{path} (with children, offset and limit), POST /api/v1/bulk-requests and
+  GET /api/v1/bulk-requests/{id} (paged with offset and nextId, targets relative to targetPrefix)
+* the WebDAV door: PROPFIND with Depth 0 and 1, HEAD with Want-Digest, GET with Range, PUT with Expect:
+  100-continue and DELETE on /pnfs/...
+
+The namespace is virtual. A path whose name starts with "dir" is a directory holding files f00000000, f00000001,
+... A name starting with "missing" does not exist, "download-<bytes>" is a file of that size, "corrupt-<bytes>"
+one whose reported checksum does not match its content, and every other path is a file of the default size. File
+content is a repeated pseudo-random block, so any size can be served without storage. Files are NEARLINE unless
+selected by the online fraction, a PIN brings them ONLINE after the tape delay. Setting drops cuts that many file
+transfers off halfway, responses put in scripted are sent instead of handling the next requests. Uploads are kept
+in uploads, except to a name starting with "forbidden", which is refused with 403, "redirect-<name>", which is
+redirected to <name>, and "early", which is answered with 201 before the body is sent.
+
+FakeDcache and FakeClock are in-process stand-ins for unit tests and the StageManager benchmark, which need no
+server.
+
+Usage: python benchmarks/mock_dcache.py [--port 8080] [--latency 0.01] [--error-rate 0.01] [--tape-delay 30]
+"""
+
+import argparse
+import collections
+import http.server
+import itertools
+import json
+import posixpath
+import random
+import threading
+import time
+import zlib
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+from pmgridtools.api_dcache import BulkRequestStatus
+
+BLOCK: bytes = random.Random(0).randbytes(1024 * 1024)
+API: str = "/api/v1"
+
+
+def content(start: int, end: int) -> bytes:
+    """
+    Content of every virtual file between two offsets.
+
+    :param start: First byte
+    :param end: End, exclusive
+    :return: Bytes of the range
+    """
+    parts: List[bytes] = []
+    while start < end:
+        offset: int = start % len(BLOCK)
+        stop: int = min(len(BLOCK), offset + end - start)
+        parts.append(BLOCK[offset:stop])
+        start += stop - offset
+    return b"".join(parts)
+
+
+class MockDcache:
+    """Virtual namespace, bulk requests and the HTTP server serving them."""
+
+    def __init__(
+        self,
+        latency: float = 0,
+        error_rate: float = 0,
+        tape_delay: float = 5,
+        files_per_dir: int = 1000,
+        file_size: int = 1024 * 1024 * 1024,
+        online_fraction: float = 0,
+        page_size: int = 10000,
+        seed: int = 0,
+    ) -> None:
+        """
+        Initialize the mock.
+
+        :param latency: Seconds every request is delayed
+        :param error_rate: Fraction of idempotent requests answered with 503
+        :param tape_delay: Seconds after which a pinned NEARLINE file comes online
+        :param files_per_dir: Number of files in every directory
+        :param file_size: Size in bytes reported for files
+        :param online_fraction: Fraction of the files that are ONLINE from the start
+        :param page_size: Maximum number of targets per page of a bulk request status
+        :param seed: Seed of the error generator
+        """
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.tape_delay: float = tape_delay
+        self.files_per_dir: int = files_per_dir
+        self.file_size: int = file_size
+        self.online_fraction: float = online_fraction
+        self.page_size: int = page_size
+        self.random: random.Random = random.Random(seed)
+        self.online: Set[str] = set()
+        self.bulk: Dict[str, Tuple[str, List[str], float]] = {}
+        self.requests: Dict[str, int] = {}
+        self.errors: int = 0
+        # number of file transfers still to be cut off halfway, to exercise resuming
+        self.drops: int = 0
+        # responses sent instead of handling the next requests, to exercise retries
+        self.scripted: Deque[Tuple[int, Dict[str, str]]] = collections.deque()
+        # body and Expect header of every PUT, by path
+        self.uploads: Dict[str, Tuple[bytes, Optional[str]]] = {}
+        self._ids = itertools.count()
+        self._checksums: Dict[int, str] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self.server: Optional[http.server.ThreadingHTTPServer] = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Serve in a background thread.
+
+        :param host: Address to listen on
+        :param port: Port to listen on, a free one if 0
+        :return: Base URL of the server
+        """
+        # the checksum of the default file size takes a moment, it should not be part of the first measurement
+        self.adler32(self.file_size)
+        handler = type("Handler", (MockHandler,), {"mock": self})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_port}"
+
+    def stop(self) -> None:
+        """Stop serving."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def count(self, method: str) -> bool:
+        """
+        Count a request and decide whether it fails.
+
+        :param method: HTTP method
+        :return: True if the request should be answered with an error
+        """
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            failed: bool = method != "POST" and self.random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+    def drop(self) -> bool:
+        """
+        Decide whether a file transfer is cut off halfway.
+
+        :return: True if the connection should be dropped
+        """
+        with self._lock:
+            dropped: bool = self.drops > 0
+            self.drops -= dropped
+        return dropped
+
+    def stat(self, path: str) -> Optional[Dict[str, Any]]:
+        """
+        Metadata of a path.
+
+        :param path: PNFS path
+        :return: Dictionary in the format of the namespace API, None if the path does not exist
+        """
+        path = path.rstrip("/") or "/"
+        name: str = posixpath.basename(path)
+        if name.startswith("missing"):
+            return None
+        if name.startswith("dir"):
+            return {"fileName": name, "fileType": "DIR", "size": 512}
+        size: int = int(name.partition("-")[2]) if name.startswith(("download-", "corrupt-")) else self.file_size
+        checksum: str = self.adler32(size)
+        if name.startswith("corrupt-"):
+            checksum = f"{int(checksum, 16) ^ 1:08x}"
+        hashed: float = (zlib.crc32(path.encode()) % 10000) / 10000
+        online: bool = path in self.online or hashed < self.online_fraction
+        return {
+            "fileName": name,
+            "fileType": "REGULAR",
+            "size": size,
+            "fileLocality": "ONLINE_AND_NEARLINE" if online else "NEARLINE",
+            "accessLatency": "NEARLINE",
+            "checksums": [{"type": "ADLER32", "value": checksum}],
+            "storageClass": f"bench:tape{zlib.crc32(posixpath.dirname(path).encode()) % 16}@osm",
+            "labels": [],
+        }
+
+    def children(self, path: str, offset: int, limit: int) -> List[Dict[str, Any]]:
+        """
+        Entries of a directory.
+
+        :param path: Directory path
+        :param offset: Index of the first entry
+        :param limit: Maximum number of entries
+        :return: Metadata of the entries
+        """
+        names = (f"f{i:08d}" for i in range(offset, min(self.files_per_dir, offset + limit)))
+        return [info for info in (self.stat(f"{path.rstrip('/')}/{name}") for name in names) if info is not None]
+
+    def adler32(self, size: int) -> str:
+        """
+        Adler-32 checksum of a file of the given size, computed once per size.
+
+        :param size: File size
+        :return: Hexadecimal checksum
+        """
+        if size not in self._checksums:
+            checksum: int = zlib.adler32(b"")
+            for start in range(0, size, len(BLOCK)):
+                checksum = zlib.adler32(content(start, min(size, start + len(BLOCK))), checksum)
+            self._checksums[size] = f"{checksum:08x}"
+        return self._checksums[size]
+
+    def submit(self, activity: str, targets: List[str]) -> str:
+        """
+        Register a bulk request.
+
+        :param activity: Bulk activity
+        :param targets: Target paths
+        :return: Request ID
+        """
+        request_id: str = f"bench-{next(self._ids)}"
+        with self._lock:
+            self.bulk[request_id] = (activity, targets, time.monotonic())
+        return request_id
+
+    def bulk_status(self, request_id: str, offset: int) -> Optional[Dict[str, Any]]:
+        """
+        One page of the state of a bulk request.
+
+        :param request_id: Request ID
+        :param offset: Index of the first target of the page
+        :return: Dictionary in the format of the bulk-requests API, None if the request does not exist
+        """
+        if request_id not in self.bulk:
+            return None
+        activity, targets, submitted = self.bulk[request_id]
+        # like dCache, send the directory the targets have in common once, and the targets relative to it
+        prefix: str = posixpath.dirname(posixpath.commonprefix(targets)) if targets else ""
+        recalled: bool = activity != "PIN" or time.monotonic() >= submitted + self.tape_delay
+        states: List[Dict[str, Any]] = []
+        running: bool = False
+        for index, target in enumerate(targets):
+            info: Optional[Dict[str, Any]] = self.stat(target)
+            if info is None:
+                state: Dict[str, Any] = {"state": "FAILED", "errorMessage": "No such file or directory"}
+            elif recalled or info.get("fileLocality", "").startswith("ONLINE"):
+                state = {"state": "COMPLETED"}
+                if activity == "PIN":
+                    self.online.add(target)
+            else:
+                state = {"state": "RUNNING"}
+                running = True
+            if offset <= index < offset + self.page_size:
+                states.append({"target": target.removeprefix(prefix), "id": index, **state})
+        next_id: int = offset + self.page_size if offset + self.page_size < len(targets) else -1
+        return {
+            "status": "STARTED" if running else "COMPLETED",
+            "targetPrefix": prefix,
+            "targets": states,
+            "nextId": next_id,
+        }
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler of MockDcache, the mock attribute is set on a subclass per server."""
+
+    protocol_version: str = "HTTP/1.1"
+    # headers and body are written separately, with Nagle's algorithm every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    mock: MockDcache
+
+    def log_message(self, format: str, *args: Any) -> None:
+        """Do not log every request."""
+
+    def _begin(self) -> bool:
+        """
+        Apply latency and errors.
+
+        :return: True if the request should be handled, False if an error or a scripted response was sent
+        """
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        with self.mock._lock:
+            scripted: Optional[Tuple[int, Dict[str, str]]] = (
+                self.mock.scripted.popleft() if self.mock.scripted else None
+            )
+        if scripted is not None:
+            self.mock.count(self.command)
+            status, headers = scripted
+            # the body of a POST is still unread, the connection cannot be reused
+            self._send(status, b"scripted", {**headers, "Connection": "close"} if self.command == "POST" else headers)
+            return False
+        if self.mock.count(self.command):
+            self._send(503, b"simulated error")
+            return False
+        return True
+
+    def _send(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None) -> None:
+        """
+        Send a complete response.
+
+        :param status: HTTP status
+        :param body: Response body
+        :param headers: Extra headers
+        """
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, value: Any, status: int = 200) -> None:
+        """
+        Send a JSON response.
+
+        :param value: Value to encode
+        :param status: HTTP status
+        """
+        self._send(status, json.dumps(value).encode(), {"Content-Type": "application/json"})
+
+    def _body(self) -> bytes:
+        """
+        Read the request body.
+
+        :return: Body
+        """
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self) -> None:
+        """Namespace, bulk request status or file content."""
+        if not self._begin():
+            return
+        parts = urlsplit(self.path)
+        query: Dict[str, List[str]] = parse_qs(parts.query)
+        path: str = unquote(parts.path)
+        if path.startswith(f"{API}/namespace/"):
+            pnfs: str = "/" + path.removeprefix(f"{API}/namespace/").lstrip("/")
+            info: Optional[Dict[str, Any]] = self.mock.stat(pnfs)
+            if info is None:
+                self._json({"errors": [{"message": "not found"}]}, 404)
+            elif info["fileType"] == "DIR" and query.get("children") == ["true"]:
+                offset: int = int(query.get("offset", ["0"])[0])
+                limit: int = int(query.get("limit", [str(self.mock.files_per_dir)])[0])
+                self._json({**info, "children": self.mock.children(pnfs, offset, limit)})
+            else:
+                self._json(info)
+        elif path.startswith(f"{API}/bulk-requests/"):
+            request_id: str = path.removeprefix(f"{API}/bulk-requests/").strip("/")
+            status: Optional[Dict[str, Any]] = self.mock.bulk_status(request_id, int(query.get("offset", ["0"])[0]))
+            if status is None:
+                self._json({"errors": [{"message": "not found"}]}, 404)
+            else:
+                self._json(status)
+        else:
+            self._content(path)
+
+    def do_HEAD(self) -> None:
+        """File size and checksum."""
+        if self._begin():
+            self._content(unquote(urlsplit(self.path).path))
+
+    def _content(self, path: str) -> None:
+        """
+        Send a file or a range of it.
+
+        :param path: PNFS path
+        """
+        info: Optional[Dict[str, Any]] = self.mock.stat(path)
+        if info is None or info["fileType"] == "DIR":
+            self._send(404)
+            return
+        size: int = info["size"]
+        headers: Dict[str, str] = {"Accept-Ranges": "bytes"}
+        if "adler32" in self.headers.get("Want-Digest", "").lower():
+            headers["Digest"] = f"adler32={info['checksums'][0]['value']}"
+        start, end, status = 0, size, 200
+        ranges: Optional[str] = self.headers.get("Range")
+        if ranges is not None and ranges.startswith("bytes="):
+            first, _, last = ranges[6:].partition("-")
+            start, end, status = int(first), min(size, int(last) + 1 if last else size), 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if end > start and self.mock.drop():
+            self.wfile.write(content(start, start + (end - start) // 2))
+            self.close_connection = True
+            return
+        for offset in range(start, end, len(BLOCK)):
+            self.wfile.write(content(offset, min(end, offset + len(BLOCK))))
+
+    def do_POST(self) -> None:
+        """Submit a bulk request."""
+        if not self._begin():
+            return
+        if urlsplit(self.path).path.rstrip("/") != f"{API}/bulk-requests":
+            self._send(404)
+            return
+        data: Dict[str, Any] = json.loads(self._body())
+        request_id: str = self.mock.submit(data["activity"], list(data["target"]))
+        self._send(201, headers={"request-url": f"http://{self.headers['Host']}{API}/bulk-requests/{request_id}"})
+
+    def do_DELETE(self) -> None:
+        """Remove a file, the namespace is virtual so nothing changes."""
+        if not self._begin():
+            return
+        self._send(204 if self.mock.stat(unquote(urlsplit(self.path).path)) is not None else 404)
+
+    def _refuse_upload(self) -> bool:
+        """
+        Answer an upload to a special name without reading the body.
+
+        :return: True if a final response was sent
+        """
+        path: str = unquote(urlsplit(self.path).path)
+        directory, name = posixpath.split(path)
+        if name.startswith("forbidden"):
+            self._send(403)
+        elif name.startswith("redirect-"):
+            location: str = quote(posixpath.join(directory, name.partition("-")[2]))
+            self._send(307, headers={"Location": f"http://{self.headers['Host']}{location}"})
+        elif name.startswith("early"):
+            self._send(201)
+        else:
+            return False
+        return True
+
+    def handle_expect_100(self) -> bool:
+        """Refuse, redirect or accept an upload before the client sends the body."""
+        if self._refuse_upload():
+            self.close_connection = True
+            return False
+        return super().handle_expect_100()
+
+    def do_PUT(self) -> None:
+        """Store an upload, a file that was refused before the body was sent never gets here."""
+        body: bytes = self._body()
+        if not self._begin() or self._refuse_upload():
+            return
+        with self.mock._lock:
+            self.mock.uploads[unquote(urlsplit(self.path).path)] = (body, self.headers.get("Expect"))
+        self._send(201, headers={"Digest": f"adler32={zlib.adler32(body):08x}"})
+
+    def do_PROPFIND(self) -> None:
+        """Properties of a file or of a directory and its entries."""
+        self._body()
+        if not self._begin():
+            return
+        path: str = unquote(urlsplit(self.path).path).rstrip("/")
+        info: Optional[Dict[str, Any]] = self.mock.stat(path)
+        if info is None:
+            self._send(404)
+            return
+        entries: List[Tuple[str, Dict[str, Any]]] = [(path, info)]
+        if info["fileType"] == "DIR" and self.headers.get("Depth", "1") != "0":
+            entries.extend((f"{path}/{child['fileName']}", child) for child in self.mock.children(path, 0, 1 << 62))
+        body: str = "".join(self._propstat(href, entry) for href, entry in entries)
+        self._send(
+            207,
+            (
+                '<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" '
+                'xmlns:ns1="http://srm.lbl.gov/StorageResourceManager" '
+                f'xmlns:ns2="http://www.dcache.org/2013/webdav">{body}</d:multistatus>'
+            ).encode(),
+            {"Content-Type": "application/xml; charset=utf-8"},
+        )
+
+    @staticmethod
+    def _propstat(href: str, info: Dict[str, Any]) -> str:
+        """
+        DAV:response element of a path.
+
+        :param href: Path
+        :param info: Metadata of the path
+        :return: XML fragment
+        """
+        if info["fileType"] == "DIR":
+            props: str = "<d:resourcetype><d:collection/></d:resourcetype>"
+        else:
+            checksums: str = ",".join(f"{c['type'].lower()}={c['value']}" for c in info["checksums"])
+            props = (
+                f"<d:resourcetype/><d:getcontentlength>{info['size']}</d:getcontentlength>"
+                f"<ns1:FileLocality>{info['fileLocality']}</ns1:FileLocality>"
+                f"<ns1:AccessLatency>{info['accessLatency']}</ns1:AccessLatency>"
+                f"<ns2:Checksums>{escape(checksums)}</ns2:Checksums>"
+            )
+        return (
+            f"<d:response><d:href>{escape(quote(href))}</d:href><d:propstat><d:prop>{props}</d:prop>"
+            "<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+        )
+
+
+class FakeDcache:
+    """
+    In-process stand-in for the bulk request methods of dcacheapy, for StageManager tests and benchmarks.
+
+    Targets stay RUNNING until complete is called, unless complete_on_poll is set: "all" completes a request on its
+    first poll, "oldest" completes the oldest open request whenever that one is polled.
+    """
+
+    def __init__(self, complete_on_poll: Optional[str] = None) -> None:
+        """
+        Initialize the fake client.
+
+        :param complete_on_poll: None, "all" or "oldest"
+        """
+        self.complete_on_poll: Optional[str] = complete_on_poll
+        self.requests: Dict[str, Dict[str, str]] = {}
+        self.missing: Set[str] = set()
+        self.fail_stage: bool = False
+        self._open: Deque[str] = collections.deque()
+        self._ids = itertools.count()
+
+    def stage(self, pnfs: List[str], lifetime: int = 3) -> str:
+        """
+        Register a bulk request.
+
+        :param pnfs: Target paths
+        :param lifetime: Lifetime in hours, ignored
+        :return: Request ID
+        """
+        if self.fail_stage:
+            raise RuntimeError("bulk request rejected")
+        request_id: str = f"fake-{next(self._ids)}"
+        self.requests[request_id] = dict.fromkeys(pnfs, "RUNNING")
+        self._open.append(request_id)
+        return request_id
+
+    def bulk_request_status(self, request_id: str) -> BulkRequestStatus:
+        """
+        State of a bulk request.
+
+        :param request_id: Request ID
+        :return: Bulk request state, FileNotFoundError for requests in self.missing
+        """
+        if request_id in self.missing or request_id not in self.requests:
+            raise FileNotFoundError(f"Bulk request not found: {request_id}")
+        if self.complete_on_poll == "all" or (self.complete_on_poll == "oldest" and self._open[0] == request_id):
+            self.complete(*self.requests[request_id])
+        targets: Dict[str, str] = self.requests[request_id]
+        running: bool = "RUNNING" in targets.values()
+        return BulkRequestStatus(request_id, "STARTED" if running else "COMPLETED", dict(targets))
+
+    def complete(self, *pnfs: str, state: str = "COMPLETED") -> None:
+        """
+        Set the state of targets in every request that holds them.
+
+        :param pnfs: Target paths
+        :param state: New target state
+        """
+        for targets in self.requests.values():
+            for path in pnfs:
+                if path in targets:
+                    targets[path] = state
+        while self._open and "RUNNING" not in self.requests[self._open[0]].values():
+            self._open.popleft()
+
+    def staged(self) -> List[List[str]]:
+        """
+        Targets of every bulk request.
+
+        :return: Lists of target paths, in submission order
+        """
+        return [list(targets) for targets in self.requests.values()]
+
+
+class FakeClock:
+    """Clock that only moves when told to, for code taking a clock function."""
+
+    def __init__(self, now: float = 1000) -> None:
+        """
+        Initialize the clock.
+
+        :param now: Start time in seconds
+        """
+        self.now: float = now
+
+    def __call__(self) -> float:
+        """Current time in seconds."""
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        """
+        Move the clock forward.
+
+        :param seconds: Number of seconds
+        """
+        self.now += seconds
+
+
+def main() -> None:
+    """Run the mock server in the foreground."""
+    parser = argparse.ArgumentParser(description="mock dCache REST API and WebDAV door")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of idempotent requests failing")
+    parser.add_argument("--tape-delay", type=float, default=5, help="seconds until a pinned file is online")
+    parser.add_argument("--files-per-dir", type=int, default=1000)
+    parser.add_argument("--file-size", type=int, default=1024 * 1024 * 1024)
+    parser.add_argument("--online-fraction", type=float, default=0)
+    args = parser.parse_args()
+
+    mock = MockDcache(
+        args.latency, args.error_rate, args.tape_delay, args.files_per_dir, args.file_size, args.online_fraction
+    )
+    print(f"serving on {mock.start(args.host, args.port)}, REST API at {API}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,159 @@
+import itertools
 import os
-from typing import Any, Dict, List, Union
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import requests
 
+import pmgridtools.remote_file as remote_file
+import pmgridtools.transfer as transfer
+import pmgridtools.transport as transport
+from pmgridtools.metadata_cache import MetadataCache, cached
+from pmgridtools.metrics import RequestEvent
+
+# dCache rejects bulk requests above a configurable number of targets, 10000 by default
+BULK_CHUNK_SIZE: int = 10000
+EXPAND_DIRECTORIES: Tuple[str, ...] = ("NONE", "TARGETS", "ALL")
+
+
+@dataclass(frozen=True)
+class FileInfo:
+    """Compact file metadata record as returned by the dCache namespace API."""
+
+    path: str
+    size: int
+    locality: str
+    file_type: str = "REGULAR"
+    access_latency: Optional[str] = None
+    checksums: Dict[str, str] = field(default_factory=dict)
+    storage_class: Optional[str] = None
+    labels: Tuple[str, ...] = ()
+
+    @property
+    def online(self) -> bool:
+        """True if the file has a replica on disk."""
+        return "ONLINE" in self.locality
+
+    @classmethod
+    def from_json(cls, path: str, json_response: Dict[str, Any]) -> "FileInfo":
+        """
+        Build a record from a namespace API response.
+
+        :param path: File path the response belongs to
+        :param json_response: Decoded JSON response
+        :return: File metadata record
+        """
+        return cls(
+            path=path,
+            size=int(json_response.get("size", 0)),
+            locality=json_response.get("fileLocality", ""),
+            file_type=json_response.get("fileType", "REGULAR"),
+            access_latency=json_response.get("accessLatency"),
+            checksums={c["type"].upper(): c["value"] for c in json_response.get("checksums", [])},
+            storage_class=json_response.get("storageClass"),
+            labels=tuple(json_response.get("labels", ())),
+        )
+
+
+@dataclass(frozen=True)
+class BulkRequestStatus:
+    """State of a bulk request and of its individual targets."""
+
+    request_id: str
+    status: str
+    targets: Dict[str, str] = field(default_factory=dict)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def finished(self) -> bool:
+        """True if dCache will not process the request any further."""
+        return self.status in ("COMPLETED", "CANCELLED")
+
+
+def parse_bulk_page(json_response: Dict[str, Any], targets: Dict[str, str], errors: Dict[str, str]) -> Tuple[str, int]:
+    """
+    Collect the target states of one page of a bulk request status response.
+
+    :param json_response: Decoded JSON response of /bulk-requests/{id}
+    :param targets: Dictionary to which the state per target path is added
+    :param errors: Dictionary to which the error message per failed target path is added
+    :return: Tuple of (request status, offset of the next page or -1 on the last page)
+    """
+    prefix: str = json_response.get("targetPrefix") or ""
+    for target in json_response.get("targets", []):
+        path: str = prefix + target["target"]
+        targets[path] = target["state"]
+        if target.get("errorMessage"):
+            errors[path] = target["errorMessage"]
+    return (json_response.get("status", ""), int(json_response.get("nextId", -1)))
+
+
+def bulk_request_id(headers: Mapping[str, str]) -> str:
+    """
+    Get the ID of a new bulk request from the headers of the response to its submission.
+
+    dCache returns the URL of the new request in a request-url header, a Location header is accepted as well.
+
+    :param headers: Response headers, looked up case-insensitively
+    :return: Bulk request ID
+    """
+    url: Optional[str] = headers.get("request-url") or headers.get("Location")
+    request_id: str = url.rstrip("/").rsplit("/", 1)[-1] if url else ""
+    if not request_id:
+        raise RuntimeError(f"No bulk request location in response: {headers}")
+    return request_id
+
 
 class dcacheapy:
     """dCache API wrapper for file operations."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        pool_size: int = 10,
+        cache: Optional[MetadataCache] = None,
+        session: Optional[requests.Session] = None,
+        api: str = "https://dcacheview.grid.surfsara.nl:22882/api/v1",
+    ) -> None:
         """
         Initialize dCache API client.
+
+        :param pool_size: Maximum number of connections kept open per host, should be at least the number of
+            threads sharing this client
+        :param cache: Optional metadata cache consulted before asking the server, can be shared between clients
+        :param session: Session to use, e.g. one from transport.make_session shared with other clients or tuned
+            for retries and rate limiting. A default one with pool_size connections is created if not given
+        :param api: Base URL of the dCache REST API
         """
         self.cert: str = os.environ["X509_USER_PROXY"]
         self.capath: str = "/etc/grid-security/certificates/"
-        self.session: requests.Session = requests.Session()
-        self.session.verify = "/etc/grid-security/certificates/"
-        self.session.cert = self.cert
+        self.session: requests.Session = (
+            session if session is not None else transport.make_session(self.cert, self.capath, pool_size)
+        )
         self.timeout: int = 20
-        self.api: str = "https://dcacheview.grid.surfsara.nl:22882/api/v1"
+        self.api: str = api
+        self.cache: Optional[MetadataCache] = cache
+
+    def add_hook(self, hook: Callable[[RequestEvent], None]) -> None:
+        """
+        Call a function after every request sent through the session of this client, e.g. a metrics.Metrics
+        instance recording latencies, status codes, retries and bytes.
+
+        :param hook: Function called with a RequestEvent
+        """
+        transport.add_hook(self.session, hook)
 
+    @cached("adler32")
     def adler32(self, url: str) -> str:
         """
         Get ADLER32 checksum of a file.
@@ -42,34 +177,178 @@ class dcacheapy:
 
         return adler32
 
-    def stage(self, pnfs: Union[str, List[str]], lifetime: int = 3) -> None:
+    def stage(self, pnfs: Union[str, List[str]], lifetime: int = 3) -> str:
         """
         Stage files from tape to disk.
 
         :param pnfs: File path or list of file paths
         :param lifetime: Lifetime in hours
+        :return: Bulk request ID, to be used with bulk_request_status
         """
         if isinstance(pnfs, str):
             pnfs = [pnfs]
+        return self._submit_bulk(
+            "PIN", pnfs, {"lifetime": lifetime, "lifetimeUnit": "HOURS"}, expand_directories="TARGETS"
+        )
+
+    def unpin(
+        self,
+        pnfs: Union[str, Iterable[str]],
+        pin_id: Optional[str] = None,
+        expand_directories: str = "TARGETS",
+        chunk_size: int = BULK_CHUNK_SIZE,
+    ) -> List[str]:
+        """
+        Release the pins of files so dCache may remove their disk copies.
+
+        :param pnfs: File or directory path or paths
+        :param pin_id: ID of the pins to release, i.e. the ID of the bulk request that created them; by default the
+            pins are released regardless of their ID
+        :param expand_directories: NONE, TARGETS (files directly in a directory) or ALL (recursively)
+        :param chunk_size: Maximum number of targets per bulk request
+        :return: Bulk request IDs, to be used with bulk_request_status
+        """
+        arguments: Dict[str, Any] = {} if pin_id is None else {"id": pin_id}
+        return self.bulk_request("UNPIN", pnfs, arguments, expand_directories, chunk_size)
+
+    def delete(
+        self,
+        pnfs: Union[str, Iterable[str]],
+        skip_dirs: bool = True,
+        expand_directories: str = "NONE",
+        chunk_size: int = BULK_CHUNK_SIZE,
+    ) -> List[str]:
+        """
+        Delete files in bulk.
+
+        :param pnfs: File or directory path or paths
+        :param skip_dirs: Do not delete directories, only the files in them
+        :param expand_directories: NONE, TARGETS (files directly in a directory) or ALL (recursively)
+        :param chunk_size: Maximum number of targets per bulk request
+        :return: Bulk request IDs, to be used with bulk_request_status
+        """
+        targets: List[str] = [pnfs] if isinstance(pnfs, str) else list(pnfs)
+        if self.cache is not None:
+            for target in targets:
+                self.cache.invalidate(target, children=expand_directories != "NONE")
+        return self.bulk_request(
+            "DELETE", targets, {"skipDirs": str(skip_dirs).lower()}, expand_directories, chunk_size
+        )
+
+    def update_qos(
+        self,
+        pnfs: Union[str, Iterable[str]],
+        target_qos: str,
+        expand_directories: str = "NONE",
+        chunk_size: int = BULK_CHUNK_SIZE,
+    ) -> List[str]:
+        """
+        Change the QoS of files, e.g. to move them to tape only or to keep a copy on disk.
 
+        :param pnfs: File or directory path or paths
+        :param target_qos: disk, tape or disk+tape
+        :param expand_directories: NONE, TARGETS (files directly in a directory) or ALL (recursively)
+        :param chunk_size: Maximum number of targets per bulk request
+        :return: Bulk request IDs, to be used with bulk_request_status
+        """
+        targets: List[str] = [pnfs] if isinstance(pnfs, str) else list(pnfs)
+        if self.cache is not None:
+            for target in targets:
+                self.cache.invalidate(target, children=expand_directories != "NONE")
+        return self.bulk_request("UPDATE_QOS", targets, {"targetQos": target_qos}, expand_directories, chunk_size)
+
+    def bulk_request(
+        self,
+        activity: str,
+        pnfs: Union[str, Iterable[str]],
+        arguments: Optional[Dict[str, Any]] = None,
+        expand_directories: str = "NONE",
+        chunk_size: int = BULK_CHUNK_SIZE,
+    ) -> List[str]:
+        """
+        Submit a bulk activity, split into requests of at most chunk_size targets.
+
+        :param activity: Bulk activity, e.g. PIN, UNPIN, DELETE or UPDATE_QOS
+        :param pnfs: File or directory path or paths
+        :param arguments: Arguments of the activity
+        :param expand_directories: NONE, TARGETS (files directly in a directory) or ALL (recursively)
+        :param chunk_size: Maximum number of targets per bulk request
+        :return: Bulk request IDs, to be used with bulk_request_status
+        """
+        if expand_directories not in EXPAND_DIRECTORIES:
+            raise ValueError(f"expand_directories must be one of {', '.join(EXPAND_DIRECTORIES)}: {expand_directories}")
+        targets: Iterator[str] = iter([pnfs] if isinstance(pnfs, str) else pnfs)
+        request_ids: List[str] = []
+        while True:
+            chunk: List[str] = list(itertools.islice(targets, chunk_size))
+            if not chunk:
+                break
+            request_ids.append(self._submit_bulk(activity, chunk, arguments or {}, expand_directories))
+        return request_ids
+
+    def _submit_bulk(
+        self, activity: str, targets: List[str], arguments: Dict[str, Any], expand_directories: str
+    ) -> str:
+        """
+        Submit a single bulk request.
+
+        :param activity: Bulk activity
+        :param targets: Target paths
+        :param arguments: Arguments of the activity
+        :param expand_directories: NONE, TARGETS or ALL
+        :return: Bulk request ID
+        """
         headers: Dict[str, str] = {
             "accept": "application/json",
             "content-type": "application/json",
         }
         data: Dict[str, Any] = {
-            "activity": "PIN",
-            "arguments": {"lifetime": lifetime, "lifetimeUnit": "HOURS"},
-            "target": pnfs,
-            "expand_directories": "TARGETS",
+            "activity": activity,
+            "arguments": arguments,
+            "target": targets,
+            "expand_directories": expand_directories,
         }
         url = f"{self.api}/bulk-requests"
         response = self.session.post(
             url,
             json=data,
             headers=headers,
+            timeout=self.timeout,
         )
         response.raise_for_status()
+        return bulk_request_id(response.headers)
+
+    def bulk_request_status(self, request_id: str) -> BulkRequestStatus:
+        """
+        Get the state of a bulk request and of each of its targets.
 
+        :param request_id: Bulk request ID as returned by stage
+        :return: Bulk request state
+        """
+        headers: Dict[str, str] = {"accept": "application/json"}
+        url: str = f"{self.api}/bulk-requests/{request_id}"
+        status: str = ""
+        targets: Dict[str, str] = {}
+        errors: Dict[str, str] = {}
+        offset: int = 0
+        while True:
+            response: requests.Response = self.session.get(
+                url, params={"offset": offset}, headers=headers, timeout=self.timeout
+            )
+            if response.status_code == 404:
+                raise FileNotFoundError(f"Bulk request not found: {request_id}")
+            elif response.status_code == 403:
+                raise PermissionError(f"Permission denied for bulk request {request_id}")
+            elif not response.ok:
+                raise RuntimeError(f"API request failed: {response}")
+
+            status, next_id = parse_bulk_page(response.json(), targets, errors)
+            if next_id < 0 or next_id <= offset:
+                break
+            offset = next_id
+        return BulkRequestStatus(request_id, status, targets, errors)
+
+    @cached("locality")
     def locality(self, pnfs: str) -> str:
         """
         Get file locality information.
@@ -81,7 +360,7 @@ class dcacheapy:
         headers: Dict[str, str] = {"accept": "application/json"}
         url: str = f"{self.api}/namespace/{pnfs}"
         # Make the GET request
-        response: requests.Response = self.session.get(url, params=params, headers=headers)
+        response: requests.Response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
 
         # Handle the response
         if response.ok:
@@ -96,6 +375,70 @@ class dcacheapy:
             else:
                 raise RuntimeError(f"API request failed: {response}")
 
+    def stat(self, pnfs: str) -> FileInfo:
+        """
+        Get size, locality, access latency and checksums of a file in a single request.
+
+        :param pnfs: File path
+        :return: File metadata record
+        """
+        params: Dict[str, str] = {"locality": "true", "checksum": "true", "optional": "true"}
+        headers: Dict[str, str] = {"accept": "application/json"}
+        url: str = f"{self.api}/namespace/{pnfs}"
+        response: requests.Response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+
+        if response.ok:
+            info: FileInfo = FileInfo.from_json(pnfs, response.json())
+            if self.cache is not None:
+                self.cache.set("size", pnfs, info.size)
+                self.cache.set("locality", pnfs, info.locality)
+            return info
+        elif response.status_code == 404:
+            raise FileNotFoundError(f"File not found: {pnfs}")
+        elif response.status_code == 403:
+            raise PermissionError(f"Permission denied for {pnfs}")
+        else:
+            raise RuntimeError(f"API request failed: {response}")
+
+    def list_dir(self, pnfs: str, page_size: int = 1000) -> Iterator[FileInfo]:
+        """
+        List the children of a directory with their size, locality and checksums.
+
+        The listing is fetched in pages of page_size entries, so large directories are streamed instead of
+        being returned in one response.
+
+        :param pnfs: Directory path
+        :param page_size: Number of entries requested per call
+        :return: Iterator over the metadata records of the directory entries
+        """
+        headers: Dict[str, str] = {"accept": "application/json"}
+        url: str = f"{self.api}/namespace/{pnfs}"
+        directory: str = pnfs.rstrip("/")
+        offset: int = 0
+        while True:
+            params: Dict[str, Union[str, int]] = {
+                "children": "true",
+                "locality": "true",
+                "checksum": "true",
+                "optional": "true",
+                "offset": offset,
+                "limit": page_size,
+            }
+            response: requests.Response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            if response.status_code == 404:
+                raise FileNotFoundError(f"Directory not found: {pnfs}")
+            elif response.status_code == 403:
+                raise PermissionError(f"Permission denied for {pnfs}")
+            elif not response.ok:
+                raise RuntimeError(f"API request failed: {response}")
+
+            children: List[Dict[str, Any]] = response.json().get("children", [])
+            for child in children:
+                yield FileInfo.from_json(f"{directory}/{child['fileName']}", child)
+            if len(children) < page_size:
+                return
+            offset += len(children)
+
     # def access_latency(self, url):
     #     """
 
@@ -126,6 +469,8 @@ class dcacheapy:
 
         :param url: File URL
         """
+        if self.cache is not None:
+            self.cache.invalidate(url)
         response: requests.Response = self.session.request("DELETE", url, timeout=self.timeout)
         print(response)
 
@@ -138,32 +483,61 @@ class dcacheapy:
         """
         raise NotImplementedError
 
-    def upload(self, file: str, url: str) -> None:
+    def upload(self, file: str, url: str, expect_continue: bool = True) -> None:
         """
         Upload a file.
 
+        The file is streamed, never loaded into memory, and dCache verifies its Adler-32 checksum on arrival.
+
         :param file: Local file path
         :param url: Destination URL
+        :param expect_continue: Wait for the door to accept (or redirect) the upload before sending any data
         """
-        raise NotImplementedError
+        if self.cache is not None:
+            self.cache.invalidate(url)
+        transfer.upload_file(self.session, file, url, self.timeout, expect_continue)
 
-    def download(self, url: str, localfile: str) -> str:
+    def upload_many(
+        self, jobs: List[Tuple[str, str]], concurrency: int = 4, expect_continue: bool = False
+    ) -> Dict[str, Optional[BaseException]]:
+        """
+        Upload many files concurrently over the pooled session.
+
+        :param jobs: Tuples of (local file path, destination URL)
+        :param concurrency: Number of uploads in flight
+        :param expect_continue: Use Expect: 100-continue, which opens a dedicated connection per upload
+        :return: Dictionary mapping every destination URL to None on success or the exception that occurred
+        """
+        return transfer.upload_many(lambda file, url: self.upload(file, url, expect_continue), jobs, concurrency)
+
+    def download(
+        self,
+        url: str,
+        localfile: str,
+        parallel: int = 1,
+        segment_size: int = transfer.SEGMENT_SIZE,
+        verify: bool = True,
+    ) -> str:
         """
         Download a file.
 
+        The Adler-32 checksum is computed while downloading and compared with the one reported by the server,
+        a mismatch raises a ChecksumMismatchError and removes the local file.
+
         :param url: Source URL
         :param localfile: Local file path
+        :param parallel: Number of HTTP range requests in flight, 1 downloads the file in a single stream
+        :param segment_size: Size in bytes of each range request when downloading in parallel
+        :param verify: Verify the Adler-32 checksum of the downloaded data
         :return: Local file path
         """
+        if parallel > 1:
+            return transfer.ranged_download(
+                self.session, url, localfile, segment_size, parallel, self.timeout, verify=verify
+            )
+        return transfer.stream_download(self.session, url, localfile, self.timeout, verify)
 
-        with self.session.get(url, stream=True, timeout=self.timeout) as d:
-            d.raise_for_status()
-            with open(localfile, "wb") as lf:
-                for chunk in d.iter_content(chunk_size=4194304):
-                    if chunk:
-                        lf.write(chunk)
-        return localfile
-
+    @cached("size")
     def size(self, pnfs: str) -> int:
         """
         Get file size.
@@ -189,8 +563,26 @@ class dcacheapy:
         :param url: File URL
         :return: File content as bytes
         """
-        return self.session.get(url, timeout=self.timeout).content
+        return remote_file.cat(self.session, url, self.timeout)
+
+    def open_remote(
+        self, url: str, block_size: int = remote_file.BLOCK_SIZE, cache_blocks: int = 8
+    ) -> remote_file.RemoteFile:
+        """
+        Open a remote file for random access reads with range requests, e.g. to read the header of a large file.
+
+        :param url: File URL
+        :param block_size: Size in bytes of the range requests of small reads
+        :param cache_blocks: Number of blocks kept in the read-ahead cache
+        :return: Seekable raw file object, wrap it in io.BufferedReader for buffered reads
+        """
+        size: Optional[int] = None
+        if self.cache is not None:
+            found, value = self.cache.get("size", url)
+            size = value if found else None
+        return remote_file.open_remote(self.session, url, size, block_size, cache_blocks, self.timeout)
 
+    @cached("exists")
     def exists(self, url: str) -> bool:
         """
         Check if file exists.
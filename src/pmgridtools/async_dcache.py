@@ -0,0 +1,338 @@
+import asyncio
+import os
+import ssl
+import xml.etree.ElementTree as ET
+import zlib
+from types import TracebackType
+from typing import Any, Dict, List, Optional, Self, Type, Union
+
+import pmgridtools.transfer as transfer
+from pmgridtools.api_dcache import (
+    BulkRequestStatus,
+    FileInfo,
+    bulk_request_id,
+    parse_bulk_page,
+)
+from pmgridtools.webdav_dcache import DAV, STAT_PROPFIND, WebDav
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None  # type: ignore[assignment]
+
+
+class _AsyncClient:
+    """Shared connection handling of the asynchronous dCache clients."""
+
+    def __init__(
+        self,
+        concurrency: int = 100,
+        http2: bool = True,
+        client: Optional["httpx.AsyncClient"] = None,
+        verify: Union[bool, str, ssl.SSLContext, None] = None,
+    ) -> None:
+        """
+        Initialize the client.
+
+        :param concurrency: Maximum number of requests in flight, also the size of the connection pool
+        :param http2: Use HTTP/2 when the door supports it, keep-alive HTTP/1.1 otherwise
+        :param client: Client to use, e.g. one shared with other clients. It is not closed by aclose. A default one
+            with concurrency connections is created if not given
+        :param verify: TLS settings of the default client, passed to httpx. An SSL context with the grid proxy and
+            the grid CA certificates is used if not given
+        """
+        if httpx is None:
+            raise ImportError("the asynchronous clients require httpx, install pmgridtools[async]")
+        self.cert: str = os.environ["X509_USER_PROXY"]
+        self.capath: str = "/etc/grid-security/certificates/"
+        self.timeout: int = 20
+        self._owns_client: bool = client is None
+        if client is None:
+            if verify is None:
+                context: ssl.SSLContext = ssl.create_default_context(capath=self.capath)
+                context.load_cert_chain(self.cert)
+                verify = context
+            client = httpx.AsyncClient(
+                verify=verify,
+                http2=http2,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            )
+        self.client: httpx.AsyncClient = client
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self) -> Self:
+        """Use the client as an async context manager, closing its connections on exit."""
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        """Close the connections of the client."""
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the connections of the client, unless it was passed in."""
+        if self._owns_client:
+            await self.client.aclose()
+
+    @staticmethod
+    def _raise_for_status(response: "httpx.Response", name: str) -> None:
+        """
+        Raise the exceptions of the synchronous clients for an unsuccessful response.
+
+        :param response: Response object
+        :param name: URL or path the request was about, for the error message
+        """
+        if response.status_code == 404:
+            raise FileNotFoundError(f"Could not found {name}")
+        elif response.status_code == 403:
+            raise PermissionError(f"response code {response.status_code} : {name}")
+        response.raise_for_status()
+
+    async def _request(self, method: str, url: str, **kwargs: Any) -> "httpx.Response":
+        """
+        Send a request, waiting for a free slot when concurrency requests are in flight.
+
+        :param method: HTTP method
+        :param url: URL
+        :return: Response object
+        """
+        async with self.semaphore:
+            return await self.client.request(method, url, **kwargs)
+
+    async def adler32(self, url: str) -> str:
+        """
+        Get ADLER32 checksum of a file.
+
+        :param url: File URL
+        :return: ADLER32 checksum string
+        """
+        response = await self._request("HEAD", url, headers={"Want-Digest": "ADLER32"})
+        self._raise_for_status(response, url)
+        digests: Dict[str, str] = transfer.parse_digest(response.headers.get("Digest", ""))
+        if "adler32" not in digests:
+            raise KeyError(f"No ADLER32 digest for {url}: {response.headers}")
+        return digests["adler32"]
+
+    async def exists(self, url: str) -> bool:
+        """
+        Check if file exists.
+
+        :param url: File URL
+        :return: True if file exists, False otherwise
+        """
+        response = await self._request("HEAD", url)
+        if response.status_code == 200:
+            return True
+        elif response.status_code == 404:
+            return False
+        elif response.status_code == 403:
+            raise PermissionError(f"response code {response.status_code} : {url}")
+        else:
+            raise ValueError(f"response code not a default value (expected 200 or 404){response.status_code} {url}")
+
+    async def download(self, url: str, localfile: str, verify: bool = True) -> str:
+        """
+        Download a file, computing its Adler-32 checksum on the fly.
+
+        :param url: Source URL
+        :param localfile: Local file path
+        :param verify: Compare the checksum with the Digest header of the response
+        :return: Local file path
+        """
+        checksum: int = zlib.adler32(b"")
+        headers: Dict[str, str] = {"Want-Digest": "ADLER32"} if verify else {}
+        async with self.semaphore:
+            async with self.client.stream("GET", url, headers=headers) as response:
+                self._raise_for_status(response, url)
+                with open(localfile, "wb") as lf:
+                    async for chunk in response.aiter_bytes(chunk_size=transfer.CHUNK_SIZE):
+                        lf.write(chunk)
+                        checksum = zlib.adler32(chunk, checksum)
+                expected: Optional[str] = transfer.parse_digest(response.headers.get("Digest", "")).get("adler32")
+        if verify:
+            transfer.verify_adler32(url, localfile, checksum, expected)
+        return localfile
+
+
+class AsyncDcacheApy(_AsyncClient):
+    """
+    Asynchronous dCache REST API client with the method surface of dcacheapy.
+
+    One instance drives many concurrent calls from a single event loop, e.g. with asyncio.gather; the semaphore
+    keeps at most concurrency requests in flight.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 100,
+        http2: bool = True,
+        api: str = "https://dcacheview.grid.surfsara.nl:22882/api/v1",
+        client: Optional["httpx.AsyncClient"] = None,
+        verify: Union[bool, str, ssl.SSLContext, None] = None,
+    ) -> None:
+        """
+        Initialize the client.
+
+        :param concurrency: Maximum number of requests in flight, also the size of the connection pool
+        :param http2: Use HTTP/2 when the frontend supports it, keep-alive HTTP/1.1 otherwise
+        :param api: Base URL of the dCache REST API
+        :param client: Client to use, e.g. one shared with other clients. It is not closed by aclose
+        :param verify: TLS settings of the default client, an SSL context with the grid proxy if not given
+        """
+        super().__init__(concurrency, http2, client, verify)
+        self.api: str = api
+
+    async def stat(self, pnfs: str) -> FileInfo:
+        """
+        Get size, locality, access latency and checksums of a file in a single request.
+
+        :param pnfs: File path
+        :return: File metadata record
+        """
+        params: Dict[str, str] = {"locality": "true", "checksum": "true", "optional": "true"}
+        response = await self._request(
+            "GET", f"{self.api}/namespace/{pnfs}", params=params, headers={"accept": "application/json"}
+        )
+        if response.is_success:
+            return FileInfo.from_json(pnfs, response.json())
+        elif response.status_code == 404:
+            raise FileNotFoundError(f"File not found: {pnfs}")
+        elif response.status_code == 403:
+            raise PermissionError(f"Permission denied for {pnfs}")
+        else:
+            raise RuntimeError(f"API request failed: {response}")
+
+    async def locality(self, pnfs: str) -> str:
+        """
+        Get file locality information.
+
+        :param pnfs: File path
+        :return: File locality (ONLINE, NEARLINE, or ONLINE_AND_NEARLINE)
+        """
+        return (await self.stat(pnfs)).locality
+
+    async def size(self, pnfs: str) -> int:
+        """
+        Get file size.
+
+        :param pnfs: File path
+        :return: File size in bytes
+        """
+        return (await self.stat(pnfs)).size
+
+    async def stage(self, pnfs: Union[str, List[str]], lifetime: int = 3) -> str:
+        """
+        Stage files from tape to disk.
+
+        :param pnfs: File path or list of file paths
+        :param lifetime: Lifetime in hours
+        :return: Bulk request ID, to be used with bulk_request_status
+        """
+        data: Dict[str, Any] = {
+            "activity": "PIN",
+            "arguments": {"lifetime": lifetime, "lifetimeUnit": "HOURS"},
+            "target": [pnfs] if isinstance(pnfs, str) else pnfs,
+            "expand_directories": "TARGETS",
+        }
+        response = await self._request(
+            "POST", f"{self.api}/bulk-requests", json=data, headers={"accept": "application/json"}
+        )
+        self._raise_for_status(response, ", ".join(data["target"]))
+        return bulk_request_id(response.headers)
+
+    async def bulk_request_status(self, request_id: str) -> BulkRequestStatus:
+        """
+        Get the state of a bulk request and of each of its targets.
+
+        :param request_id: Bulk request ID as returned by stage
+        :return: Bulk request state
+        """
+        status: str = ""
+        targets: Dict[str, str] = {}
+        errors: Dict[str, str] = {}
+        offset: int = 0
+        while True:
+            response = await self._request(
+                "GET",
+                f"{self.api}/bulk-requests/{request_id}",
+                params={"offset": offset},
+                headers={"accept": "application/json"},
+            )
+            if response.status_code == 404:
+                raise FileNotFoundError(f"Bulk request not found: {request_id}")
+            elif response.status_code == 403:
+                raise PermissionError(f"Permission denied for bulk request {request_id}")
+            elif not response.is_success:
+                raise RuntimeError(f"API request failed: {response}")
+            status, next_id = parse_bulk_page(response.json(), targets, errors)
+            if next_id < 0 or next_id <= offset:
+                break
+            offset = next_id
+        return BulkRequestStatus(request_id, status, targets, errors)
+
+
+class AsyncWebDav(_AsyncClient):
+    """Asynchronous WebDAV client with the method surface of WebDav."""
+
+    async def stat(self, url: str) -> FileInfo:
+        """
+        Get size, locality, access latency and checksums of a file with a single PROPFIND.
+
+        :param url: File URL
+        :return: File metadata record
+        """
+        response = await self._request(
+            "PROPFIND", url, content=STAT_PROPFIND, headers={"Depth": "0", "Content-Type": "application/xml"}
+        )
+        if response.status_code == 404:
+            raise FileNotFoundError(f"Could not found {url}")
+        elif response.status_code == 403:
+            raise PermissionError(f"response code {response.status_code} : {url}")
+        elif response.status_code != 207:
+            raise ValueError(f"response code not a default value (expected 207){response.status_code} : {url}")
+        for elem in ET.fromstring(response.content).iter(f"{DAV}response"):
+            info: Optional[FileInfo] = WebDav._parse_response(url, elem)
+            if info is not None:
+                return info
+        raise FileNotFoundError(f"Could not found {url}")
+
+    async def locality(self, url: str) -> str:
+        """
+        Get file locality information.
+
+        :param url: File URL
+        :return: File locality (ONLINE, NEARLINE, or ONLINE_AND_NEARLINE)
+        """
+        return (await self.stat(url)).locality
+
+    async def access_latency(self, url: str) -> Optional[str]:
+        """
+        Get file access latency information.
+
+        :param url: File URL
+        :return: Access latency ("NEARLINE" or "ONLINE")
+        """
+        return (await self.stat(url)).access_latency
+
+    async def size(self, url: str) -> int:
+        """
+        Get file size.
+
+        :param url: File URL
+        :return: File size in bytes
+        """
+        response = await self._request("HEAD", url)
+        if response.status_code == 200:
+            return int(response.headers["Content-Length"])
+        elif response.status_code == 404:
+            raise ValueError(f"file not found: {url}")
+        elif response.status_code == 403:
+            raise PermissionError(f"response code {response.status_code} : {url}")
+        else:
+            raise ValueError(f"response code not a default value (expected 200 or 404){response.status_code} : {url}")
@@ -0,0 +1,27 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def ordered_map(func: Callable[[T], R], items: Iterable[T], concurrency: int = 16) -> Iterator[R]:
+    """
+    Apply func to items in a thread pool and yield the results in input order.
+
+    At most a few times concurrency items are in flight, so long inputs are not submitted all at once.
+
+    :param func: Function to apply to every item
+    :param items: Input items
+    :param concurrency: Number of worker threads
+    :return: Iterator over the results, in the same order as items
+    """
+    pending: Deque[Future[R]] = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= concurrency * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
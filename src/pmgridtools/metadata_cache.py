@@ -0,0 +1,199 @@
+import functools
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+from urllib.parse import unquote, urlsplit
+
+T = TypeVar("T")
+C = TypeVar("C")
+
+# size and checksum never change for a file in dCache, locality and existence do
+DEFAULT_TTLS: Dict[str, float] = {
+    "size": 7 * 24 * 3600,
+    "adler32": 7 * 24 * 3600,
+    "access_latency": 24 * 3600,
+    "exists": 300,
+    "locality": 60,
+}
+
+
+def cache_key(key: str) -> str:
+    """
+    Normalise a cache key to a file path: URLs are reduced to their unquoted path, so an entry cached by the REST
+    API client under a pnfs path is found with the WebDAV door URL of the same file and the other way around.
+
+    :param key: File path or URL
+    :return: File path
+    """
+    parts = urlsplit(key)
+    path: str = unquote(parts.path) if parts.scheme else key
+    return path.rstrip("/") or "/"
+
+
+class MetadataCache:
+    """
+    Thread-safe LRU cache of file metadata with a time-to-live per field.
+
+    Entries are keyed by file path, URLs are converted with cache_key. The cache can be shared by several clients.
+    When a path is given, entries are also stored in an SQLite file, so processes running one after another or side
+    by side can reuse each other's lookups.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 100000,
+        ttls: Optional[Dict[str, float]] = None,
+        path: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Initialize the cache.
+
+        :param maxsize: Maximum number of entries kept in memory
+        :param ttls: Time-to-live in seconds per field, overrides the defaults; fields without TTL are not cached
+        :param path: Optional SQLite file to share entries across processes
+        :param clock: Function returning the current time in seconds since the epoch
+        """
+        self.maxsize: int = maxsize
+        self.ttls: Dict[str, float] = {**DEFAULT_TTLS, **(ttls or {})}
+        self.clock: Callable[[], float] = clock
+        self._entries: OrderedDict[Tuple[str, str], Tuple[Any, float]] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "field TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (field, key))"
+            )
+            self._db.commit()
+
+    def lookup(self, field: str, key: str, compute: Callable[[], T]) -> T:
+        """
+        Get a cached value, or compute and cache it.
+
+        :param field: Metadata field, e.g. size or locality
+        :param key: File path or URL
+        :param compute: Function that fetches the value from the server
+        :return: The cached or computed value
+        """
+        found, value = self.get(field, key)
+        if found:
+            return value  # type: ignore[no-any-return]
+        value = compute()
+        self.set(field, key, value)
+        return value  # type: ignore[no-any-return]
+
+    def get(self, field: str, key: str) -> Tuple[bool, Any]:
+        """
+        Get a cached value.
+
+        :param field: Metadata field
+        :param key: File path or URL
+        :return: Tuple of (found, value)
+        """
+        key = cache_key(key)
+        now: float = self.clock()
+        with self._lock:
+            entry = self._entries.get((field, key))
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end((field, key))
+                    return (True, entry[0])
+                del self._entries[(field, key)]
+            if self._db is None:
+                return (False, None)
+            row = self._db.execute(
+                "SELECT value, expires FROM metadata WHERE field=? AND key=? AND expires>?", (field, key, now)
+            ).fetchone()
+            if row is None:
+                return (False, None)
+            value = json.loads(row[0])
+            self._store((field, key), value, row[1])
+            return (True, value)
+
+    def set(self, field: str, key: str, value: Any) -> None:
+        """
+        Cache a value, fields without TTL are ignored.
+
+        :param field: Metadata field
+        :param key: File path or URL
+        :param value: Value to cache, must be JSON serialisable when an SQLite file is used
+        """
+        ttl: Optional[float] = self.ttls.get(field)
+        if not ttl:
+            return
+        key = cache_key(key)
+        expires: float = self.clock() + ttl
+        with self._lock:
+            self._store((field, key), value, expires)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO metadata (field, key, value, expires) VALUES (?, ?, ?, ?)",
+                    (field, key, json.dumps(value), expires),
+                )
+                self._db.commit()
+
+    def invalidate(self, key: str, children: bool = False) -> None:
+        """
+        Drop all cached fields of a file, e.g. after it was removed or overwritten.
+
+        :param key: File path or URL
+        :param children: Also drop the entries of everything below the path, e.g. after a bulk request that
+            expanded a directory
+        """
+        key = cache_key(key)
+        prefix: str = key.rstrip("/") + "/"
+        with self._lock:
+            for field in self.ttls:
+                self._entries.pop((field, key), None)
+            if children:
+                for entry in [entry for entry in self._entries if entry[1].startswith(prefix)]:
+                    del self._entries[entry]
+            if self._db is not None:
+                self._db.execute("DELETE FROM metadata WHERE key=?", (key,))
+                if children:
+                    # "0" follows "/", so the range holds exactly the keys starting with the prefix
+                    self._db.execute("DELETE FROM metadata WHERE key>=? AND key<?", (prefix, prefix[:-1] + "0"))
+                self._db.commit()
+
+    def _store(self, entry: Tuple[str, str], value: Any, expires: float) -> None:
+        """
+        Put an entry in memory and evict the least recently used entries. Must be called with the lock held.
+
+        :param entry: Tuple of (field, key)
+        :param value: Value to cache
+        :param expires: Expiry time
+        """
+        self._entries[entry] = (value, expires)
+        self._entries.move_to_end(entry)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def cached(field: str) -> Callable[[Callable[[C, str], T]], Callable[[C, str], T]]:
+    """
+    Decorator caching the result of a client method that takes a single path or URL.
+
+    The cache is taken from the cache attribute of the client, nothing is cached if that is None.
+
+    :param field: Metadata field the method returns
+    :return: Decorator
+    """
+
+    def decorator(method: Callable[[C, str], T]) -> Callable[[C, str], T]:
+        @functools.wraps(method)
+        def wrapper(self: C, key: str) -> T:
+            cache: Optional[MetadataCache] = getattr(self, "cache", None)
+            if cache is None:
+                return method(self, key)
+            return cache.lookup(field, key, lambda: method(self, key))
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,195 @@
+import json
+import os
+import tempfile
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+@dataclass(frozen=True)
+class RequestEvent:
+    """A finished HTTP request, as passed to the hooks of a TransportAdapter."""
+
+    method: str
+    url: str
+    status: Optional[int]
+    seconds: float
+    retries: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    in_flight: int = 1
+    error: Optional[str] = None
+
+    @property
+    def endpoint(self) -> str:
+        """Scheme, host and port of the request, e.g. the REST frontend or a WebDAV door."""
+        parts = urlsplit(self.url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+
+@dataclass
+class _Series:
+    """Accumulated statistics of the requests with the same method and endpoint."""
+
+    buckets: List[int]
+    count: int = 0
+    seconds: float = 0
+    retries: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    statuses: Counter = field(default_factory=Counter)
+
+
+class Metrics:
+    """
+    Thread-safe request metrics, to be used as a hook of a TransportAdapter.
+
+    Latency is the time until the response headers arrived, so for streamed downloads it does not include the
+    transfer of the body; bytes received are taken from the Content-Length of the response.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        """
+        Initialize empty metrics.
+
+        :param buckets: Upper bounds in seconds of the latency histogram buckets
+        """
+        self.bucket_bounds: Tuple[float, ...] = buckets
+        self.max_in_flight: int = 0
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def __call__(self, event: RequestEvent) -> None:
+        """
+        Record a finished request.
+
+        :param event: Request event
+        """
+        key: Tuple[str, str] = (event.method, event.endpoint)
+        with self._lock:
+            series: Optional[_Series] = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series([0] * (len(self.bucket_bounds) + 1))
+            series.count += 1
+            series.seconds += event.seconds
+            series.buckets[self._bucket(event.seconds)] += 1
+            series.retries += event.retries
+            series.bytes_sent += event.bytes_sent
+            series.bytes_received += event.bytes_received
+            series.statuses[str(event.status) if event.status is not None else event.error or "error"] += 1
+            self.max_in_flight = max(self.max_in_flight, event.in_flight)
+
+    def _bucket(self, seconds: float) -> int:
+        """
+        Index of the histogram bucket of a latency.
+
+        :param seconds: Latency
+        :return: Bucket index
+        """
+        for index, bound in enumerate(self.bucket_bounds):
+            if seconds <= bound:
+                return index
+        return len(self.bucket_bounds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Current values, e.g. to be written as JSON.
+
+        :return: Dictionary with the statistics per method and endpoint
+        """
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "bucket_bounds": list(self.bucket_bounds),
+                "requests": [
+                    {
+                        "method": method,
+                        "endpoint": endpoint,
+                        "count": series.count,
+                        "seconds": series.seconds,
+                        "buckets": list(series.buckets),
+                        "retries": series.retries,
+                        "bytes_sent": series.bytes_sent,
+                        "bytes_received": series.bytes_received,
+                        "statuses": dict(series.statuses),
+                    }
+                    for (method, endpoint), series in sorted(self._series.items())
+                ],
+            }
+
+    def to_prometheus(self, prefix: str = "pmgridtools") -> str:
+        """
+        Current values in the Prometheus text exposition format.
+
+        :param prefix: Prefix of the metric names
+        :return: Metrics text
+        """
+        snapshot: Dict[str, Any] = self.snapshot()
+        series: List[Tuple[str, Dict[str, Any]]] = [
+            (f'method="{item["method"]}",endpoint="{item["endpoint"]}"', item) for item in snapshot["requests"]
+        ]
+        # all samples of a metric family have to be contiguous
+        lines: List[str] = [f"# TYPE {prefix}_request_duration_seconds histogram"]
+        for labels, item in series:
+            cumulative: int = 0
+            for bound, count in zip([*snapshot["bucket_bounds"], "+Inf"], item["buckets"]):
+                cumulative += count
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{prefix}_request_duration_seconds_sum{{{labels}}} {item['seconds']}")
+            lines.append(f"{prefix}_request_duration_seconds_count{{{labels}}} {item['count']}")
+        lines.append(f"# TYPE {prefix}_requests_total counter")
+        for labels, item in series:
+            for status, count in sorted(item["statuses"].items()):
+                lines.append(f'{prefix}_requests_total{{{labels},status="{status}"}} {count}')
+        for name, key in (
+            ("request_retries", "retries"),
+            ("bytes_sent", "bytes_sent"),
+            ("bytes_received", "bytes_received"),
+        ):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.extend(f"{prefix}_{name}_total{{{labels}}} {item[key]}" for labels, item in series)
+        lines.append(f"# TYPE {prefix}_max_in_flight gauge")
+        lines.append(f"{prefix}_max_in_flight {snapshot['max_in_flight']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Write the current values atomically, as JSON if the path ends with .json and for the Prometheus textfile
+        collector otherwise.
+
+        :param path: Output file
+        """
+        text: str = json.dumps(self.snapshot(), indent=2) + "\n" if path.endswith(".json") else self.to_prometheus()
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".metrics-")
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        # mkstemp creates the file readable by the owner only, the textfile collector usually runs as another user
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+
+    def summary(self) -> str:
+        """
+        Human readable summary per method and endpoint.
+
+        :return: Table with request counts, mean latency, statuses, retries and bytes
+        """
+        lines: List[str] = [
+            f"{'method':<9}{'endpoint':<45}{'count':>8}{'mean ms':>9}{'retries':>8}{'MB sent':>9}{'MB recv':>9}"
+            "  statuses"
+        ]
+        snapshot: Dict[str, Any] = self.snapshot()
+        for series in snapshot["requests"]:
+            mean: float = series["seconds"] / series["count"] * 1000 if series["count"] else 0
+            statuses: str = " ".join(f"{status}:{count}" for status, count in sorted(series["statuses"].items()))
+            lines.append(
+                f"{series['method']:<9}{series['endpoint']:<45}{series['count']:>8}{mean:>9.1f}"
+                f"{series['retries']:>8}{series['bytes_sent'] / 1e6:>9.1f}{series['bytes_received'] / 1e6:>9.1f}"
+                f"  {statuses}"
+            )
+        lines.append(f"maximum requests in flight: {snapshot['max_in_flight']}")
+        return "\n".join(lines)
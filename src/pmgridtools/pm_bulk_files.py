@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+from typing import Dict, Iterable, List
+
+import requests
+
+import pmgridtools.transport as transport
+from pmgridtools.api_dcache import (
+    BULK_CHUNK_SIZE,
+    EXPAND_DIRECTORIES,
+    BulkRequestStatus,
+    dcacheapy,
+)
+from pmgridtools.pnfs_paths import load_normaliser
+
+
+def submit(dcache: dcacheapy, args: argparse.Namespace, pnfs: List[str]) -> List[str]:
+    """
+    Submit the bulk requests of the chosen subcommand.
+
+    :param dcache: dCache API client
+    :param args: Parsed command line arguments
+    :param pnfs: Target paths
+    :return: Bulk request IDs
+    """
+    if args.command == "unpin":
+        return dcache.unpin(pnfs, args.pin_id, args.expand, args.chunk_size)
+    elif args.command == "delete":
+        return dcache.delete(pnfs, not args.dirs, args.expand, args.chunk_size)
+    else:
+        return dcache.update_qos(pnfs, args.target_qos, args.expand, args.chunk_size)
+
+
+def wait(dcache: dcacheapy, request_ids: List[str], poll_interval: float) -> Dict[str, str]:
+    """
+    Wait until all bulk requests are finished.
+
+    :param dcache: dCache API client
+    :param request_ids: Bulk request IDs
+    :param poll_interval: Seconds between polls
+    :return: Error message per failed target
+    """
+    pending: List[str] = list(request_ids)
+    errors: Dict[str, str] = {}
+    while pending:
+        time.sleep(poll_interval)
+        for request_id in list(pending):
+            status: BulkRequestStatus = dcache.bulk_request_status(request_id)
+            if status.finished:
+                pending.remove(request_id)
+                errors.update({t: state for t, state in status.targets.items() if state in ("FAILED", "CANCELLED")})
+                errors.update(status.errors)
+    return errors
+
+
+def main() -> None:
+    """Main entry point for the pm_bulk_files script."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description="unpin, delete or change the QoS of files with dCache bulk requests"
+    )
+    common: argparse.ArgumentParser = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--expand",
+        choices=EXPAND_DIRECTORIES,
+        default="NONE",
+        help="apply to the files in directories given as target: not at all, only directly in it (TARGETS) or "
+        "recursively (ALL) (default: %(default)s)",
+    )
+    common.add_argument(
+        "--chunk-size",
+        type=int,
+        default=BULK_CHUNK_SIZE,
+        help="maximum number of targets per bulk request (default: %(default)s)",
+    )
+    common.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="number of retries of failed idempotent requests, with exponential back-off (default: %(default)s)",
+    )
+    common.add_argument(
+        "--path-rules",
+        type=str,
+        default=None,
+        help="TOML file with [[rules]] mapping URL and mount point prefixes to pnfs paths",
+    )
+    common.add_argument("--wait", action="store_true", help="wait until the requests are finished")
+    common.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10,
+        help="seconds between status checks with --wait (default: %(default)s)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    unpin: argparse.ArgumentParser = subparsers.add_parser("unpin", parents=[common], help="release pins")
+    unpin.add_argument(
+        "--pin-id",
+        type=str,
+        default=None,
+        help="only release the pins created by this (stage) bulk request (default: all pins)",
+    )
+    delete: argparse.ArgumentParser = subparsers.add_parser("delete", parents=[common], help="delete files")
+    delete.add_argument("--dirs", action="store_true", help="also delete the directories given as target")
+    qos: argparse.ArgumentParser = subparsers.add_parser("qos", parents=[common], help="change QoS")
+    qos.add_argument("target_qos", choices=["disk", "tape", "disk+tape"], help="new QoS of the files")
+    # after the positional arguments of the subcommands, any number of files would swallow the target QoS
+    for subparser in (unpin, delete, qos):
+        subparser.add_argument("files", metavar="N", type=str, nargs="*", help="files or directories", default=None)
+
+    args: argparse.Namespace = parser.parse_args()
+
+    # stdin is read line by line, a long file list is only held once, as normalised paths
+    rawfiles: Iterable[str] = args.files if sys.stdin.isatty() else (line.strip() for line in sys.stdin)
+    pnfs, rejected = load_normaliser(args.path_rules).normalise_many(rawfiles)
+    for rawfile in rejected:
+        print(f"invalid path: {rawfile}. skipped", file=sys.stderr)
+    if not pnfs:
+        exit("no valid input files")
+
+    session: requests.Session = transport.make_session(os.environ["X509_USER_PROXY"], retries=args.retries)
+    dcache: dcacheapy = dcacheapy(session=session)
+    request_ids: List[str] = submit(dcache, args, pnfs)
+    for request_id in request_ids:
+        print(request_id)
+
+    if args.wait:
+        errors: Dict[str, str] = wait(dcache, request_ids, args.poll_interval)
+        for target, error in errors.items():
+            print(f"{target}: {error}", file=sys.stderr)
+        if errors:
+            print(f"{len(errors)} of {len(pnfs)} targets failed", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,112 +1,941 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
+import itertools
 import logging
 import os
-import re
+import posixpath
+import queue
+import random
+import sqlite3
 import sys
+import threading
 import time
-from typing import Dict, List, Set, Tuple
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 import tqdm
 
 import pmgridtools.api_dcache as api_dcache
+import pmgridtools.transport as transport
+from pmgridtools.concurrency import ordered_map
+from pmgridtools.metrics import Metrics
+from pmgridtools.pnfs_paths import PathNormaliser, load_normaliser
+from pmgridtools.stage_coordinator import ChunkTracker, Coordinator
+from pmgridtools.stage_state import (
+    FAILED,
+    ONLINE,
+    PENDING,
+    RELEASED,
+    STAGING,
+    FileRecord,
+    StageState,
+)
+from pmgridtools.webdav_dcache import WebDav
+
+T = TypeVar("T")
+
+# marks the end of the items of an InputPipeline
+_END: object = object()
+# number of entries per directory listing request
+LISTING_PAGE_SIZE: int = 1000
 
 
 def get_pnfs(url: str) -> str:
     """
-    Convert URL to PNFS path.
+    Convert URL to PNFS path, exiting on paths outside dCache. Use PathNormaliser to handle invalid paths.
 
     :param url: Input URL or local path
     :return: PNFS path
     """
-    url = url.strip()
-    pnfs = None
-    if url.startswith("gsiftp://") or url.startswith("srm://"):
-        pnfs = re.sub(r".*/pnfs/grid.sara.nl/", "/pnfs/grid.sara.nl/", url)
+    pnfs: Optional[str] = PathNormaliser().normalise(url)
+    if pnfs is None:
+        print(
+            f"Invalid URL: only gsiftp:// or local paths under /project/projectmine/Data/GridStorage/ "
+            f"allowed. Found: {url.strip()}"
+        )
+        sys.exit(1)
+    return pnfs
 
-    else:
-        url = os.path.abspath(url)
-        # print(url)
-        if url.startswith("/project/projectmine/Data/GridStorage/"):
-            pnfs = url.replace(
-                "/project/projectmine/Data/GridStorage/",
-                "/pnfs/grid.sara.nl/data/lsgrid/Project_MinE/",
-            )
-        elif url.startswith("/projectmine-nfs/"):
-            pnfs = url.replace(
-                "/projectmine-nfs/",
-                "/pnfs/grid.sara.nl/data/lsgrid/Project_MinE/",
-            )
+
+class DirectoryListings:
+    """
+    Directory listings shared by the batches of a run, so a directory whose files are spread over many batches is
+    listed only once.
+
+    A listing is read page by page, only as far as the requested files need it. Entries that were listed but not
+    requested yet are kept for later batches, up to maxentries in total; entries beyond that are dropped and the
+    files they belong to are checked one by one when they are requested.
+    """
+
+    def __init__(
+        self, dcache: api_dcache.dcacheapy, page_size: int = LISTING_PAGE_SIZE, maxentries: int = 100000
+    ) -> None:
+        """
+        Initialize empty listings.
+
+        :param dcache: dCache API client
+        :param page_size: Number of entries per listing request
+        :param maxentries: Maximum number of listed entries kept for later batches
+        """
+        self.dcache: api_dcache.dcacheapy = dcache
+        self.page_size: int = page_size
+        self.maxentries: int = maxentries
+        self.kept: int = 0
+        self._cursors: Dict[str, Iterator[api_dcache.FileInfo]] = {}
+        self._entries: Dict[str, Dict[str, api_dcache.FileInfo]] = {}
+        self._listed: Set[str] = set()
+        self._dropped: Set[str] = set()
+        self._lock: threading.Lock = threading.Lock()
+
+    def known(self, directory: str) -> bool:
+        """
+        Check if a directory was (partly) listed before.
+
+        :param directory: Directory path
+        :return: True if the directory has a listing
+        """
+        with self._lock:
+            return directory in self._entries or directory in self._listed
+
+    def resolve(self, directory: str, files: Set[str], maxpages: int) -> Dict[str, Optional[api_dcache.FileInfo]]:
+        """
+        Look up files of one directory in its listing, continuing the listing by at most maxpages pages.
+
+        Different directories may be resolved concurrently, a single directory must not. The shared state is only
+        changed under the lock, pages are requested outside of it.
+
+        :param directory: Directory path
+        :param files: Paths of the requested files in the directory
+        :param maxpages: Maximum number of listing pages to request
+        :return: Dictionary mapping the resolved files to their metadata record, or to None when the complete
+            listing shows they do not exist. Files that are not in it have to be checked one by one
+        """
+        found: Dict[str, Optional[api_dcache.FileInfo]] = {}
+        with self._lock:
+            entries: Dict[str, api_dcache.FileInfo] = self._entries.setdefault(directory, {})
+            for pnfs in files & entries.keys():
+                found[pnfs] = entries.pop(pnfs)
+            self.kept -= len(found)
+            listed: bool = directory in self._listed
+        wanted: Set[str] = files - found.keys()
+        pages: int = 0
+        while wanted and not listed and pages < maxpages:
+            with self._lock:
+                if directory not in self._cursors:
+                    self._cursors[directory] = self.dcache.list_dir(directory, self.page_size)
+                cursor: Iterator[api_dcache.FileInfo] = self._cursors[directory]
+            try:
+                page: List[api_dcache.FileInfo] = list(itertools.islice(cursor, self.page_size))
+            except FileNotFoundError:
+                page = []
+            pages += 1
+            with self._lock:
+                if len(page) < self.page_size:
+                    self._listed.add(directory)
+                    del self._cursors[directory]
+                    listed = True
+                for info in page:
+                    if info.path in wanted:
+                        wanted.discard(info.path)
+                        found[info.path] = info
+                    elif self.kept < self.maxentries:
+                        entries[info.path] = info
+                        self.kept += 1
+                    else:
+                        self._dropped.add(directory)
+        with self._lock:
+            if listed and directory not in self._dropped:
+                # the whole directory was listed, the files that were not in it do not exist
+                found.update(dict.fromkeys(wanted))
+            if not entries:
+                del self._entries[directory]
+        return found
+
+
+def precheck_files(
+    dcache: api_dcache.dcacheapy,
+    cleanpnfs: List[str],
+    concurrency: int = 16,
+    listing_threshold: int = 16,
+    listings: Optional[DirectoryListings] = None,
+) -> Iterator[api_dcache.FileInfo]:
+    """
+    Check locality and size of files concurrently, with a single namespace request per file.
+
+    Files are grouped by parent directory. Directories holding at least listing_threshold of the requested
+    files are resolved with a paged directory listing instead, which costs one request per page of entries. A
+    listing stops once all requested files of the directory were found, or after as many pages as files were
+    requested, so it never costs more requests than it saves; the files it did not reach are checked one by one.
+
+    :param dcache: dCache API client, its connection pool should hold at least concurrency connections
+    :param cleanpnfs: PNFS paths to check
+    :param concurrency: Number of requests in flight
+    :param listing_threshold: Minimum number of requested files in a directory to list it, 0 disables listings
+    :param listings: Listings of earlier calls to continue, e.g. of the previous batches of a run
+    :return: Iterator over the metadata records in input order. Files that could not be found are skipped
+    """
+    bydir: Dict[str, Set[str]] = defaultdict(set)
+    for pnfs in cleanpnfs:
+        bydir[posixpath.dirname(pnfs)].add(pnfs)
+    dirlistings: DirectoryListings = listings if listings is not None else DirectoryListings(dcache)
+    listdirs: List[Tuple[str, int]] = []
+    if listing_threshold > 0:
+        for directory, files in bydir.items():
+            maxpages: int = len(files) if len(files) >= listing_threshold else 0
+            if maxpages or dirlistings.known(directory):
+                listdirs.append((directory, maxpages))
+
+    listed: Dict[str, Optional[api_dcache.FileInfo]] = {}
+    for infos in ordered_map(lambda item: dirlistings.resolve(item[0], bydir[item[0]], item[1]), listdirs, concurrency):
+        listed.update(infos)
+
+    def check(pnfs: str) -> Optional[api_dcache.FileInfo]:
+        if pnfs in listed:
+            info = listed[pnfs]
         else:
-            print(
-                f"Invalid URL: only gsiftp:// or local paths under /project/projectmine/Data/GridStorage/ "
-                f"allowed. Found: {url}"
-            )
+            try:
+                info = dcache.stat(pnfs)
+            except FileNotFoundError:
+                info = None
+        if info is None:
+            print(f"could not find {pnfs}. skip staging this file", file=sys.stderr)
+        return info
 
-            sys.exit(1)
+    for info in ordered_map(check, cleanpnfs, concurrency):
+        if info is not None:
+            yield info
+
+
+def read_lines(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Input stage: strip lines and skip empty ones.
+
+    :param lines: Raw input lines, e.g. sys.stdin, which is read lazily
+    :return: Iterator over the stripped lines
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
 
-    assert pnfs is not None, "could not return an empty pnfs"
-    return pnfs
+
+def normalise(urls: Iterable[str], normaliser: PathNormaliser, rejected: List[str]) -> Iterator[str]:
+    """
+    Normalisation stage: convert URLs and local paths to PNFS paths.
+
+    :param urls: Input URLs or local paths
+    :param normaliser: Path normaliser
+    :param rejected: List to which the inputs that are not dCache paths are added
+    :return: Iterator over the PNFS paths
+    """
+    for url in urls:
+        pnfs: Optional[str] = normaliser.normalise(url)
+        if pnfs is None:
+            print(f"invalid path: {url}. skip staging this file", file=sys.stderr)
+            rejected.append(url)
+        else:
+            yield pnfs
+
+
+def dedupe(items: Iterable[str], memory_limit: int = 1000000) -> Iterator[str]:
+    """
+    Deduplication stage: pass every item only once.
+
+    The items seen are remembered in memory up to memory_limit of them; beyond that they are moved to a temporary
+    SQLite database on disk, so memory stays bounded for any input size at the cost of a lookup per item.
+
+    :param items: Input items
+    :param memory_limit: Maximum number of items remembered in memory
+    :return: Iterator over the first occurrence of every item
+    """
+    seen: Set[str] = set()
+    # an empty file name gives a private temporary database on disk, removed when it is closed
+    spilled: Optional[sqlite3.Connection] = None
+    try:
+        for item in items:
+            if item in seen:
+                continue
+            if spilled is not None and spilled.execute("SELECT 1 FROM seen WHERE item=?", (item,)).fetchone():
+                continue
+            seen.add(item)
+            if len(seen) >= memory_limit:
+                if spilled is None:
+                    spilled = sqlite3.connect("")
+                    spilled.execute("CREATE TABLE seen (item TEXT PRIMARY KEY) WITHOUT ROWID")
+                spilled.executemany("INSERT INTO seen (item) VALUES (?)", ((seenitem,) for seenitem in seen))
+                spilled.commit()
+                seen.clear()
+            yield item
+    finally:
+        if spilled is not None:
+            spilled.close()
+
+
+def lookup_records(
+    dcache: api_dcache.dcacheapy,
+    pnfs: Iterable[str],
+    known: Dict[str, FileRecord],
+    concurrency: int = 16,
+    listing_threshold: int = 16,
+    batch_size: int = 1000,
+    listings: Optional[DirectoryListings] = None,
+) -> Iterator[Tuple[FileRecord, bool]]:
+    """
+    Metadata stage: get size, locality and tape hint of the files that are not known yet.
+
+    The input is consumed in batches of batch_size files, directories are only listed when enough files of the
+    same batch are in them. Every directory is listed at most once, later batches continue its listing.
+
+    :param dcache: dCache API client
+    :param pnfs: PNFS paths
+    :param known: Records of a previous run, these files are not checked again
+    :param concurrency: Number of requests in flight
+    :param listing_threshold: Minimum number of files of a batch in a directory to list it, 0 disables listings
+    :param batch_size: Number of files per batch
+    :param listings: Directory listings to continue, a new set is used if not given
+    :return: Iterator over tuples of (record, whether it is new), files that could not be found are skipped
+    """
+    dirlistings: DirectoryListings = listings if listings is not None else DirectoryListings(dcache)
+    paths: Iterator[str] = iter(pnfs)
+    while True:
+        batch: List[str] = list(itertools.islice(paths, batch_size))
+        if not batch:
+            break
+        tocheck: List[str] = [path for path in batch if path not in known]
+        checked: Iterator[api_dcache.FileInfo] = precheck_files(
+            dcache, tocheck, concurrency, listing_threshold, dirlistings
+        )
+        info: Optional[api_dcache.FileInfo] = next(checked, None)
+        for path in batch:
+            if path in known:
+                yield (known[path], False)
+            elif info is not None and info.path == path:
+                tapehint: str = info.storage_class or ",".join(sorted(info.labels))
+                yield (FileRecord(path, info.size, ONLINE if info.online else PENDING, tapehint or None), True)
+                info = next(checked, None)
+
+
+class InputPipeline(Generic[T]):
+    """
+    Runs input stages in a background thread and hands their output over through a bounded queue.
+
+    The producer blocks when the queue is full, so the stages never run further ahead of the consumer than
+    maxsize items plus the requests in flight within the stages.
+    """
+
+    def __init__(self, items: Iterable[T], maxsize: int = 10000) -> None:
+        """
+        Start the pipeline.
+
+        :param items: Output of the last stage, consumed in the background thread
+        :param maxsize: Maximum number of items waiting for the consumer
+        """
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._error: Optional[BaseException] = None
+        self._finished: bool = False
+        self._thread: threading.Thread = threading.Thread(target=self._run, args=(items,), daemon=True)
+        self._thread.start()
+
+    def _run(self, items: Iterable[T]) -> None:
+        """
+        Feed the queue, ending with a sentinel.
+
+        :param items: Output of the last stage
+        """
+        try:
+            for item in items:
+                self._queue.put(item)
+        except BaseException as e:
+            # also SystemExit, which would otherwise only end this thread
+            self._error = e
+        finally:
+            self._queue.put(_END)
+
+    @property
+    def running(self) -> bool:
+        """True while the stages are producing items."""
+        return self._thread.is_alive()
+
+    @property
+    def finished(self) -> bool:
+        """True when the stages are exhausted and all items were taken."""
+        return self._finished
+
+    def available(self) -> int:
+        """
+        Number of items that can be taken without waiting.
+
+        :return: Approximate number of waiting items
+        """
+        return self._queue.qsize()
+
+    def take(self, maxitems: int) -> List[T]:
+        """
+        Take the waiting items without blocking. Errors raised in the stages are raised here.
+
+        :param maxitems: Maximum number of items to take
+        :return: List of items, possibly empty
+        """
+        items: List[T] = []
+        while len(items) < maxitems and not self._finished:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                self._finished = True
+                if self._error is not None:
+                    raise self._error
+            else:
+                items.append(item)
+        return items
+
+
+class PollScheduler:
+    """
+    Schedules status checks with a per key exponential back-off.
+
+    Every key (e.g. a bulk request ID) has its own next check time. The interval is reset to min_interval when a
+    check showed progress and multiplied by factor otherwise, capped at max_interval. A random jitter spreads
+    checks that were scheduled at the same moment.
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 60,
+        max_interval: float = 900,
+        factor: float = 2,
+        jitter: float = 0.1,
+        slack: float = 5,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Initialize the scheduler.
+
+        :param min_interval: Interval in seconds after scheduling a new key or after a check that showed progress
+        :param max_interval: Maximum interval in seconds
+        :param factor: Back-off factor for checks without progress
+        :param jitter: Relative random variation of the interval
+        :param slack: Keys due within this many seconds are returned together with the keys that are due now
+        :param clock: Function returning the current time in seconds
+        """
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.factor: float = factor
+        self.jitter: float = jitter
+        self.slack: float = slack
+        self.clock: Callable[[], float] = clock
+        self._heap: List[Tuple[float, str]] = []
+        self._due_at: Dict[str, float] = {}
+        self._interval: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        """Number of scheduled keys."""
+        return len(self._due_at)
+
+    def add(self, key: str) -> None:
+        """
+        Schedule a new key, its first check is due after min_interval.
+
+        :param key: Key to schedule
+        """
+        self._interval[key] = self.min_interval
+        self._push(key)
+
+    def reschedule(self, key: str, progressed: bool) -> None:
+        """
+        Schedule the next check of a key that was just checked.
+
+        :param key: Key that was checked
+        :param progressed: Whether the check showed progress
+        """
+        if progressed:
+            self._interval[key] = self.min_interval
+        else:
+            self._interval[key] = min(self._interval[key] * self.factor, self.max_interval)
+        self._push(key)
+
+    def remove(self, key: str) -> None:
+        """
+        Stop scheduling a key.
+
+        :param key: Key to remove
+        """
+        self._due_at.pop(key, None)
+        self._interval.pop(key, None)
+
+    def due(self) -> List[str]:
+        """
+        Take the keys that are due, they are not scheduled again until reschedule is called.
+
+        :return: Keys that are due now or within the slack period
+        """
+        now: float = self.clock()
+        keys: List[str] = []
+        while self._heap and self._heap[0][0] <= now + self.slack:
+            due_at, key = heapq.heappop(self._heap)
+            # entries of removed or rescheduled keys are skipped
+            if self._due_at.get(key) == due_at:
+                del self._due_at[key]
+                keys.append(key)
+        return keys
+
+    def next_due(self) -> Optional[float]:
+        """
+        Time of the next check.
+
+        :return: Time according to clock, or None if nothing is scheduled
+        """
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _push(self, key: str) -> None:
+        """
+        Put a key on the heap according to its current interval.
+
+        :param key: Key to schedule
+        """
+        interval: float = self._interval[key] * (1 + random.uniform(-self.jitter, self.jitter))
+        due_at: float = self.clock() + interval
+        self._due_at[key] = due_at
+        heapq.heappush(self._heap, (due_at, key))
+
+
+class InputOrder:
+    """
+    Ordering stage in front of StageManager.stage, keeping files in input order.
+
+    Subclasses reorder the files added to the StageManager and group them, every bulk request that is submitted
+    only contains files of a single group.
+    """
+
+    def order(self, jobs: Dict[str, int]) -> Dict[str, int]:
+        """
+        Order files before they are queued.
+
+        :param jobs: Dictionary mapping file paths to file sizes
+        :return: The same files in staging order
+        """
+        return jobs
+
+    def group(self, pnfs: str) -> Tuple[str, ...]:
+        """
+        Group key of a file, consecutive files with the same key are staged in the same bulk request.
+
+        :param pnfs: File path
+        :return: Group key
+        """
+        return ()
+
+
+class TapeOrder(InputOrder):
+    """
+    Orders files so that files that are likely on the same tape are staged together.
+
+    Files are grouped by tape hint (e.g. the storage class or a tape family label reported by the namespace API)
+    and sorted by directory and name within a group, so each bulk request targets contiguous data.
+    """
+
+    def __init__(self, hints: Optional[Dict[str, str]] = None) -> None:
+        """
+        Initialize the ordering.
+
+        :param hints: Dictionary mapping file paths to tape hints, files without hint share one group
+        """
+        self.hints: Dict[str, str] = hints if hints is not None else {}
+
+    def order(self, jobs: Dict[str, int]) -> Dict[str, int]:
+        """
+        Order files by tape hint, directory and name.
+
+        :param jobs: Dictionary mapping file paths to file sizes
+        :return: The same files in staging order
+        """
+        return dict(sorted(jobs.items(), key=lambda job: (*self.group(job[0]), *posixpath.split(job[0]))))
+
+    def group(self, pnfs: str) -> Tuple[str, ...]:
+        """
+        Group key of a file, the directory is not part of it to avoid a bulk request per directory.
+
+        :param pnfs: File path
+        :return: Tuple of (tape hint,)
+        """
+        return (self.hints.get(pnfs, ""),)
 
 
 class StageManager:
-    """Manages file staging operations."""
+    """
+    Manages file staging operations.
+
+    Files move from the pending queue (in the order they were added) to staging once a PIN is requested, and
+    leave the manager once their bulk request target has finished. All bookkeeping is done with dictionaries
+    keyed by pnfs and running byte counters, so a staging cycle only costs work for the files that change state.
+
+    The bytes that are requested but not yet online form a sliding window limited to max_stage_gb. Whenever files
+    come online the window is refilled with the pending files that fit in the remaining budget. When a Coordinator
+    is given as budget, the window is shared with the other workers of the coordinator instead.
+    """
 
-    def __init__(self) -> None:
-        """Initialize the StageManager."""
-        self.files2stage: Dict[str, int] = {}
-        self.staging: List[str] = []
-        self.dcacheapy: api_dcache.dcacheapy = api_dcache.dcacheapy()
+    def __init__(
+        self,
+        dcache: Optional[api_dcache.dcacheapy] = None,
+        scheduler: Optional[PollScheduler] = None,
+        max_stage_gb: float = 200,
+        lookahead: int = 1000,
+        order: Optional[InputOrder] = None,
+        state: Optional[StageState] = None,
+        budget: Optional[Coordinator] = None,
+    ) -> None:
+        """
+        Initialize the StageManager.
+
+        :param dcache: dCache API client to use, a new one is created if not given
+        :param scheduler: Scheduler deciding when bulk requests are polled, a default one is created if not given
+        :param max_stage_gb: Maximum amount of data in GB that is being staged at the same time
+        :param lookahead: Maximum number of pending files that are skipped when looking for files that fit in the
+            remaining budget
+        :param order: Ordering and grouping of the files in bulk requests, input order if not given
+        :param state: Store in which every state change is recorded, so the run can be resumed
+        :param budget: Coordinator holding the staging budget shared by several workers, max_stage_gb only limits
+            this manager if not given
+        """
+        self.pending: OrderedDict[str, int] = OrderedDict()
+        self.staging: Dict[str, int] = {}
+        self.requests: Dict[str, Set[str]] = {}
+        self.failed: Dict[str, str] = {}
+        self.pending_bytes: int = 0
+        self.staging_bytes: int = 0
+        self.released_bytes: int = 0
+        # files that were online already, they are released by the next cycle
+        self.online: List[str] = []
+        self.dcacheapy: api_dcache.dcacheapy = dcache if dcache is not None else api_dcache.dcacheapy()
+        self.scheduler: PollScheduler = scheduler if scheduler is not None else PollScheduler()
+        self.max_stage_bytes: int = int(max_stage_gb * 1024 * 1024 * 1024)
+        self.lookahead: int = lookahead
+        self.order: InputOrder = order if order is not None else InputOrder()
+        self.state: Optional[StageState] = state
+        self.budget: Optional[Coordinator] = budget
+        # files that left the staging state during a cycle, their shared budget is released at the end of it
+        self._left: List[str] = []
+
+    @property
+    def remaining(self) -> int:
+        """Number of files that are pending or staging."""
+        return len(self.pending) + len(self.staging)
 
     def add_files(self, jobs: Dict[str, int]) -> None:
         """
         Add files to the staging queue.
 
+        :param jobs: Dictionary mapping file paths to file sizes, files already known are ignored
+        """
+        for pnfs, filesize in self.order.order(jobs).items():
+            if pnfs in self.pending or pnfs in self.staging:
+                continue
+            self.pending[pnfs] = filesize
+            self.pending_bytes += filesize
+
+    def add_online(self, pnfs: Iterable[str]) -> None:
+        """
+        Add files that are online already, they need no staging and are released by the next cycle.
+
+        :param pnfs: File paths
+        """
+        self.online.extend(pnfs)
+
+    def restore(self, request_id: str, jobs: Dict[str, int]) -> None:
+        """
+        Track files that were already requested by a previous run.
+
+        :param request_id: Bulk request the files belong to
         :param jobs: Dictionary mapping file paths to file sizes
         """
-        self.files2stage = jobs
+        if request_id not in self.requests:
+            self.requests[request_id] = set()
+            self.scheduler.add(request_id)
+        for pnfs, filesize in jobs.items():
+            if pnfs in self.staging:
+                continue
+            self.staging[pnfs] = filesize
+            self.staging_bytes += filesize
+            self.requests[request_id].add(pnfs)
 
-    def stage(self, max_stage_gb: int = 200) -> None:
+    def stage(self) -> None:
         """
-        Stage files up to the specified limit.
+        Request a PIN for the pending files that fit in the remaining staging budget.
 
-        :param max_stage_gb: Maximum data to stage in GB
+        Files are taken in queue order. A file that does not fit is skipped in favour of smaller files behind it,
+        until lookahead files have been skipped. A single file larger than the whole budget is only staged when
+        nothing else is staging. Consecutive files of the same group are submitted as one bulk request.
+        With a shared budget the selected files are reserved with the coordinator first, the ones that do not fit
+        stay pending. Files only move to staging once their bulk request was accepted; if a submission fails,
+        its files and the ones of the groups after it stay pending and the error is raised.
         """
-        # TODO: check amount of data already staged
-        data2stage: int = 0
+        if not self.pending:
+            return
+        budget: int = self.max_stage_bytes - self.staging_bytes if self.budget is None else self.budget.available()
         stagenow: List[str] = []
-        for file, filesize in self.files2stage.items():
-            if file not in self.staging:
-                data2stage = data2stage + filesize
-                if data2stage >= max_stage_gb * 1024 * 1024 * 1024:
-                    break
+        skipped: int = 0
+        for file, filesize in self.pending.items():
+            if budget <= 0 or skipped >= self.lookahead:
+                break
+            if filesize <= budget or (not self.staging and not stagenow):
                 stagenow.append(file)
-                self.staging.append(file)
-        if stagenow:
-            self.dcacheapy.stage(stagenow, lifetime=3)
+                budget -= filesize
+            else:
+                skipped += 1
+        if self.budget is not None and stagenow:
+            stagenow = self.budget.reserve({file: self.pending[file] for file in stagenow})
+        groups: List[List[str]] = [list(group) for _, group in itertools.groupby(stagenow, key=self.order.group)]
+        for index, files in enumerate(groups):
+            try:
+                request_id: str = self.dcacheapy.stage(files, lifetime=3)
+            except BaseException:
+                if self.budget is not None:
+                    self.budget.release(itertools.chain.from_iterable(groups[index:]))
+                raise
+            for file in files:
+                filesize = self.pending.pop(file)
+                self.pending_bytes -= filesize
+                self.staging[file] = filesize
+                self.staging_bytes += filesize
+            if request_id in self.requests:
+                # a server that reuses IDs may hand out the ID of a restored request, track both sets of files
+                self.requests[request_id].update(files)
+            else:
+                self.requests[request_id] = set(files)
+                self.scheduler.add(request_id)
+            if self.state is not None:
+                self.state.set_state(files, STAGING, request_id)
 
     def checkstaged(self) -> Tuple[Set[str], int]:
         """
         Check which files have been staged and update internal state.
 
-        :return: Tuple of (released files set, total size released)
+        Only the bulk requests that are due according to the scheduler are polled, not the individual files.
+        Files whose PIN failed are removed from the queue and recorded in self.failed.
+
+        :return: Tuple of (released files set, total size released). The released files include the ones added
+            with add_online, their size is not counted
         """
         self.stage()
         sizereleased: int = 0
-        released: Set[str] = set()
-        for pnfs in self.staging[:]:  # Create a copy to iterate over
-            if "ONLINE" in self.dcacheapy.locality(pnfs):
-                self.staging.remove(pnfs)
-                sizereleased += self.files2stage[pnfs]
-                del self.files2stage[pnfs]
-                released.add(pnfs)
+        released: Set[str] = set(self.online)
+        self.online = []
+        for request_id in self.scheduler.due():
+            files: Set[str] = self.requests[request_id]
+            before: int = len(files)
+            try:
+                status = self.dcacheapy.bulk_request_status(request_id)
+            except FileNotFoundError:
+                # the bulk request was cleared on the server, e.g. when resuming an old run
+                logging.warning(f"bulk request {request_id} not found, staging its files again")
+                self._requeue(request_id)
+                continue
+            done: List[str] = []
+            for pnfs, state in status.targets.items():
+                if pnfs not in files:
+                    continue
+                if state == "COMPLETED":
+                    done.append(pnfs)
+                    sizereleased += self._finish(request_id, pnfs)
+                elif state in ("FAILED", "CANCELLED", "SKIPPED"):
+                    self._fail(request_id, pnfs, status.errors.get(pnfs, state))
+            if status.finished:
+                for pnfs in list(files):
+                    self._fail(request_id, pnfs, "not part of bulk request")
+            if self.state is not None and done:
+                self.state.set_state(done, RELEASED)
+            released.update(done)
+            if files:
+                self.scheduler.reschedule(request_id, progressed=len(files) < before)
+            else:
+                del self.requests[request_id]
+        if self.budget is not None and self._left:
+            self.budget.release(self._left)
+            self._left = []
+        self.released_bytes += sizereleased
         return (released, sizereleased)
 
+    def iter_released(
+        self,
+        feed: Optional[Callable[[], None]] = None,
+        more: Optional[Callable[[], bool]] = None,
+        wake: Optional[Callable[[], bool]] = None,
+    ) -> Iterator[str]:
+        """
+        Stage the files and yield every file as soon as it is online, so processing can start while the rest is
+        still being recalled. Files added with add_online are yielded by the first cycle after they were added.
+        Failed files are not yielded, they end up in self.failed.
 
-# check for srm/gsifip/wevdav
+        Every cycle feeds new files, stages and polls, yields the released files and then sleeps until a bulk
+        request is due or wake returns True.
 
-# solve full path of localfiles
+        :param feed: Function called at the start of every cycle, e.g. to add files from an input queue
+        :param more: Function called at the end of every cycle, after the released files were consumed; it returns
+            True as long as more files may be fed. Without it only the files added so far are staged
+        :param wake: Function that ends the sleep between cycles early when it returns True, e.g. when new input is
+            waiting
+        :return: Iterator over the released file paths, it ends when no more files follow and none are pending or
+            staging
+        """
+        while True:
+            if feed is not None:
+                feed()
+            released, _ = self.checkstaged()
+            yield from released
+            if not self.remaining and (more is None or not more()):
+                return
+            _sleep_until(self.scheduler, wake)
+
+    def _requeue(self, request_id: str) -> None:
+        """
+        Move the files of a bulk request back to the front of the pending queue.
+
+        :param request_id: Bulk request to forget
+        """
+        files: Set[str] = self.requests.pop(request_id)
+        self.scheduler.remove(request_id)
+        for pnfs in files:
+            filesize: int = self.staging.pop(pnfs)
+            self.staging_bytes -= filesize
+            self.pending[pnfs] = filesize
+            self.pending.move_to_end(pnfs, last=False)
+            self.pending_bytes += filesize
+        if self.state is not None:
+            self.state.set_state(files, PENDING)
+        if self.budget is not None:
+            self.budget.release(files)
+
+    def _finish(self, request_id: str, pnfs: str) -> int:
+        """
+        Remove a file that left the staging state.
+
+        :param request_id: Bulk request the file belongs to
+        :param pnfs: File path
+        :return: Size of the file
+        """
+        self.requests[request_id].discard(pnfs)
+        filesize: int = self.staging.pop(pnfs)
+        self.staging_bytes -= filesize
+        if self.budget is not None:
+            self._left.append(pnfs)
+        return filesize
+
+    def _fail(self, request_id: str, pnfs: str, error: str) -> None:
+        """
+        Record a file whose staging failed.
+
+        :param request_id: Bulk request the file belongs to
+        :param pnfs: File path
+        :param error: Reason of the failure
+        """
+        self._finish(request_id, pnfs)
+        self.failed[pnfs] = error
+        if self.state is not None:
+            self.state.set_state([pnfs], FAILED, error=error)
+        logging.warning(f"staging {pnfs} failed: {error}")
+
+
+class ReleaseHandler:
+    """
+    Hands files over to the next step as soon as they are online: their paths are written to stdout and/or they
+    are downloaded by a pool of worker threads, so recall from tape overlaps with transfer and processing.
+
+    At most backlog files per download worker are running or waiting, handing over another one blocks until a
+    download finished, so a staging loop that releases files faster than they are downloaded is held up instead of
+    queueing without bound.
+    """
+
+    def __init__(
+        self,
+        emit: bool = False,
+        download_to: Optional[str] = None,
+        webdav: Optional[WebDav] = None,
+        door: str = "https://webdav.grid.surfsara.nl:2880",
+        workers: int = 4,
+        backlog: int = 2,
+    ) -> None:
+        """
+        Initialize the handler.
+
+        :param emit: Write the path of every released file to stdout
+        :param download_to: Directory to download the released files to, under their pnfs path
+        :param webdav: WebDAV client used for the downloads, a new one is created if not given
+        :param door: WebDAV door the files are downloaded from
+        :param workers: Number of concurrent downloads
+        :param backlog: Number of files per worker that may be running or waiting for a download
+        """
+        self.emit: bool = emit
+        self.download_to: Optional[str] = download_to
+        self.door: str = door.rstrip("/")
+        self.webdav: Optional[WebDav] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.failed: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(workers * backlog)
+        if download_to is not None:
+            self.webdav = webdav if webdav is not None else WebDav(pool_size=workers)
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __call__(self, pnfs: str) -> None:
+        """
+        Hand a released file over.
+
+        :param pnfs: Path of a file that is online
+        """
+        if self.emit:
+            print(pnfs, flush=True)
+        if self.executor is not None:
+            self._slots.acquire()
+            try:
+                self.executor.submit(self._download, pnfs)
+            except BaseException:
+                self._slots.release()
+                raise
+
+    def _download(self, pnfs: str) -> None:
+        """
+        Download a file, errors are reported on stderr and counted in self.failed.
+
+        :param pnfs: File path
+        """
+        assert self.webdav is not None and self.download_to is not None
+        localfile: str = os.path.join(self.download_to, pnfs.lstrip("/"))
+        try:
+            os.makedirs(os.path.dirname(localfile), exist_ok=True)
+            self.webdav.download(self.door + pnfs, localfile)
+        except Exception as exc:
+            print(f"download of {pnfs} failed: {exc}", file=sys.stderr)
+            with self._lock:
+                self.failed += 1
+        finally:
+            self._slots.release()
+
+    def close(self) -> int:
+        """
+        Wait for the downloads that are still running.
+
+        :return: Number of failed downloads
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        return self.failed
 
 
 def main() -> None:
@@ -127,81 +956,429 @@ def main() -> None:
         help="files to stage from tape to disk",
         default=None,
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="number of concurrent metadata requests to dCache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="maximum number of requests per second to the dCache frontend (default: unlimited)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="number of retries of failed idempotent requests, with exponential back-off (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-stage-gb",
+        type=float,
+        default=200,
+        help="maximum amount of data in GB that is being staged at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["tape", "input"],
+        default="tape",
+        help="order of staging: group files by tape hint and directory, or keep the input order "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--listing-threshold",
+        type=int,
+        default=16,
+        help="list directories that hold at least this many of the input files instead of checking them one by "
+        "one, 0 disables listings (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of input files that are checked together and staged together once they are checked "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=10000,
+        help="maximum number of checked files waiting to be staged, reading the input pauses when it is reached "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--path-rules",
+        type=str,
+        default=None,
+        help="TOML file with [[rules]] mapping URL and mount point prefixes to pnfs paths",
+    )
+    parser.add_argument(
+        "--state-file",
+        type=str,
+        default=None,
+        help="SQLite file in which sizes, localities and staging progress are recorded",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume the run recorded in --state-file instead of starting over, files known in the state file "
+        "are not checked again",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print a summary of the requests per method and endpoint at the end",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="file that is updated with request metrics after every staging cycle, in the Prometheus textfile "
+        "format, or as JSON if the name ends with .json",
+    )
+    parser.add_argument(
+        "--emit-released",
+        action="store_true",
+        help="write the pnfs path of every file to stdout as soon as it is online, including the files that were "
+        "online already, so a downstream job can start on them while the rest is staged",
+    )
+    parser.add_argument(
+        "--download-to",
+        type=str,
+        default=None,
+        help="download every file to this directory, under its pnfs path, as soon as it is online",
+    )
+    parser.add_argument(
+        "--door",
+        type=str,
+        default="https://webdav.grid.surfsara.nl:2880",
+        help="WebDAV door used by --download-to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=4,
+        help="number of concurrent downloads of --download-to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--coordinator",
+        type=str,
+        default=None,
+        help="SQLite file on a file system shared by several workers, e.g. on NFS. The input files are queued in it "
+        "in chunks of --batch-size files, and every worker checks and stages the chunks it leases, within one "
+        "global staging budget of --max-stage-gb set by the worker that creates the file",
+    )
+    parser.add_argument(
+        "--worker-id",
+        type=str,
+        default=None,
+        help="name of this worker in the --coordinator file (default: hostname and process ID)",
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=900,
+        help="time after which the chunks of a worker that stopped renewing them are taken over by other workers "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--submit-only",
+        action="store_true",
+        help="only queue the input files in the --coordinator file, without staging them",
+    )
 
     args: argparse.Namespace = parser.parse_args()
 
+    if args.coordinator and args.state_file:
+        parser.error("--coordinator and --state-file can not be combined")
+    if args.submit_only and not args.coordinator:
+        parser.error("--submit-only requires --coordinator")
     if sys.stdin.isatty():
-        rawfiles: List[str] = args.to_stage_raw
+        # workers of a coordinator may only process the files queued by others
+        if not args.to_stage_raw and not args.coordinator:
+            exit("no input files")
+        rawfiles: Iterable[str] = args.to_stage_raw
     else:
-        rawfiles = [line.strip() for line in sys.stdin.readlines()]
+        rawfiles = sys.stdin
 
-    if len(rawfiles) == 0:
-        exit("no input files")
+    if args.resume and not args.state_file:
+        parser.error("--resume requires --state-file")
+    state: Optional[StageState] = StageState(args.state_file, resume=args.resume) if args.state_file else None
+    known: Dict[str, FileRecord] = state.load() if state is not None else {}
 
-    cleanpnfs: List[str] = [get_pnfs(rfile) for rfile in rawfiles]
-    # check filesize and staged
-    allsizes: Dict[str, int] = {}
+    metrics: Optional[Metrics] = Metrics() if args.stats or args.metrics_file else None
+    # the lookups and downloads run in their own threads, one more connection serves the bulk requests and polls of
+    # the main thread, which would otherwise wait for a free one or open a connection that is not kept
+    session = transport.make_session(
+        os.environ["X509_USER_PROXY"],
+        pool_size=args.concurrency + (args.download_workers if args.download_to else 0) + 1,
+        retries=args.retries,
+        rate_limit=args.rate_limit,
+        hooks=[metrics] if metrics is not None else None,
+    )
+    dcache: api_dcache.dcacheapy = api_dcache.dcacheapy(session=session)
+    normaliser: PathNormaliser = load_normaliser(args.path_rules)
+    rejected: List[str] = []
+    releasehandler: ReleaseHandler = ReleaseHandler(
+        args.emit_released, args.download_to, WebDav(session=session), args.door, args.download_workers
+    )
+    if args.coordinator:
+        coordinator: Coordinator = Coordinator(
+            args.coordinator, int(args.max_stage_gb * 1024**3), args.worker_id, args.lease_seconds
+        )
+        chunks: int = coordinator.submit(dedupe(normalise(read_lines(rawfiles), normaliser, rejected)), args.batch_size)
+        if rejected:
+            print(f"{len(rejected)} invalid paths were skipped", file=sys.stderr)
+        if chunks:
+            print(f"{chunks} chunks queued", file=sys.stderr)
+        if not args.submit_only:
+            run_worker(coordinator, dcache, args, metrics, releasehandler)
+        coordinator.close()
+        _close_handler(releasehandler)
+        if metrics is not None and args.stats:
+            print(metrics.summary(), file=sys.stderr)
+        return
+    # normalise, dedupe and check filesize and staged in the background, for the files that are not known from a
+    # previous run
+    pipeline: InputPipeline[Tuple[FileRecord, bool]] = InputPipeline(
+        lookup_records(
+            dcache,
+            dedupe(normalise(read_lines(rawfiles), normaliser, rejected)),
+            known,
+            args.concurrency,
+            args.listing_threshold,
+            args.batch_size,
+        ),
+        maxsize=args.window,
+    )
+
+    tapehints: Dict[str, str] = {}
+    order: InputOrder = TapeOrder(tapehints) if args.order == "tape" else InputOrder()
+    stagemanager: StageManager = StageManager(dcache, max_stage_gb=args.max_stage_gb, order=order, state=state)
+    ninput: int = 0
     totalsize: int = 0
-    cleanpnfs_offline: List[str] = []
-    files2pin: List[str] = []
-    dcache: api_dcache.dcacheapy = api_dcache.dcacheapy()
 
-    for pnfs in tqdm.tqdm(cleanpnfs, ascii=True, desc="checking staged"):
-        try:
-            if "ONLINE" not in dcache.locality(pnfs):
-                cleanpnfs_offline.append(pnfs)
-            else:
-                files2pin.append(pnfs)
-        except FileNotFoundError:
-            print(f"could not find {pnfs}. skip staging this file", file=sys.stderr)
+    with tqdm.tqdm(total=0, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+
+        def feed() -> None:
+            nonlocal ninput, totalsize
+            # only take input while the pending queue is below the window, the pipeline blocks when its queue is full
+            records: List[Tuple[FileRecord, bool]] = pipeline.take(args.window - len(stagemanager.pending))
+            ninput += len(records)
+            stagemanager.add_online(record.pnfs for record, _ in records if record.state in (ONLINE, RELEASED))
+            totalsize += _feed(stagemanager, records, tapehints, state)
+
+        def more() -> bool:
+            _progress(pbar, totalsize, stagemanager, metrics, args.metrics_file)
+            return not pipeline.finished
+
+        for pnfs in stagemanager.iter_released(
+            feed, more, lambda: _input_ready(pipeline, stagemanager, args.batch_size, args.window)
+        ):
+            releasehandler(pnfs)
+        _progress(pbar, totalsize, stagemanager, metrics, args.metrics_file)
 
-    # TODO: pin files that are already staged
-    if not cleanpnfs_offline:
+    logging.info("No staging requests left.")
+    if rejected:
+        print(f"{len(rejected)} invalid paths were skipped", file=sys.stderr)
+    if ninput == 0:
+        print("no input files", file=sys.stderr)
+    elif totalsize == 0:
         print("all already staged", file=sys.stderr)
-        exit()
-    totalsize = 0
+    else:
+        print("staging done", file=sys.stderr)
+    if stagemanager.failed:
+        print(f"{len(stagemanager.failed)} files failed to stage", file=sys.stderr)
+    if state is not None:
+        state.close()
+    _close_handler(releasehandler)
+    if metrics is not None and args.stats:
+        print(metrics.summary(), file=sys.stderr)
 
-    for pnfs in tqdm.tqdm(cleanpnfs_offline, ascii=True, desc="getting file size"):
-        dc_size: int = dcache.size(pnfs)
-        allsizes[pnfs] = dc_size
-        totalsize += dc_size
 
-    stagemanager: StageManager = StageManager()
-    stagemanager.add_files(allsizes)
+def run_worker(
+    coordinator: Coordinator,
+    dcache: api_dcache.dcacheapy,
+    args: argparse.Namespace,
+    metrics: Optional[Metrics],
+    handler: Optional[ReleaseHandler] = None,
+) -> None:
+    """
+    Stage the files queued in a coordinator together with the other workers, until every chunk is done.
 
-    retryinterval: int = 60
-    with tqdm.tqdm(total=totalsize, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
-        while True:
-            starttime: int = int(time.time())
-            _, releasedbytes = stagemanager.checkstaged()
-            # TODO: create option to print released files to stdout
-            pbar.update(releasedbytes)
-            # stop staging if no files are left to be staged
-            if len(stagemanager.files2stage) == 0:
-                logging.info("No staging requests left.")
-                print("staging done", file=sys.stderr)
+    Chunks are leased while fewer than a batch of files are pending, their files are checked and the ones that are
+    not online yet are staged within the shared budget. A chunk is completed once all of its files are online or
+    failed, and the leases are renewed every cycle, at least three times per lease period.
+
+    :param coordinator: Coordinator holding the work queue and the staging budget
+    :param dcache: dCache API client
+    :param args: Command line arguments of pm_stage_files
+    :param metrics: Request metrics written to args.metrics_file after every cycle
+    :param handler: Handler of the files of this worker that are online
+    """
+    tapehints: Dict[str, str] = {}
+    order: InputOrder = TapeOrder(tapehints) if args.order == "tape" else InputOrder()
+    stagemanager: StageManager = StageManager(
+        dcache, max_stage_gb=coordinator.max_stage_bytes / 1024**3, order=order, budget=coordinator
+    )
+    tracker: ChunkTracker = ChunkTracker()
+    listings: DirectoryListings = DirectoryListings(dcache)
+    totalsize: int = 0
+    renew_at: float = 0
+    nfailed: int = 0
+
+    def settle() -> None:
+        # failed files are not released, their chunks are completed here
+        nonlocal nfailed
+        failed: List[str] = list(itertools.islice(stagemanager.failed, nfailed, None))
+        nfailed = len(stagemanager.failed)
+        for chunk in tracker.finish(failed):
+            coordinator.complete(chunk)
+
+    def feed() -> None:
+        nonlocal totalsize, renew_at
+        settle()
+        coordinator.renew()
+        renew_at = time.monotonic() + coordinator.lease_seconds / 3
+        while len(stagemanager.pending) < args.batch_size:
+            lease: Optional[Tuple[int, List[str]]] = coordinator.lease()
+            if lease is None:
                 break
+            chunk, files = lease
+            records: List[Tuple[FileRecord, bool]] = list(
+                lookup_records(dcache, files, {}, args.concurrency, args.listing_threshold, len(files), listings)
+            )
+            tracker.add(chunk, (record.pnfs for record, _ in records if record.state == PENDING))
+            if chunk not in tracker.chunks:
+                coordinator.complete(chunk)
+            stagemanager.add_online(record.pnfs for record, _ in records if record.state == ONLINE)
+            totalsize += _feed(stagemanager, records, tapehints, None)
+
+    def more() -> bool:
+        settle()
+        _progress(pbar, totalsize, stagemanager, metrics, args.metrics_file)
+        # wait for the chunks of the other workers, to take them over if a worker stops
+        return coordinator.remaining() > len(tracker.chunks)
+
+    with tqdm.tqdm(total=0, unit="B", unit_scale=True, unit_divisor=1024) as pbar:
+        for pnfs in stagemanager.iter_released(feed, more, lambda: time.monotonic() >= renew_at):
+            for chunk in tracker.finish([pnfs]):
+                coordinator.complete(chunk)
+            if handler is not None:
+                handler(pnfs)
+        _progress(pbar, totalsize, stagemanager, metrics, args.metrics_file)
+    print("staging done", file=sys.stderr)
+    if stagemanager.failed:
+        print(f"{len(stagemanager.failed)} files failed to stage", file=sys.stderr)
+
+
+def _progress(
+    pbar: tqdm.tqdm, totalsize: int, stagemanager: StageManager, metrics: Optional[Metrics], metrics_file: Optional[str]
+) -> None:
+    """
+    Show the staging progress and write the request metrics after a cycle.
+
+    :param pbar: Progress bar in bytes
+    :param totalsize: Number of bytes to stage
+    :param stagemanager: StageManager doing the staging
+    :param metrics: Request metrics
+    :param metrics_file: File the metrics are written to, not written if None
+    """
+    if pbar.total != totalsize:
+        pbar.total = totalsize
+        pbar.refresh()
+    pbar.update(stagemanager.released_bytes - pbar.n)
+    if metrics is not None and metrics_file:
+        metrics.write(metrics_file)
+
+
+def _close_handler(handler: ReleaseHandler) -> None:
+    """
+    Wait for the downloads of a ReleaseHandler and report the failed ones.
 
-            _sleep_with_interrupt(retryinterval, starttime)
+    :param handler: Handler to close
+    """
+    faileddownloads: int = handler.close()
+    if faileddownloads:
+        print(f"{faileddownloads} files failed to download", file=sys.stderr)
 
 
-def _sleep_with_interrupt(retryinterval: int, starttime: int) -> None:
+def _feed(
+    stagemanager: StageManager,
+    records: List[Tuple[FileRecord, bool]],
+    tapehints: Dict[str, str],
+    state: Optional[StageState],
+) -> int:
     """
-    Sleep with interrupt capability.
+    Hand records coming out of the input pipeline over to the StageManager.
 
-    :param retryinterval: Retry interval in seconds
-    :param starttime: Start time timestamp
+    :param stagemanager: StageManager to feed
+    :param records: Tuples of (record, whether it is new) from lookup_records
+    :param tapehints: Tape hints of the TapeOrder, updated with the hints of the records
+    :param state: Store in which the new records are saved
+    :return: Number of bytes added to the StageManager
     """
-    sleeptime: int = retryinterval - (int(time.time()) - starttime)
-    # increase retry interval if sleeptime is too small, so progress bar is shown
-    if sleeptime < 20:
-        retryinterval *= 2
-        sleeptime = 60
-    logging.debug(f"sleep until next online check {max(0, sleeptime)} seconds")
+    jobs: Dict[str, int] = {}
+    restored: Dict[str, Dict[str, int]] = defaultdict(dict)
+    new: List[FileRecord] = []
+    for record, isnew in records:
+        if isnew:
+            new.append(record)
+        if record.state in (ONLINE, RELEASED):
+            continue
+        if record.state == STAGING and record.request_id is not None:
+            restored[record.request_id][record.pnfs] = record.size
+        else:
+            jobs[record.pnfs] = record.size
+        if record.hint:
+            tapehints[record.pnfs] = record.hint
+    if state is not None:
+        state.save(new)
+        state.set_state(jobs, PENDING)
+    for request_id, restorejobs in restored.items():
+        stagemanager.restore(request_id, restorejobs)
+    stagemanager.add_files(jobs)
+    return sum(jobs.values()) + sum(sum(restorejobs.values()) for restorejobs in restored.values())
+
+
+def _input_ready(pipeline: InputPipeline, stagemanager: StageManager, batch: int, window: int) -> bool:
+    """
+    Check if it is worth waking up for new input: the staging budget is not used up, the pending queue has room
+    and a full batch of input, or the last of it, is waiting.
+
+    :param pipeline: Input pipeline
+    :param stagemanager: StageManager fed by the pipeline
+    :param batch: Number of waiting files that is worth a bulk request
+    :param window: Maximum number of pending files, no input is taken while it is reached
+    :return: True if the waiting input should be staged now
+    """
+    if pipeline.finished or stagemanager.staging_bytes >= stagemanager.max_stage_bytes:
+        return False
+    # a full pending queue takes no input, waking up would only repeat the same cycle
+    if len(stagemanager.pending) >= window:
+        return False
+    waiting: int = pipeline.available()
+    return waiting >= batch or (waiting > 0 and not pipeline.running)
+
+
+def _sleep_until(scheduler: PollScheduler, wake: Optional[Callable[[], bool]] = None) -> None:
+    """
+    Sleep until the scheduler has a check due.
+
+    :param scheduler: Scheduler of the status checks
+    :param wake: Function that ends the sleep early when it returns True
+    """
+    wakeup: Optional[float] = scheduler.next_due()
+    if wakeup is None:
+        wakeup = scheduler.clock() + scheduler.min_interval
+    logging.debug(f"sleep until next online check {max(0.0, wakeup - scheduler.clock()):.0f} seconds")
     # sleep interval of 0.1 sec makes it able to exit the script with control+c
     # after a short time instead of waiting for the full interval
-
-    for _ in range(max(0, sleeptime * 10)):
+    while scheduler.clock() < wakeup:
+        if wake is not None and wake():
+            return
         time.sleep(0.1)
 
 
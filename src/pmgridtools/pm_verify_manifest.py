@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional, Set, TextIO
+
+import requests
+import tqdm
+
+import pmgridtools.transfer as transfer
+import pmgridtools.transport as transport
+from pmgridtools.concurrency import ordered_map
+from pmgridtools.pnfs_paths import PathNormaliser, load_normaliser
+
+OK = "ok"
+MISSING = "missing"
+SIZE_MISMATCH = "size-mismatch"
+CHECKSUM_MISMATCH = "checksum-mismatch"
+ERROR = "error"
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """Expected properties of a file, size and checksum are optional. Malformed lines carry an error instead."""
+
+    path: str
+    size: Optional[int] = None
+    adler32: Optional[str] = None
+    error: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class VerifyResult:
+    """Outcome of checking a single manifest entry."""
+
+    path: str
+    status: str
+    detail: str = ""
+
+    def __str__(self) -> str:
+        """Report line of the result."""
+        return f"{self.status}\t{self.path}\t{self.detail}"
+
+
+def read_manifest(lines: Iterable[str]) -> Iterator[ManifestEntry]:
+    """
+    Parse manifest lines of the form "path [size [adler32]]", "-" skips a field.
+
+    :param lines: Manifest lines, empty lines and lines starting with # are ignored
+    :return: Iterator over the manifest entries, a malformed line gives an entry with an error, so it is reported
+        without stopping the run
+    """
+    for line in lines:
+        fields: List[str] = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        try:
+            size: Optional[int] = int(fields[1]) if len(fields) > 1 and fields[1] != "-" else None
+            adler32: Optional[str] = fields[2] if len(fields) > 2 and fields[2] != "-" else None
+            if adler32 is not None:
+                int(adler32, 16)
+        except ValueError:
+            yield ManifestEntry(fields[0], error=f"malformed manifest line: {line.strip()}")
+            continue
+        yield ManifestEntry(fields[0], size, adler32)
+
+
+def read_report(lines: Iterable[str]) -> Set[str]:
+    """
+    Collect the paths with a final result from a previous (partial) report, entries with an error are not final.
+
+    :param lines: Report lines
+    :return: Set of paths that do not have to be checked again
+    """
+    done: Set[str] = set()
+    for line in lines:
+        fields: List[str] = line.rstrip("\n").split("\t")
+        if len(fields) >= 2 and fields[0] != ERROR:
+            done.add(fields[1])
+    return done
+
+
+def check_entry(session: requests.Session, url: str, entry: ManifestEntry, timeout: int = 20) -> VerifyResult:
+    """
+    Check a single file with one HEAD request asking for its Adler-32 digest.
+
+    :param session: Session to use
+    :param url: URL of the file
+    :param entry: Expected properties
+    :param timeout: Timeout in seconds
+    :return: Result of the check
+    """
+    try:
+        size, adler32 = transfer.remote_head(session, url, timeout)
+    except FileNotFoundError:
+        return VerifyResult(entry.path, MISSING)
+    except (requests.RequestException, KeyError, ValueError) as e:
+        return VerifyResult(entry.path, ERROR, str(e))
+    if entry.size is not None and size != entry.size:
+        return VerifyResult(entry.path, SIZE_MISMATCH, f"expected {entry.size}, found {size}")
+    if entry.adler32 is not None:
+        if adler32 is None:
+            return VerifyResult(entry.path, ERROR, "no ADLER32 digest reported")
+        if int(adler32, 16) != int(entry.adler32, 16):
+            return VerifyResult(entry.path, CHECKSUM_MISMATCH, f"expected {entry.adler32}, found {adler32}")
+    return VerifyResult(entry.path, OK)
+
+
+def url_for(path: str, door: str, normaliser: PathNormaliser) -> Optional[str]:
+    """
+    Translate a manifest path to a URL.
+
+    :param path: URL, local path or gsiftp/srm URL
+    :param door: WebDAV door prefix for paths that are not http(s) URLs
+    :param normaliser: Path normaliser for paths that are not http(s) URLs
+    :return: URL of the file, or None if the path is not in dCache
+    """
+    if path.startswith("https://") or path.startswith("http://"):
+        return path
+    pnfs: Optional[str] = normaliser.normalise(path)
+    return door.rstrip("/") + pnfs if pnfs is not None else None
+
+
+def verify_manifest(
+    session: requests.Session,
+    entries: Iterable[ManifestEntry],
+    door: str = "https://webdav.grid.surfsara.nl:2880",
+    concurrency: int = 32,
+    timeout: int = 20,
+    normaliser: Optional[PathNormaliser] = None,
+) -> Iterator[VerifyResult]:
+    """
+    Check manifest entries with concurrent HEAD requests over one connection pool.
+
+    :param session: Session to use, its pool should hold at least concurrency connections
+    :param entries: Manifest entries
+    :param door: WebDAV door prefix for paths that are not http(s) URLs
+    :param concurrency: Number of requests in flight
+    :param timeout: Timeout in seconds
+    :param normaliser: Path normaliser for paths that are not http(s) URLs, default rules if not given
+    :return: Iterator over the results, in manifest order, as soon as they are available
+    """
+    pathnormaliser: PathNormaliser = normaliser if normaliser is not None else PathNormaliser()
+
+    def check(entry: ManifestEntry) -> VerifyResult:
+        if entry.error is not None:
+            return VerifyResult(entry.path, ERROR, entry.error)
+        url: Optional[str] = url_for(entry.path, door, pathnormaliser)
+        if url is None:
+            return VerifyResult(entry.path, ERROR, "not a dCache path")
+        return check_entry(session, url, entry, timeout)
+
+    return ordered_map(check, entries, concurrency)
+
+
+def main() -> None:
+    """Main entry point for the pm_verify_manifest script."""
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        description="verify existence, size and adler32 of files listed in a manifest "
+        "with lines 'path [size [adler32]]'"
+    )
+    parser.add_argument("manifest", nargs="?", default="-", help="manifest file, - for stdin (default: %(default)s)")
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="file the results are appended to, entries already in it are skipped (default: stdout)",
+    )
+    parser.add_argument(
+        "--door",
+        type=str,
+        default="https://webdav.grid.surfsara.nl:2880",
+        help="WebDAV door for paths that are not URLs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--path-rules",
+        type=str,
+        default=None,
+        help="TOML file with [[rules]] mapping URL and mount point prefixes to pnfs paths",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="number of concurrent requests (default: %(default)s)",
+    )
+    args: argparse.Namespace = parser.parse_args()
+
+    done: Set[str] = set()
+    if args.report is not None and os.path.exists(args.report):
+        with open(args.report) as f:
+            done = read_report(f)
+
+    session: requests.Session = transport.make_session(os.environ["X509_USER_PROXY"], pool_size=args.concurrency)
+    manifest: TextIO = sys.stdin if args.manifest == "-" else open(args.manifest)
+    report: TextIO = sys.stdout if args.report is None else open(args.report, "a")
+    failures: int = 0
+    try:
+        entries = (entry for entry in read_manifest(manifest) if entry.path not in done)
+        for result in tqdm.tqdm(
+            verify_manifest(session, entries, args.door, args.concurrency, normaliser=load_normaliser(args.path_rules)),
+            ascii=True,
+            desc="verifying",
+        ):
+            print(result, file=report, flush=True)
+            if result.status != OK:
+                failures += 1
+    finally:
+        if manifest is not sys.stdin:
+            manifest.close()
+        if report is not sys.stdout:
+            report.close()
+
+    if failures:
+        print(f"{failures} files failed verification", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
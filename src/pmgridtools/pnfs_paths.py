@@ -0,0 +1,133 @@
+import os
+import posixpath
+import re
+import tomllib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+@dataclass(frozen=True)
+class PrefixRule:
+    """Maps input paths starting with a pattern to a PNFS path, by replacing the matched prefix."""
+
+    pattern: str
+    replacement: str
+
+    @classmethod
+    def literal(cls, prefix: str, replacement: str) -> "PrefixRule":
+        """
+        Rule for a fixed prefix, e.g. a mount point.
+
+        :param prefix: Path prefix
+        :param replacement: PNFS path the prefix stands for
+        :return: Prefix rule
+        """
+        return cls(re.escape(prefix), replacement)
+
+    @classmethod
+    def from_dict(cls, rule: Dict[str, Any]) -> "PrefixRule":
+        """
+        Rule from a config table with either a literal prefix or a regular expression pattern.
+
+        :param rule: Dictionary with the keys prefix or pattern, and replacement
+        :return: Prefix rule
+        """
+        if "replacement" not in rule or ("prefix" in rule) == ("pattern" in rule):
+            raise ValueError(f"a path rule needs a replacement and either a prefix or a pattern: {rule}")
+        if "prefix" in rule:
+            return cls.literal(rule["prefix"], rule["replacement"])
+        return cls(rule["pattern"], rule["replacement"])
+
+
+DEFAULT_RULES: Tuple[PrefixRule, ...] = (
+    # gsiftp://, srm://, https:// and davs:// URLs of the SURF dCache, including srm URLs with ?SFN=
+    PrefixRule(r"(?:gsiftp|srm|https?|davs?)://.*/pnfs/grid\.sara\.nl/", "/pnfs/grid.sara.nl/"),
+    PrefixRule.literal("/pnfs/grid.sara.nl/", "/pnfs/grid.sara.nl/"),
+    # Project MinE mount points
+    PrefixRule.literal("/project/projectmine/Data/GridStorage/", "/pnfs/grid.sara.nl/data/lsgrid/Project_MinE/"),
+    PrefixRule.literal("/projectmine-nfs/", "/pnfs/grid.sara.nl/data/lsgrid/Project_MinE/"),
+)
+
+
+class PathNormaliser:
+    """
+    Converts URLs and local paths to PNFS paths with prefix rules.
+
+    All rules are compiled into one regular expression, the first matching rule wins. Local paths are made absolute
+    against the working directory before matching, URLs are matched as they are.
+    """
+
+    def __init__(self, rules: Sequence[PrefixRule] = DEFAULT_RULES, cwd: Optional[str] = None) -> None:
+        """
+        Initialize the normaliser.
+
+        :param rules: Prefix rules in order of precedence
+        :param cwd: Directory relative paths are resolved against, the current working directory if not given
+        """
+        if not rules:
+            raise ValueError("at least one path rule is required")
+        self.rules: Tuple[PrefixRule, ...] = tuple(rules)
+        self.cwd: str = cwd if cwd is not None else os.getcwd()
+        self._regex: re.Pattern = re.compile("|".join(f"(?P<r{i}>{rule.pattern})" for i, rule in enumerate(self.rules)))
+
+    @classmethod
+    def from_config(cls, path: str) -> "PathNormaliser":
+        """
+        Load the rules from a TOML file with [[rules]] tables. The default rules are tried after the configured
+        ones, unless the file sets defaults = false.
+
+        :param path: TOML file
+        :return: Path normaliser
+        """
+        with open(path, "rb") as f:
+            config: Dict[str, Any] = tomllib.load(f)
+        rules: List[PrefixRule] = [PrefixRule.from_dict(rule) for rule in config.get("rules", [])]
+        if config.get("defaults", True):
+            rules.extend(DEFAULT_RULES)
+        return cls(rules)
+
+    def normalise(self, url: str) -> Optional[str]:
+        """
+        Convert a URL or local path to a PNFS path.
+
+        :param url: Input URL or local path
+        :return: PNFS path, or None if no rule matches
+        """
+        url = url.strip()
+        if "://" not in url:
+            url = posixpath.normpath(url if url.startswith("/") else posixpath.join(self.cwd, url))
+        match: Optional[re.Match] = self._regex.match(url)
+        if match is None:
+            return None
+        assert match.lastgroup is not None
+        prefixlen: int = match.end()
+        return self.rules[int(match.lastgroup[1:])].replacement + url[prefixlen:]
+
+    def normalise_many(self, urls: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Convert URLs and local paths to unique PNFS paths.
+
+        :param urls: Input URLs or local paths, empty lines are skipped
+        :return: Tuple of (PNFS paths in input order without duplicates, inputs no rule matched)
+        """
+        valid: Dict[str, None] = {}
+        rejected: List[str] = []
+        for url in urls:
+            if not url.strip():
+                continue
+            pnfs: Optional[str] = self.normalise(url)
+            if pnfs is None:
+                rejected.append(url.strip())
+            else:
+                valid[pnfs] = None
+        return (list(valid), rejected)
+
+
+def load_normaliser(path: Optional[str] = None) -> PathNormaliser:
+    """
+    Get a path normaliser, with the rules of a config file if given.
+
+    :param path: TOML file with path rules, the default rules are used if None
+    :return: Path normaliser
+    """
+    return PathNormaliser.from_config(path) if path is not None else PathNormaliser()
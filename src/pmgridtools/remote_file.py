@@ -0,0 +1,213 @@
+import io
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+import requests
+
+import pmgridtools.transfer as transfer
+
+if TYPE_CHECKING:
+    from _typeshed import WriteableBuffer
+
+BLOCK_SIZE: int = 1024 * 1024
+
+
+def check_response(url: str, response: requests.Response) -> None:
+    """
+    Raise an exception for a response with an error status.
+
+    :param url: Requested URL, used in messages
+    :param response: Response to check
+    """
+    if response.status_code == 404:
+        raise FileNotFoundError(f"Could not found {url}")
+    elif response.status_code == 403:
+        raise PermissionError(f"response code {response.status_code} : {url}")
+    response.raise_for_status()
+
+
+def cat(session: requests.Session, url: str, timeout: int = 20) -> bytes:
+    """
+    Get file content, raising an exception instead of returning the body of an error response.
+
+    :param session: Session to use
+    :param url: File URL
+    :param timeout: Timeout in seconds
+    :return: File content as bytes
+    """
+    with session.get(url, stream=True, timeout=timeout) as response:
+        check_response(url, response)
+        return response.content
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable file object reading a remote file with HTTP range requests.
+
+    Small reads are served from an LRU cache of blocks. A read that misses the cache fetches the whole block it
+    falls in with one range request, so the next small reads in that block need no request; blocks beyond the one
+    being read are not fetched in advance. Reads of at least a block bypass the cache and are written straight
+    into the caller's buffer. Wrap the object in io.BufferedReader or io.TextIOWrapper where a buffered or text
+    file is needed.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        size: Optional[int] = None,
+        block_size: int = BLOCK_SIZE,
+        cache_blocks: int = 8,
+        timeout: int = 20,
+    ) -> None:
+        """
+        Open a remote file, its size is requested with a HEAD request when not given.
+
+        :param session: Session to use
+        :param url: File URL
+        :param size: File size in bytes, if already known
+        :param block_size: Size in bytes of the range requests of small reads
+        :param cache_blocks: Number of blocks kept in the cache
+        :param timeout: Timeout in seconds
+        """
+        super().__init__()
+        self.session: requests.Session = session
+        self.url: str = url
+        self.name: str = url
+        self.timeout: int = timeout
+        self.size: int = size if size is not None else transfer.remote_head(session, url, timeout)[0]
+        self.block_size: int = block_size
+        self.cache_blocks: int = cache_blocks
+        self._blocks: OrderedDict[int, bytearray] = OrderedDict()
+        self._pos: int = 0
+
+    def readable(self) -> bool:
+        """The file can be read."""
+        return True
+
+    def seekable(self) -> bool:
+        """The file supports random access."""
+        return True
+
+    def tell(self) -> int:
+        """
+        Current position.
+
+        :return: Position in bytes from the start of the file
+        """
+        self._checkClosed()  # type: ignore[attr-defined]
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """
+        Change the position, no request is sent until the next read.
+
+        :param offset: Offset in bytes relative to whence
+        :param whence: io.SEEK_SET, io.SEEK_CUR or io.SEEK_END
+        :return: New position
+        """
+        self._checkClosed()  # type: ignore[attr-defined]
+        if whence == io.SEEK_SET:
+            pos: int = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer: "WriteableBuffer") -> int:
+        """
+        Read bytes into a pre-allocated buffer.
+
+        :param buffer: Writable buffer, e.g. a bytearray or memoryview
+        :return: Number of bytes read, 0 at the end of the file
+        """
+        self._checkClosed()  # type: ignore[attr-defined]
+        view: memoryview = memoryview(buffer).cast("B")
+        n: int = min(len(view), self.size - self._pos)
+        if n <= 0:
+            return 0
+        if n >= self.block_size:
+            self._fetch_into(self._pos, view[:n])
+        else:
+            copied: int = 0
+            while copied < n:
+                index, offset = divmod(self._pos + copied, self.block_size)
+                block: bytearray = self._block(index)
+                length: int = min(n - copied, len(block) - offset)
+                stop: int = copied + length
+                end: int = offset + length
+                view[copied:stop] = block[offset:end]
+                copied = stop
+        self._pos += n
+        return n
+
+    def close(self) -> None:
+        """Close the file and drop the cache, the session stays open."""
+        self._blocks.clear()
+        super().close()
+
+    def _block(self, index: int) -> bytearray:
+        """
+        Get a block from the cache, fetching it on a miss.
+
+        :param index: Block number
+        :return: Block content, the last block of the file may be shorter than block_size
+        """
+        block: Optional[bytearray] = self._blocks.get(index)
+        if block is not None:
+            self._blocks.move_to_end(index)
+            return block
+        start: int = index * self.block_size
+        block = bytearray(min(self.block_size, self.size - start))
+        self._fetch_into(start, memoryview(block))
+        self._blocks[index] = block
+        if len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def _fetch_into(self, start: int, view: memoryview) -> None:
+        """
+        Fetch a byte range with one request, reading the body straight into a buffer.
+
+        :param start: First byte of the range
+        :param view: Buffer to fill, its length is the length of the range
+        """
+        headers = {"Range": f"bytes={start}-{start + len(view) - 1}", "Accept-Encoding": "identity"}
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            check_response(self.url, response)
+            if response.status_code != 206:
+                raise ValueError(f"server ignored range request for {self.url}: {response.status_code}")
+            received: int = 0
+            while received < len(view):
+                count: int = response.raw.readinto(view[received:])
+                if not count:
+                    raise IOError(f"short read of {self.url} at byte {start + received}, expected {start + len(view)}")
+                received += count
+
+
+def open_remote(
+    session: requests.Session,
+    url: str,
+    size: Optional[int] = None,
+    block_size: int = BLOCK_SIZE,
+    cache_blocks: int = 8,
+    timeout: int = 20,
+) -> RemoteFile:
+    """
+    Open a remote file for random access reads.
+
+    :param session: Session to use
+    :param url: File URL
+    :param size: File size in bytes, if already known
+    :param block_size: Size in bytes of the range requests of small reads
+    :param cache_blocks: Number of blocks kept in the cache
+    :param timeout: Timeout in seconds
+    :return: Seekable raw file object
+    """
+    return RemoteFile(session, url, size, block_size, cache_blocks, timeout)
@@ -0,0 +1,258 @@
+import contextlib
+import fcntl
+import itertools
+import os
+import socket
+import sqlite3
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+class Coordinator:
+    """
+    Work queue and global staging budget shared by several pm_stage_files workers, e.g. on different hosts.
+
+    Everything is kept in one SQLite file that may live on a shared (NFS) file system. Because SQLite's own locking
+    is not reliable on NFS, every transaction holds a POSIX lock on a lock file next to it, and the rollback journal
+    is used instead of WAL, which needs shared memory.
+
+    Input files are queued in chunks. A worker leases a chunk, checks and stages its files and marks it done once
+    every file is online or failed. Leases expire unless they are renewed, so the chunks of a worker that died are
+    taken over by another one. Bytes that are being staged are reserved per file, and the sum of the reservations
+    of all workers is kept below one global budget.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_stage_bytes: Optional[int] = None,
+        worker: Optional[str] = None,
+        lease_seconds: float = 900,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Open or create a coordination file.
+
+        :param path: Path of the SQLite database, on a file system shared by all workers
+        :param max_stage_bytes: Global staging budget, stored when the file is created and ignored afterwards
+        :param worker: Name of this worker, hostname and process ID by default
+        :param lease_seconds: Time after which a chunk that was not renewed can be taken over
+        :param clock: Function returning the current time in seconds, shared by all workers
+        """
+        self.path: str = path
+        self.worker: str = worker if worker is not None else f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds: float = lease_seconds
+        self.clock: Callable[[], float] = clock
+        self._lockfile: int = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o664)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        with self._transaction() as cursor:
+            cursor.execute("PRAGMA journal_mode=DELETE")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "id INTEGER PRIMARY KEY, owner TEXT, lease_until REAL, done INTEGER NOT NULL DEFAULT 0)"
+            )
+            cursor.execute("CREATE TABLE IF NOT EXISTS chunk_files (pnfs TEXT PRIMARY KEY, chunk INTEGER NOT NULL)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS chunk_files_chunk ON chunk_files (chunk)")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS staging (pnfs TEXT PRIMARY KEY, size INTEGER NOT NULL, owner TEXT NOT NULL)"
+            )
+            cursor.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)")
+            if max_stage_bytes is not None:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO settings (key, value) VALUES ('max_stage_bytes', ?)", (max_stage_bytes,)
+                )
+            row = cursor.execute("SELECT value FROM settings WHERE key='max_stage_bytes'").fetchone()
+        if row is None:
+            raise ValueError(f"{path} has no staging budget yet, pass max_stage_bytes")
+        self.max_stage_bytes: int = int(row[0])
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Run statements in one transaction, holding the lock file.
+
+        :return: Cursor to execute the statements with
+        """
+        fcntl.lockf(self._lockfile, fcntl.LOCK_EX)
+        try:
+            cursor: sqlite3.Cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+        finally:
+            fcntl.lockf(self._lockfile, fcntl.LOCK_UN)
+
+    def submit(self, pnfs: Iterable[str], chunk_size: int = 1000) -> int:
+        """
+        Queue files, files that are already queued are skipped.
+
+        :param pnfs: File paths
+        :param chunk_size: Number of files per chunk
+        :return: Number of new chunks
+        """
+        paths: Iterator[str] = iter(pnfs)
+        chunks: int = 0
+        while True:
+            batch: List[str] = list(itertools.islice(paths, chunk_size))
+            if not batch:
+                return chunks
+            with self._transaction() as cursor:
+                cursor.execute("INSERT INTO chunks (owner, lease_until) VALUES (NULL, NULL)")
+                chunk: Optional[int] = cursor.lastrowid
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO chunk_files (pnfs, chunk) VALUES (?, ?)", ((path, chunk) for path in batch)
+                )
+                if cursor.execute("SELECT 1 FROM chunk_files WHERE chunk=? LIMIT 1", (chunk,)).fetchone() is None:
+                    cursor.execute("DELETE FROM chunks WHERE id=?", (chunk,))
+                else:
+                    chunks += 1
+
+    def lease(self) -> Optional[Tuple[int, List[str]]]:
+        """
+        Take the next chunk that is not leased or whose lease expired.
+
+        Reservations left behind by another worker that owned the chunk before are dropped. A worker that takes back
+        its own expired chunk, e.g. after a stall, keeps its reservations: its files may still be staging.
+
+        :return: Tuple of (chunk ID, file paths), None if no chunk is available
+        """
+        now: float = self.clock()
+        with self._transaction() as cursor:
+            row = cursor.execute(
+                "SELECT id FROM chunks WHERE done=0 AND (owner IS NULL OR lease_until < ?) ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            chunk: int = row[0]
+            cursor.execute(
+                "UPDATE chunks SET owner=?, lease_until=? WHERE id=?", (self.worker, now + self.lease_seconds, chunk)
+            )
+            cursor.execute(
+                "DELETE FROM staging WHERE owner<>? AND pnfs IN (SELECT pnfs FROM chunk_files WHERE chunk=?)",
+                (self.worker, chunk),
+            )
+            files: List[str] = [r[0] for r in cursor.execute("SELECT pnfs FROM chunk_files WHERE chunk=?", (chunk,))]
+        return (chunk, files)
+
+    def renew(self) -> None:
+        """Extend the leases of the chunks of this worker."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE chunks SET lease_until=? WHERE owner=? AND done=0",
+                (self.clock() + self.lease_seconds, self.worker),
+            )
+
+    def complete(self, chunk: int) -> None:
+        """
+        Mark a chunk as done, unless another worker took it over in the meantime.
+
+        :param chunk: Chunk ID
+        """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE chunks SET done=1 WHERE id=? AND owner=?", (chunk, self.worker))
+
+    def remaining(self) -> int:
+        """
+        Number of chunks that are not done, including the leased ones.
+
+        :return: Number of chunks
+        """
+        with self._transaction() as cursor:
+            return int(cursor.execute("SELECT COUNT(*) FROM chunks WHERE done=0").fetchone()[0])
+
+    def available(self) -> int:
+        """
+        Bytes left in the global staging budget.
+
+        :return: Number of bytes, may be negative when a single large file exceeds the budget
+        """
+        with self._transaction() as cursor:
+            return self.max_stage_bytes - self._reserved(cursor)
+
+    def reserve(self, jobs: Dict[str, int]) -> List[str]:
+        """
+        Reserve budget for files about to be staged. Files are admitted in order while they fit; a single file
+        larger than the whole budget is admitted when nothing is being staged.
+
+        :param jobs: Dictionary mapping file paths to file sizes
+        :return: Paths of the admitted files
+        """
+        admitted: List[str] = []
+        with self._transaction() as cursor:
+            reserved: int = self._reserved(cursor)
+            for pnfs, size in jobs.items():
+                if reserved + size <= self.max_stage_bytes or reserved == 0:
+                    admitted.append(pnfs)
+                    reserved += size
+            cursor.executemany(
+                "INSERT OR REPLACE INTO staging (pnfs, size, owner) VALUES (?, ?, ?)",
+                ((pnfs, jobs[pnfs], self.worker) for pnfs in admitted),
+            )
+        return admitted
+
+    def release(self, pnfs: Iterable[str]) -> None:
+        """
+        Give the reserved budget of files back.
+
+        :param pnfs: File paths
+        """
+        with self._transaction() as cursor:
+            cursor.executemany("DELETE FROM staging WHERE pnfs=? AND owner=?", ((path, self.worker) for path in pnfs))
+
+    @staticmethod
+    def _reserved(cursor: sqlite3.Cursor) -> int:
+        """
+        Bytes reserved by all workers.
+
+        :param cursor: Cursor of an open transaction
+        :return: Number of bytes
+        """
+        return int(cursor.execute("SELECT COALESCE(SUM(size), 0) FROM staging").fetchone()[0])
+
+    def close(self) -> None:
+        """Close the coordination file."""
+        self.connection.close()
+        os.close(self._lockfile)
+
+
+class ChunkTracker:
+    """Keeps track of the files of the leased chunks that are not finished yet."""
+
+    def __init__(self) -> None:
+        """Initialize an empty tracker."""
+        self.chunks: Dict[int, Set[str]] = {}
+        self.chunk_of: Dict[str, int] = {}
+
+    def add(self, chunk: int, pnfs: Iterable[str]) -> None:
+        """
+        Track the unfinished files of a chunk, a chunk without any is not tracked.
+
+        :param chunk: Chunk ID
+        :param pnfs: File paths
+        """
+        for path in pnfs:
+            self.chunks.setdefault(chunk, set()).add(path)
+            self.chunk_of[path] = chunk
+
+    def finish(self, pnfs: Iterable[str]) -> List[int]:
+        """
+        Mark files as finished.
+
+        :param pnfs: File paths that are online or failed
+        :return: IDs of the chunks that have no unfinished files left
+        """
+        done: List[int] = []
+        for path in pnfs:
+            chunk: Optional[int] = self.chunk_of.pop(path, None)
+            if chunk is None:
+                continue
+            self.chunks[chunk].discard(path)
+            if not self.chunks[chunk]:
+                del self.chunks[chunk]
+                done.append(chunk)
+        return done
@@ -0,0 +1,92 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+PENDING = "pending"
+STAGING = "staging"
+ONLINE = "online"
+RELEASED = "released"
+FAILED = "failed"
+
+
+@dataclass(frozen=True)
+class FileRecord:
+    """Staging state of a single file."""
+
+    pnfs: str
+    size: int
+    state: str
+    hint: Optional[str] = None
+    request_id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class StageState:
+    """SQLite backed store of the staging state of files, so an interrupted staging run can be resumed."""
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        """
+        Open or create a state file.
+
+        :param path: Path of the SQLite database
+        :param resume: Keep the records of a previous run, otherwise the store is emptied
+        """
+        self.path: str = path
+        self.connection: sqlite3.Connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "pnfs TEXT PRIMARY KEY, size INTEGER NOT NULL, state TEXT NOT NULL, hint TEXT, request_id TEXT, "
+            "error TEXT, added REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        if not resume:
+            self.connection.execute("DELETE FROM files")
+        self.connection.commit()
+
+    def load(self) -> Dict[str, FileRecord]:
+        """
+        Read all records.
+
+        :return: Dictionary mapping file paths to their records
+        """
+        cursor = self.connection.execute("SELECT pnfs, size, state, hint, request_id, error FROM files")
+        return {row[0]: FileRecord(*row) for row in cursor}
+
+    def save(self, records: Iterable[FileRecord]) -> None:
+        """
+        Insert or replace records.
+
+        :param records: Records to store
+        """
+        now: float = time.time()
+        self.connection.executemany(
+            "INSERT INTO files (pnfs, size, state, hint, request_id, error, added, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(pnfs) DO UPDATE SET size=excluded.size, "
+            "state=excluded.state, hint=excluded.hint, request_id=excluded.request_id, error=excluded.error, "
+            "updated=excluded.updated",
+            ((r.pnfs, r.size, r.state, r.hint, r.request_id, r.error, now, now) for r in records),
+        )
+        self.connection.commit()
+
+    def set_state(
+        self, pnfs: Iterable[str], state: str, request_id: Optional[str] = None, error: Optional[str] = None
+    ) -> None:
+        """
+        Update the state of files that are already stored.
+
+        :param pnfs: File paths
+        :param state: New state
+        :param request_id: Bulk request the files belong to, the stored one is kept if None
+        :param error: Reason of a failure
+        """
+        now: float = time.time()
+        self.connection.executemany(
+            "UPDATE files SET state=?, request_id=COALESCE(?, request_id), error=?, updated=? WHERE pnfs=?",
+            ((state, request_id, error, now, path) for path in pnfs),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Close the state file."""
+        self.connection.close()
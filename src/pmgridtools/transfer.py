@@ -0,0 +1,463 @@
+import http.client
+import logging
+import mmap
+import os
+import socket
+import ssl
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+SEGMENT_SIZE: int = 64 * 1024 * 1024
+CHUNK_SIZE: int = 4 * 1024 * 1024
+ADLER32_BASE: int = 65521
+
+
+class ChecksumMismatchError(IOError):
+    """Raised when the checksum of transferred data differs from the checksum reported by the server."""
+
+
+def parse_digest(header: str) -> Dict[str, str]:
+    """
+    Parse an RFC 3230 Digest header.
+
+    :param header: Header value, e.g. "adler32=0a1b2c3d,md5=..."
+    :return: Dictionary mapping lower case algorithm names to values
+    """
+    digests: Dict[str, str] = {}
+    for item in header.split(","):
+        algorithm, _, value = item.strip().partition("=")
+        if value:
+            digests[algorithm.lower()] = value
+    return digests
+
+
+def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    """
+    Combine the Adler-32 checksums of two consecutive blocks of data, as zlib's adler32_combine.
+
+    :param adler1: Checksum of the first block
+    :param adler2: Checksum of the second block
+    :param len2: Length of the second block in bytes
+    :return: Checksum of the concatenated blocks
+    """
+    rem: int = len2 % ADLER32_BASE
+    sum1: int = adler1 & 0xFFFF
+    sum2: int = (rem * sum1) % ADLER32_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER32_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + ADLER32_BASE - rem
+    sum1 %= ADLER32_BASE
+    sum2 %= ADLER32_BASE
+    return sum1 | (sum2 << 16)
+
+
+def verify_adler32(url: str, localfile: str, computed: int, expected: Optional[str]) -> None:
+    """
+    Compare a computed Adler-32 checksum with the one reported by the server, removing the local file on mismatch.
+
+    :param url: Source URL, used in messages
+    :param localfile: Local file path
+    :param computed: Checksum of the downloaded data
+    :param expected: Hexadecimal checksum reported by the server, None if the server did not report one
+    """
+    if expected is None:
+        logging.warning(f"no ADLER32 digest received for {url}, checksum not verified")
+        return
+    if int(expected, 16) != computed:
+        os.remove(localfile)
+        raise ChecksumMismatchError(f"ADLER32 mismatch for {url}: expected {expected}, got {computed:08x}")
+
+
+def remote_head(session: requests.Session, url: str, timeout: int = 20) -> Tuple[int, Optional[str]]:
+    """
+    Get the size and Adler-32 checksum of a remote file with a HEAD request.
+
+    :param session: Session to use
+    :param url: File URL
+    :param timeout: Timeout in seconds
+    :return: Tuple of (file size in bytes, hexadecimal ADLER32 checksum or None if not reported)
+    """
+    response: requests.Response = session.head(
+        url, headers={"Want-Digest": "ADLER32"}, allow_redirects=True, timeout=timeout
+    )
+    if response.status_code == 404:
+        raise FileNotFoundError(f"Could not found {url}")
+    response.raise_for_status()
+    return (int(response.headers["Content-Length"]), parse_digest(response.headers.get("Digest", "")).get("adler32"))
+
+
+def stream_download(session: requests.Session, url: str, localfile: str, timeout: int = 20, verify: bool = True) -> str:
+    """
+    Download a file in a single stream, computing its Adler-32 checksum on the fly.
+
+    :param session: Session to use
+    :param url: Source URL
+    :param localfile: Local file path
+    :param timeout: Timeout in seconds
+    :param verify: Compare the checksum with the Digest header of the response
+    :return: Local file path
+    """
+    checksum: int = zlib.adler32(b"")
+    headers: Dict[str, str] = {"Want-Digest": "ADLER32"} if verify else {}
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as d:
+        d.raise_for_status()
+        with open(localfile, "wb") as lf:
+            for chunk in d.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    lf.write(chunk)
+                    checksum = zlib.adler32(chunk, checksum)
+        expected: Optional[str] = parse_digest(d.headers.get("Digest", "")).get("adler32")
+    if verify:
+        verify_adler32(url, localfile, checksum, expected)
+    return localfile
+
+
+def segments(size: int, segment_size: int = SEGMENT_SIZE) -> List[Tuple[int, int]]:
+    """
+    Split a file in byte ranges.
+
+    :param size: File size in bytes
+    :param segment_size: Size of each range, the last one may be smaller
+    :return: List of (start, end) tuples, end is exclusive
+    """
+    return [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+
+
+def download_segment(
+    session: requests.Session,
+    url: str,
+    fd: int,
+    start: int,
+    end: int,
+    timeout: int = 20,
+    retries: int = 3,
+) -> int:
+    """
+    Download a byte range of a remote file straight into an open file at the same offset.
+
+    An interrupted transfer is retried from the last byte that was written.
+
+    :param session: Session to use
+    :param url: File URL
+    :param fd: File descriptor of the local file, opened for writing
+    :param start: First byte of the range
+    :param end: End of the range, exclusive
+    :param timeout: Timeout in seconds
+    :param retries: Number of retries after a failed attempt
+    :return: Adler-32 checksum of the range
+    """
+    offset: int = start
+    checksum: int = zlib.adler32(b"")
+    attempt: int = 0
+    while True:
+        try:
+            headers = {"Range": f"bytes={offset}-{end - 1}"}
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise ValueError(f"server ignored range request for {url}: {response.status_code}")
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                        checksum = zlib.adler32(chunk, checksum)
+            if offset != end:
+                raise IOError(f"short read of {url} at byte {offset}, expected {end}")
+            return checksum
+        except IOError as e:
+            # requests exceptions are IOErrors too, client errors will not go away by retrying
+            client_error: bool = (
+                isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code < 500
+            )
+            if attempt >= retries or client_error:
+                raise
+            attempt += 1
+            logging.warning(f"retrying {url} from byte {offset} after: {e}")
+
+
+def ranged_download(
+    session: requests.Session,
+    url: str,
+    localfile: str,
+    segment_size: int = SEGMENT_SIZE,
+    parallel: int = 4,
+    timeout: int = 20,
+    retries: int = 3,
+    verify: bool = True,
+) -> str:
+    """
+    Download a file with parallel HTTP range requests.
+
+    The local file is preallocated and every segment is written to its own offset, so segments can arrive in any
+    order. The session should have a connection pool of at least parallel connections. The checksums of the
+    segments are combined into the Adler-32 checksum of the whole file.
+
+    :param session: Session to use
+    :param url: Source URL
+    :param localfile: Local file path
+    :param segment_size: Size of each range request in bytes
+    :param parallel: Number of segments downloaded at the same time
+    :param timeout: Timeout in seconds
+    :param retries: Number of retries per segment
+    :param verify: Compare the checksum with the Digest header of a HEAD request
+    :return: Local file path
+    """
+    size, expected = remote_head(session, url, timeout)
+    ranges: List[Tuple[int, int]] = segments(size, segment_size)
+    checksum: int = zlib.adler32(b"")
+    fd: int = os.open(localfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [
+                executor.submit(download_segment, session, url, fd, start, end, timeout, retries)
+                for start, end in ranges
+            ]
+            try:
+                for (start, end), future in zip(ranges, futures):
+                    checksum = adler32_combine(checksum, future.result(), end - start)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+    if verify:
+        verify_adler32(url, localfile, checksum, expected)
+    return localfile
+
+
+class UploadReader:
+    """
+    File-like wrapper that streams a local file in fixed size blocks.
+
+    It reports its length, so requests and http.client send a Content-Length header instead of using chunked
+    encoding, and it never holds more than one block of the file in memory.
+    """
+
+    def __init__(self, fileobj: BinaryIO, size: int, buffer_size: int = CHUNK_SIZE) -> None:
+        """
+        Wrap an open file.
+
+        :param fileobj: File opened in binary mode, positioned at the start
+        :param size: Number of bytes to send
+        :param buffer_size: Size of the blocks read from the file
+        """
+        self.fileobj: BinaryIO = fileobj
+        self.size: int = size
+        self.buffer_size: int = buffer_size
+
+    def __len__(self) -> int:
+        """Number of bytes to send."""
+        return self.size
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read the next block, the requested size is ignored in favour of the buffer size.
+
+        :param size: Requested size
+        :return: Next block, empty at the end of the file
+        """
+        return self.fileobj.read(self.buffer_size)
+
+
+def file_adler32(localfile: str) -> int:
+    """
+    Compute the Adler-32 checksum of a local file through a memory map, without copying it into memory.
+
+    :param localfile: Local file path
+    :return: Checksum
+    """
+    with open(localfile, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return zlib.adler32(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return zlib.adler32(view)
+
+
+def _ssl_context(session: requests.Session) -> ssl.SSLContext:
+    """
+    Build an SSL context with the CA path and client certificate of a session.
+
+    :param session: Session to take the settings from
+    :return: SSL context
+    """
+    verify: Union[bool, str, None] = session.verify
+    context: ssl.SSLContext
+    if isinstance(verify, str):
+        if os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+    else:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    if isinstance(session.cert, str):
+        context.load_cert_chain(session.cert)
+    elif session.cert:
+        context.load_cert_chain(session.cert[0], session.cert[1])
+    return context
+
+
+def _check_upload_status(url: str, status: int, reason: str) -> None:
+    """
+    Raise the exception matching a failed upload.
+
+    :param url: Destination URL
+    :param status: HTTP status code
+    :param reason: HTTP reason phrase
+    """
+    if status in (200, 201, 204):
+        return
+    if status == 403:
+        raise PermissionError(f"response code {status} : {url}")
+    if status in (404, 409):
+        raise FileNotFoundError(f"parent directory of {url} does not exist: {status}")
+    raise IOError(f"upload of {url} failed: {status} {reason}")
+
+
+def put_expect_continue(
+    session: requests.Session,
+    url: str,
+    reader: UploadReader,
+    headers: Dict[str, str],
+    timeout: int = 20,
+    continue_timeout: float = 10,
+    max_redirects: int = 5,
+) -> Dict[str, str]:
+    """
+    PUT a file with Expect: 100-continue, so a door that rejects or redirects the upload answers before any data
+    is sent.
+
+    requests cannot wait for the interim response, so this is done with http.client on a dedicated connection.
+    Redirects, e.g. from a dCache door to a pool, are followed before the body is sent. A door may also skip the
+    interim response and answer with a final status right away, the body is not sent then. An empty file is sent
+    without Expect header, as a request without body must not carry one.
+
+    :param session: Session to take the certificate settings from
+    :param url: Destination URL
+    :param reader: Body of the request
+    :param headers: Additional request headers
+    :param timeout: Timeout in seconds
+    :param continue_timeout: Time to wait for the interim response, the body is sent anyway after this time
+    :param max_redirects: Maximum number of redirects to follow
+    :return: Headers of the final response
+    """
+    context: Optional[ssl.SSLContext] = None
+    expect: bool = len(reader) > 0
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        conn: http.client.HTTPConnection
+        if parts.scheme == "https":
+            context = context or _ssl_context(session)
+            conn = http.client.HTTPSConnection(parts.hostname or "", parts.port, context=context, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(parts.hostname or "", parts.port, timeout=timeout)
+        try:
+            conn.putrequest("PUT", parts.path + (f"?{parts.query}" if parts.query else ""))
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.putheader("Content-Length", str(len(reader)))
+            if expect:
+                conn.putheader("Expect", "100-continue")
+            conn.endheaders()
+
+            assert conn.sock is not None
+            status: int = 100
+            reason: str = ""
+            responseheaders: Optional[http.client.HTTPMessage] = None
+            if expect:
+                conn.sock.settimeout(continue_timeout)
+                try:
+                    fp = conn.sock.makefile("rb")
+                    statusline: List[str] = fp.readline(65537).decode("iso-8859-1").split(" ", 2)
+                    status = int(statusline[1])
+                    reason = statusline[-1].strip()
+                    responseheaders = http.client.parse_headers(fp)
+                except socket.timeout:
+                    logging.debug(f"no interim response from {url}, sending the body anyway")
+                conn.sock.settimeout(timeout)
+
+            if status == 100:
+                conn.send(reader)  # type: ignore[arg-type]
+                response = conn.getresponse()
+                response.read()
+                status, reason, responseheaders = response.status, response.reason, response.msg
+            # a final status instead of the interim response: the body is not wanted and not sent
+            if status in (301, 302, 303, 307, 308) and responseheaders is not None and responseheaders.get("Location"):
+                url = urljoin(url, responseheaders["Location"])
+                continue
+            _check_upload_status(url, status, reason)
+            return dict(responseheaders.items()) if responseheaders is not None else {}
+        finally:
+            conn.close()
+    raise IOError(f"too many redirects uploading to {url}")
+
+
+def upload_file(
+    session: requests.Session,
+    localfile: str,
+    url: str,
+    timeout: int = 20,
+    expect_continue: bool = True,
+    buffer_size: int = CHUNK_SIZE,
+) -> str:
+    """
+    Upload a local file and let the server verify its Adler-32 checksum.
+
+    The checksum is computed beforehand and sent in a Digest header, dCache rejects the upload when the data it
+    received does not match. The file is streamed in blocks of buffer_size bytes.
+
+    :param session: Session to use
+    :param localfile: Local file path
+    :param url: Destination URL
+    :param timeout: Timeout in seconds
+    :param expect_continue: Send Expect: 100-continue and wait for the server before sending the data
+    :param buffer_size: Size of the blocks read from the local file
+    :return: Hexadecimal Adler-32 checksum of the uploaded file
+    """
+    checksum: str = f"{file_adler32(localfile):08x}"
+    headers: Dict[str, str] = {
+        "Digest": f"adler32={checksum}",
+        "Want-Digest": "ADLER32",
+        "Content-Type": "application/octet-stream",
+    }
+    with open(localfile, "rb") as f:
+        reader = UploadReader(f, os.fstat(f.fileno()).st_size, buffer_size)
+        if expect_continue:
+            response_headers: Dict[str, str] = put_expect_continue(session, url, reader, headers, timeout)
+        else:
+            response: requests.Response = session.put(url, data=reader, headers=headers, timeout=timeout)
+            _check_upload_status(url, response.status_code, response.reason)
+            response_headers = dict(response.headers)
+    digests: Dict[str, str] = parse_digest(
+        next((value for name, value in response_headers.items() if name.lower() == "digest"), "")
+    )
+    if "adler32" in digests and int(digests["adler32"], 16) != int(checksum, 16):
+        raise ChecksumMismatchError(f"ADLER32 mismatch for {url}: sent {checksum}, server has {digests['adler32']}")
+    return checksum
+
+
+def upload_many(
+    upload: Callable[[str, str], None], jobs: Iterable[Tuple[str, str]], concurrency: int = 4
+) -> Dict[str, Optional[BaseException]]:
+    """
+    Upload many files concurrently.
+
+    :param upload: Function uploading a local file to a URL, e.g. the upload method of a client
+    :param jobs: Tuples of (local file path, destination URL)
+    :param concurrency: Number of uploads in flight
+    :return: Dictionary mapping every destination URL to None on success or the exception that occurred
+    """
+    results: Dict[str, Optional[BaseException]] = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload, localfile, url): url for localfile, url in jobs}
+        for future, url in futures.items():
+            results[url] = future.exception()
+    return results
@@ -0,0 +1,239 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from pmgridtools.metrics import RequestEvent
+
+# POST is left out on purpose: submitting a bulk request twice would stage the files twice, and PUT bodies are
+# streamed from a file and cannot be replayed. DELETE is left out too: when the first attempt removed the file but
+# its response was lost, the retry reports a 404 for a successful removal, or removes a file written in between
+IDEMPOTENT_METHODS: frozenset = frozenset({"HEAD", "GET", "OPTIONS", "PROPFIND"})
+RETRY_STATUS: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter."""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """
+        Initialize the bucket, it starts full.
+
+        :param rate: Tokens added per second
+        :param burst: Maximum number of tokens, defaults to rate
+        :param clock: Function returning the current time in seconds
+        :param sleep: Function waiting a number of seconds
+        """
+        self.rate: float = rate
+        self.capacity: float = burst if burst is not None else max(rate, 1)
+        self.clock: Callable[[], float] = clock
+        self.sleep: Callable[[float], None] = sleep
+        self.tokens: float = self.capacity
+        self.updated: float = clock()
+        self._lock: threading.Lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, waiting until one is available."""
+        while True:
+            with self._lock:
+                now: float = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait: float = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class TransportAdapter(HTTPAdapter):
+    """
+    HTTP adapter with a sized connection pool, retries with exponential back-off on idempotent requests, a rate
+    limit per endpoint and a default timeout.
+
+    Hooks are called with a RequestEvent after every request, e.g. a metrics.Metrics instance.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        retries: int = 3,
+        backoff_factor: float = 1,
+        rate_limit: Optional[float] = None,
+        burst: Optional[float] = None,
+        timeout: float = 20,
+    ) -> None:
+        """
+        Initialize the adapter.
+
+        :param pool_size: Maximum number of connections kept open per host
+        :param retries: Number of retries of idempotent requests after connection errors or 429/5xx responses
+        :param backoff_factor: Back-off factor in seconds, retry n waits backoff_factor * 2 ** (n - 1)
+        :param rate_limit: Maximum number of requests per second per endpoint, unlimited if None
+        :param burst: Number of requests allowed in a burst above the rate limit
+        :param timeout: Timeout in seconds of requests sent without an explicit timeout
+        """
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.rate_limit: Optional[float] = rate_limit
+        self.burst: Optional[float] = burst
+        self.timeout: float = timeout
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._buckets_lock: threading.Lock = threading.Lock()
+        self.hooks: List[Callable[[RequestEvent], None]] = []
+        self.in_flight: int = 0
+        self._in_flight_lock: threading.Lock = threading.Lock()
+
+    def send(  # type: ignore[override]
+        self, request: requests.PreparedRequest, timeout: Union[None, float, Tuple[float, float]] = None, **kwargs: Any
+    ) -> requests.Response:
+        """
+        Send a request after taking a token of its endpoint's rate limiter.
+
+        :param request: Prepared request
+        :param timeout: Timeout in seconds, the adapter default is used if None
+        :return: Response object
+        """
+        if self.rate_limit is not None:
+            self._bucket(request.url or "").acquire()
+        if not self.hooks:
+            return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+        with self._in_flight_lock:
+            self.in_flight += 1
+            in_flight: int = self.in_flight
+        start: float = time.perf_counter()
+        response: Optional[requests.Response] = None
+        error: Optional[str] = None
+        try:
+            response = super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+            return response
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+            self._emit(request, response, time.perf_counter() - start, in_flight, error)
+
+    def _emit(
+        self,
+        request: requests.PreparedRequest,
+        response: Optional[requests.Response],
+        seconds: float,
+        in_flight: int,
+        error: Optional[str],
+    ) -> None:
+        """
+        Call the hooks with the event of a finished request.
+
+        :param request: Prepared request
+        :param response: Response, None if the request failed
+        :param seconds: Time until the response headers arrived
+        :param in_flight: Number of requests in flight when the request was sent, including itself
+        :param error: Name of the exception raised by the request
+        """
+        retries: int = 0
+        received: int = 0
+        if response is not None:
+            retry: Optional[Retry] = getattr(response.raw, "retries", None)
+            retries = len(retry.history) if retry is not None else 0
+            received = int(response.headers.get("Content-Length", 0) or 0)
+        body: Any = request.body
+        sent: int = len(body) if body is not None and hasattr(body, "__len__") else 0
+        event = RequestEvent(
+            method=request.method or "",
+            url=request.url or "",
+            status=response.status_code if response is not None else None,
+            seconds=seconds,
+            retries=retries,
+            bytes_sent=sent,
+            bytes_received=received,
+            in_flight=in_flight,
+            error=error,
+        )
+        for hook in self.hooks:
+            hook(event)
+
+    def _bucket(self, url: str) -> TokenBucket:
+        """
+        Get the rate limiter of the endpoint of a URL.
+
+        :param url: Request URL
+        :return: Token bucket shared by all requests to the same scheme, host and port
+        """
+        parts = urlsplit(url)
+        endpoint: str = f"{parts.scheme}://{parts.netloc}"
+        with self._buckets_lock:
+            if endpoint not in self._buckets:
+                assert self.rate_limit is not None
+                self._buckets[endpoint] = TokenBucket(self.rate_limit, self.burst)
+            return self._buckets[endpoint]
+
+
+def make_session(
+    cert: Optional[str],
+    capath: str = "/etc/grid-security/certificates/",
+    pool_size: int = 10,
+    retries: int = 3,
+    backoff_factor: float = 1,
+    rate_limit: Optional[float] = None,
+    burst: Optional[float] = None,
+    timeout: float = 20,
+    hooks: Optional[List[Callable[[RequestEvent], None]]] = None,
+) -> requests.Session:
+    """
+    Create a session for dCache doors and the REST API, it can be shared by several clients.
+
+    :param cert: Client certificate (grid proxy) file
+    :param capath: Directory with the trusted CA certificates
+    :param pool_size: Maximum number of connections kept open per host
+    :param retries: Number of retries of idempotent requests
+    :param backoff_factor: Back-off factor in seconds between retries
+    :param rate_limit: Maximum number of requests per second per endpoint, unlimited if None
+    :param burst: Number of requests allowed in a burst above the rate limit
+    :param timeout: Timeout in seconds of requests sent without an explicit timeout
+    :param hooks: Functions called with a RequestEvent after every request, e.g. a metrics.Metrics instance
+    :return: Configured session
+    """
+    session: requests.Session = requests.Session()
+    adapter = TransportAdapter(pool_size, retries, backoff_factor, rate_limit, burst, timeout)
+    adapter.hooks.extend(hooks or [])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = capath
+    session.cert = cert
+    return session
+
+
+def add_hook(session: requests.Session, hook: Callable[[RequestEvent], None]) -> None:
+    """
+    Add a hook to the transport adapters of a session.
+
+    :param session: Session created by make_session
+    :param hook: Function called with a RequestEvent after every request
+    """
+    adapters: List[TransportAdapter] = [
+        adapter for adapter in dict.fromkeys(session.adapters.values()) if isinstance(adapter, TransportAdapter)
+    ]
+    if not adapters:
+        raise ValueError("the session has no TransportAdapter, create it with transport.make_session")
+    for adapter in adapters:
+        adapter.hooks.append(hook)
@@ -1,23 +1,65 @@
 import os
+import posixpath
 import xml.etree.ElementTree as ET
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlsplit
 
 import requests
 
+import pmgridtools.remote_file as remote_file
+import pmgridtools.transfer as transfer
+import pmgridtools.transport as transport
+from pmgridtools.api_dcache import FileInfo
+from pmgridtools.metadata_cache import MetadataCache, cached
+from pmgridtools.metrics import RequestEvent
+
+DAV: str = "{DAV:}"
+SRM: str = "{http://srm.lbl.gov/StorageResourceManager}"
+DCACHE: str = "{http://www.dcache.org/2013/webdav}"
+STAT_PROPFIND: str = (
+    '<?xml version="1.0"?><a:propfind xmlns:a="DAV:" xmlns:srm="http://srm.lbl.gov/StorageResourceManager" '
+    'xmlns:d="http://www.dcache.org/2013/webdav"><a:prop><a:getcontentlength/><a:resourcetype/>'
+    "<srm:FileLocality/><srm:AccessLatency/><d:Checksums/></a:prop></a:propfind>"
+)
+
 
 class WebDav:
     """WebDAV client for dCache operations."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        cache: Optional[MetadataCache] = None,
+        pool_size: int = 10,
+        session: Optional[requests.Session] = None,
+    ) -> None:
         """
         Initialize WebDAV client.
+
+        :param cache: Optional metadata cache consulted before asking the server, can be shared between clients
+        :param pool_size: Maximum number of connections kept open per host, should be at least the number of
+            threads sharing this client
+        :param session: Session to use, e.g. one from transport.make_session shared with other clients or tuned
+            for retries and rate limiting. A default one with pool_size connections is created if not given
         """
         self.cert: str = os.environ["X509_USER_PROXY"]
         self.capath: str = "/etc/grid-security/certificates/"
-        self.session: requests.Session = requests.Session()
-        self.session.verify = "/etc/grid-security/certificates/"
-        self.session.cert = self.cert
+        self.session: requests.Session = (
+            session if session is not None else transport.make_session(self.cert, self.capath, pool_size)
+        )
         self.timeout: int = 20
+        self.cache: Optional[MetadataCache] = cache
+
+    def add_hook(self, hook: Callable[[RequestEvent], None]) -> None:
+        """
+        Call a function after every request sent through the session of this client, e.g. a metrics.Metrics
+        instance recording latencies, status codes, retries and bytes.
 
+        :param hook: Function called with a RequestEvent
+        """
+        transport.add_hook(self.session, hook)
+
+    @cached("adler32")
     def adler32(self, url: str) -> str:
         """
         Get ADLER32 checksum of a file.
@@ -41,6 +83,7 @@ class WebDav:
 
         return adler32
 
+    @cached("locality")
     def locality(self, url: str) -> str:
         """
         Get file locality information.
@@ -56,6 +99,7 @@ class WebDav:
             "{http://srm.lbl.gov/StorageResourceManager}FileLocality",
         )
 
+    @cached("access_latency")
     def access_latency(self, url: str) -> str:
         """
         Get file access latency information.
@@ -95,6 +139,137 @@ class WebDav:
             raise ValueError(f"No {extract_element} found in response")
         return elements[0]
 
+    def stat(self, url: str) -> FileInfo:
+        """
+        Get size, locality, access latency and checksums of a file with a single PROPFIND.
+
+        :param url: File URL
+        :return: File metadata record
+        """
+        for info in self._propfind(url, depth=0):
+            return info
+        raise FileNotFoundError(f"Could not found {url}")
+
+    def list_dir(self, url: str) -> Iterator[FileInfo]:
+        """
+        List a directory with a single Depth 1 PROPFIND.
+
+        The response is parsed incrementally, so large directories are never held in memory as a whole.
+
+        :param url: Directory URL
+        :return: Iterator over the metadata records of the directory entries
+        """
+        directory: str = self._url_path(url)
+        for info in self._propfind(url.rstrip("/") + "/", depth=1):
+            if self._url_path(info.path) != directory:
+                yield info
+
+    def stat_many(self, urls: Iterable[str], listing_threshold: int = 16) -> Iterator[FileInfo]:
+        """
+        Get the metadata of many files with as few PROPFIND requests as possible.
+
+        Files are grouped by directory; a directory holding at least listing_threshold of the requested files is
+        listed with one Depth 1 PROPFIND, other files get a Depth 0 PROPFIND each. A listing returns every entry
+        of the directory, so it only pays off when a good part of a directory is requested.
+
+        :param urls: File URLs
+        :param listing_threshold: Minimum number of requested files in a directory to list it
+        :return: Iterator over the metadata records, grouped by directory. Files that do not exist are skipped
+        """
+        # requested URLs by directory, keyed by their unquoted path, the server may encode hrefs differently
+        bydir: Dict[str, Dict[str, str]] = defaultdict(dict)
+        for url in urls:
+            bydir[posixpath.dirname(url)][self._url_path(url)] = url
+        for directory, wanted in bydir.items():
+            if len(wanted) >= listing_threshold:
+                try:
+                    yield from (info for info in self.list_dir(directory) if self._url_path(info.path) in wanted)
+                except FileNotFoundError:
+                    continue
+            else:
+                for url in wanted.values():
+                    try:
+                        yield self.stat(url)
+                    except FileNotFoundError:
+                        continue
+
+    def _propfind(self, url: str, depth: int) -> Iterator[FileInfo]:
+        """
+        Send a PROPFIND for size, locality, access latency and checksums and parse the response as it arrives.
+
+        :param url: File or directory URL
+        :param depth: 0 for the resource itself, 1 to include the entries of a directory
+        :return: Iterator over the metadata records in the response
+        """
+        headers: Dict[str, str] = {"Depth": str(depth), "Content-Type": "application/xml"}
+        with self.session.request(
+            "PROPFIND", url, data=STAT_PROPFIND, headers=headers, stream=True, timeout=self.timeout
+        ) as response:
+            if response.status_code == 404:
+                raise FileNotFoundError(f"Could not found {url}")
+            elif response.status_code == 403:
+                raise PermissionError(f"response code {response.status_code} : {url}")
+            elif response.status_code != 207:
+                raise ValueError(f"response code not a default value (expected 207){response.status_code} : {url}")
+            response.raw.decode_content = True
+            root: Optional[ET.Element] = None
+            for event, elem in ET.iterparse(response.raw, events=("start", "end")):
+                if root is None:
+                    root = elem
+                elif event == "end" and elem.tag == f"{DAV}response":
+                    info: Optional[FileInfo] = self._parse_response(url, elem)
+                    # drop parsed entries, so the tree never grows beyond a single response element
+                    root.clear()
+                    if info is not None:
+                        yield info
+
+    @staticmethod
+    def _url_path(url: str) -> str:
+        """
+        Unquoted path of a URL, to compare URLs that may be percent-encoded differently.
+
+        :param url: URL
+        :return: Path without trailing slash
+        """
+        return unquote(urlsplit(url).path).rstrip("/")
+
+    @staticmethod
+    def _parse_response(url: str, elem: ET.Element) -> Optional[FileInfo]:
+        """
+        Convert a DAV:response element into a metadata record.
+
+        :param url: URL the PROPFIND was sent to, hrefs are resolved against it
+        :param elem: DAV:response element
+        :return: Metadata record, None if the properties were not returned successfully
+        """
+        href: Optional[str] = elem.findtext(f"{DAV}href")
+        if href is None:
+            return None
+        props: Dict[str, ET.Element] = {}
+        for propstat in elem.iter(f"{DAV}propstat"):
+            if " 200 " not in (propstat.findtext(f"{DAV}status") or ""):
+                continue
+            for prop in propstat.iter(f"{DAV}prop"):
+                props.update({child.tag: child for child in prop})
+        if not props:
+            return None
+
+        def text(tag: str) -> Optional[str]:
+            return props[tag].text if tag in props else None
+
+        resourcetype: Optional[ET.Element] = props.get(f"{DAV}resourcetype")
+        checksums: Dict[str, str] = transfer.parse_digest(text(f"{DCACHE}Checksums") or "")
+        return FileInfo(
+            path=urljoin(url, href).rstrip("/"),
+            size=int(text(f"{DAV}getcontentlength") or 0),
+            locality=text(f"{SRM}FileLocality") or "",
+            file_type=(
+                "DIR" if resourcetype is not None and resourcetype.find(f"{DAV}collection") is not None else "REGULAR"
+            ),
+            access_latency=text(f"{SRM}AccessLatency"),
+            checksums={algorithm.upper(): value for algorithm, value in checksums.items()},
+        )
+
     def md5sum(self, url: str) -> str:
         """
         Get MD5 checksum of a file.
@@ -110,6 +285,8 @@ class WebDav:
 
         :param url: File URL
         """
+        if self.cache is not None:
+            self.cache.invalidate(url)
         response: requests.Response = self.session.request("DELETE", url, timeout=self.timeout)
         print(response)
 
@@ -122,32 +299,61 @@ class WebDav:
         """
         raise NotImplementedError
 
-    def upload(self, file: str, url: str) -> None:
+    def upload(self, file: str, url: str, expect_continue: bool = True) -> None:
         """
         Upload a file.
 
+        The file is streamed, never loaded into memory, and dCache verifies its Adler-32 checksum on arrival.
+
         :param file: Local file path
         :param url: Destination URL
+        :param expect_continue: Wait for the door to accept (or redirect) the upload before sending any data
         """
-        raise NotImplementedError
+        if self.cache is not None:
+            self.cache.invalidate(url)
+        transfer.upload_file(self.session, file, url, self.timeout, expect_continue)
+
+    def upload_many(
+        self, jobs: List[Tuple[str, str]], concurrency: int = 4, expect_continue: bool = False
+    ) -> Dict[str, Optional[BaseException]]:
+        """
+        Upload many files concurrently over the pooled session.
 
-    def download(self, url: str, localfile: str) -> str:
+        :param jobs: Tuples of (local file path, destination URL)
+        :param concurrency: Number of uploads in flight
+        :param expect_continue: Use Expect: 100-continue, which opens a dedicated connection per upload
+        :return: Dictionary mapping every destination URL to None on success or the exception that occurred
+        """
+        return transfer.upload_many(lambda file, url: self.upload(file, url, expect_continue), jobs, concurrency)
+
+    def download(
+        self,
+        url: str,
+        localfile: str,
+        parallel: int = 1,
+        segment_size: int = transfer.SEGMENT_SIZE,
+        verify: bool = True,
+    ) -> str:
         """
         Download a file.
 
+        The Adler-32 checksum is computed while downloading and compared with the one reported by the server,
+        a mismatch raises a ChecksumMismatchError and removes the local file.
+
         :param url: Source URL
         :param localfile: Local file path
+        :param parallel: Number of HTTP range requests in flight, 1 downloads the file in a single stream
+        :param segment_size: Size in bytes of each range request when downloading in parallel
+        :param verify: Verify the Adler-32 checksum of the downloaded data
         :return: Local file path
         """
+        if parallel > 1:
+            return transfer.ranged_download(
+                self.session, url, localfile, segment_size, parallel, self.timeout, verify=verify
+            )
+        return transfer.stream_download(self.session, url, localfile, self.timeout, verify)
 
-        with self.session.get(url, stream=True, timeout=self.timeout) as d:
-            d.raise_for_status()
-            with open(localfile, "wb") as lf:
-                for chunk in d.iter_content(chunk_size=4194304):
-                    if chunk:
-                        lf.write(chunk)
-        return localfile
-
+    @cached("size")
     def size(self, url: str) -> int:
         """
         Get file size.
@@ -172,8 +378,26 @@ class WebDav:
         :param url: File URL
         :return: File content as bytes
         """
-        return self.session.get(url, timeout=self.timeout).content
+        return remote_file.cat(self.session, url, self.timeout)
+
+    def open_remote(
+        self, url: str, block_size: int = remote_file.BLOCK_SIZE, cache_blocks: int = 8
+    ) -> remote_file.RemoteFile:
+        """
+        Open a remote file for random access reads with range requests, e.g. to read the header of a large file.
+
+        :param url: File URL
+        :param block_size: Size in bytes of the range requests of small reads
+        :param cache_blocks: Number of blocks kept in the read-ahead cache
+        :return: Seekable raw file object, wrap it in io.BufferedReader for buffered reads
+        """
+        size: Optional[int] = None
+        if self.cache is not None:
+            found, value = self.cache.get("size", url)
+            size = value if found else None
+        return remote_file.open_remote(self.session, url, size, block_size, cache_blocks, self.timeout)
 
+    @cached("exists")
     def exists(self, url: str) -> bool:
         """
         Check if file exists.
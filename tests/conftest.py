@@ -0,0 +1,41 @@
+import os
+import sys
+from typing import Iterator, Tuple
+
+import pytest
+
+# the mock dCache and the fakes live with the benchmarks, they are not part of the package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+
+from mock_dcache import API, FakeClock, FakeDcache, MockDcache  # noqa: E402
+
+import pmgridtools.transport as transport  # noqa: E402
+from pmgridtools.api_dcache import dcacheapy  # noqa: E402
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    """Fake clock starting at 1000 seconds."""
+    return FakeClock()
+
+
+@pytest.fixture
+def fake_dcache() -> FakeDcache:
+    """In-process dCache client whose bulk request targets stay RUNNING until the test completes them."""
+    return FakeDcache()
+
+
+@pytest.fixture(scope="module")
+def mock_dcache() -> Iterator[Tuple[MockDcache, str]]:
+    """Mock dCache shared by the tests of a module, serving small files that come online 0.2 seconds after a PIN."""
+    mock = MockDcache(tape_delay=0.2, files_per_dir=25, file_size=1024)
+    base: str = mock.start()
+    yield (mock, base)
+    mock.stop()
+
+
+@pytest.fixture
+def dcache(mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch) -> dcacheapy:
+    """REST API client talking to the mock dCache over plain HTTP."""
+    monkeypatch.setenv("X509_USER_PROXY", "")
+    return dcacheapy(session=transport.make_session(None, pool_size=4), api=mock_dcache[1] + API)
@@ -0,0 +1,122 @@
+import time
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from mock_dcache import MockDcache
+from requests.structures import CaseInsensitiveDict
+
+from pmgridtools.api_dcache import (
+    BulkRequestStatus,
+    FileInfo,
+    bulk_request_id,
+    dcacheapy,
+    parse_bulk_page,
+)
+
+DIR: str = "/pnfs/grid.sara.nl/data/test/dir1"
+
+
+def test_stat(dcache: dcacheapy) -> None:
+    info: FileInfo = dcache.stat(f"{DIR}/f00000001")
+    assert info.path == f"{DIR}/f00000001" and info.size == 1024
+    assert info.locality == "NEARLINE" and not info.online
+    assert info.storage_class is not None and "ADLER32" in info.checksums
+    with pytest.raises(FileNotFoundError):
+        dcache.stat(f"{DIR}/missing-1")
+
+
+def test_file_info_from_json() -> None:
+    info: FileInfo = FileInfo.from_json(
+        "/pnfs/a",
+        {"size": "7", "fileLocality": "ONLINE_AND_NEARLINE", "checksums": [{"type": "adler32", "value": "01"}]},
+    )
+    assert info == FileInfo("/pnfs/a", 7, "ONLINE_AND_NEARLINE", checksums={"ADLER32": "01"})
+    assert info.online
+
+
+def test_list_dir_pages(mock_dcache: Tuple[MockDcache, str], dcache: dcacheapy) -> None:
+    mock, _ = mock_dcache
+    before: int = mock.requests.get("GET", 0)
+    infos: List[FileInfo] = list(dcache.list_dir(DIR + "/", page_size=10))
+    assert [info.path for info in infos] == [f"{DIR}/f{i:08d}" for i in range(25)]
+    assert mock.requests["GET"] - before == 3
+    with pytest.raises(FileNotFoundError):
+        list(dcache.list_dir("/pnfs/grid.sara.nl/data/missing-dir"))
+
+
+def test_bulk_request_id() -> None:
+    assert bulk_request_id(CaseInsensitiveDict({"Request-URL": "https://host/api/v1/bulk-requests/abc"})) == "abc"
+    assert bulk_request_id({"Location": "https://host/api/v1/bulk-requests/def/"}) == "def"
+    with pytest.raises(RuntimeError):
+        bulk_request_id({})
+
+
+def test_stage_and_poll(dcache: dcacheapy) -> None:
+    files: List[str] = [f"{DIR}/f00000002", f"{DIR}/missing-2"]
+    request_id: str = dcache.stage(files)
+    status: BulkRequestStatus = dcache.bulk_request_status(request_id)
+    assert status.targets == {files[0]: "RUNNING", files[1]: "FAILED"} and not status.finished
+    assert status.errors[files[1]] == "No such file or directory"
+    time.sleep(0.3)
+    status = dcache.bulk_request_status(request_id)
+    assert status.targets[files[0]] == "COMPLETED" and status.finished
+    assert dcache.stat(files[0]).online
+    with pytest.raises(FileNotFoundError):
+        dcache.bulk_request_status("unknown")
+
+
+def test_parse_bulk_page_target_prefix() -> None:
+    targets: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    page: Dict[str, Any] = {
+        "status": "STARTED",
+        "targetPrefix": "/pnfs/grid.sara.nl/data",
+        "targets": [
+            {"target": "/a", "state": "COMPLETED"},
+            {"target": "/b", "state": "FAILED", "errorMessage": "No such file or directory"},
+        ],
+        "nextId": 2,
+    }
+    assert parse_bulk_page(page, targets, errors) == ("STARTED", 2)
+    assert targets == {"/pnfs/grid.sara.nl/data/a": "COMPLETED", "/pnfs/grid.sara.nl/data/b": "FAILED"}
+    assert errors == {"/pnfs/grid.sara.nl/data/b": "No such file or directory"}
+    # without a prefix the targets are full paths
+    assert parse_bulk_page({"targetPrefix": None, "targets": [{"target": "/c", "state": "RUNNING"}]}, targets, errors)
+    assert targets["/c"] == "RUNNING"
+
+
+def test_bulk_request_chunks(mock_dcache: Tuple[MockDcache, str], dcache: dcacheapy) -> None:
+    mock, _ = mock_dcache
+    files: List[str] = [f"{DIR}/f0000000{i}" for i in range(5)]
+    request_ids: List[str] = dcache.unpin(iter(files), chunk_size=2)
+    assert [mock.bulk[request_id][:2] for request_id in request_ids] == [
+        ("UNPIN", files[0:2]),
+        ("UNPIN", files[2:4]),
+        ("UNPIN", files[4:5]),
+    ]
+    # the targets come back as full paths, whatever prefix the server strips off
+    assert sorted(dcache.bulk_request_status(request_ids[0]).targets) == files[0:2]
+    assert dcache.delete(files[0]) != [] and dcache.update_qos([], "tape") == []
+    with pytest.raises(ValueError):
+        dcache.bulk_request("UNPIN", files, expand_directories="SOME")
+
+
+def test_bulk_request_arguments(dcache: dcacheapy, monkeypatch: pytest.MonkeyPatch) -> None:
+    submitted: List[Tuple[str, List[str], Dict[str, Any], str]] = []
+
+    def submit(activity: str, targets: List[str], arguments: Dict[str, Any], expand_directories: str) -> str:
+        submitted.append((activity, targets, arguments, expand_directories))
+        return str(len(submitted))
+
+    monkeypatch.setattr(dcache, "_submit_bulk", submit)
+    assert dcache.unpin(DIR, pin_id="pin-1", expand_directories="ALL") == ["1"]
+    dcache.unpin([DIR])
+    dcache.delete([DIR], skip_dirs=False, expand_directories="ALL")
+    dcache.update_qos([f"{DIR}/f00000001"], "disk+tape")
+    assert submitted == [
+        ("UNPIN", [DIR], {"id": "pin-1"}, "ALL"),
+        # like stage, unpin expands directories one level by default
+        ("UNPIN", [DIR], {}, "TARGETS"),
+        ("DELETE", [DIR], {"skipDirs": "false"}, "ALL"),
+        ("UPDATE_QOS", [f"{DIR}/f00000001"], {"targetQos": "disk+tape"}, "NONE"),
+    ]
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import pathlib
+from typing import List, Tuple
+
+import httpx
+import pytest
+from mock_dcache import API, MockDcache, content
+
+from pmgridtools import transfer
+from pmgridtools.api_dcache import FileInfo
+from pmgridtools.async_dcache import AsyncDcacheApy, AsyncWebDav
+
+DIR: str = "/pnfs/grid.sara.nl/data/async/dir1"
+DATA: str = "/pnfs/grid.sara.nl/data/async"
+
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch: pytest.MonkeyPatch) -> None:
+    """The clients read the proxy path, the mock serves plain HTTP and needs none."""
+    monkeypatch.setenv("X509_USER_PROXY", "")
+
+
+def test_api_stat_and_stage(mock_dcache: Tuple[MockDcache, str]) -> None:
+    _, base = mock_dcache
+
+    async def run() -> None:
+        async with AsyncDcacheApy(concurrency=4, http2=False, api=base + API, verify=False) as dcache:
+            infos: List[FileInfo] = await asyncio.gather(*(dcache.stat(f"{DIR}/f0000000{i}") for i in range(8)))
+            assert [info.path for info in infos] == [f"{DIR}/f0000000{i}" for i in range(8)]
+            assert await dcache.size(f"{DIR}/f00000001") == 1024
+            with pytest.raises(FileNotFoundError):
+                await dcache.stat(f"{DIR}/missing-file")
+            request_id: str = await dcache.stage([f"{DIR}/f00000001", f"{DIR}/f00000002"])
+            status = await dcache.bulk_request_status(request_id)
+            assert sorted(status.targets) == [f"{DIR}/f00000001", f"{DIR}/f00000002"]
+            with pytest.raises(FileNotFoundError):
+                await dcache.bulk_request_status("no-such-request")
+        # a wrong API URL is a 404 too, which must not escape as an httpx error
+        async with AsyncDcacheApy(http2=False, api=base + "/wrong", verify=False) as dcache:
+            with pytest.raises(FileNotFoundError):
+                await dcache.stage(f"{DIR}/f00000001")
+
+    asyncio.run(run())
+
+
+def test_webdav(mock_dcache: Tuple[MockDcache, str], tmp_path: pathlib.Path) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+
+    async def run() -> None:
+        async with AsyncWebDav(concurrency=4, http2=False, verify=False) as webdav:
+            info: FileInfo = await webdav.stat(f"{base}{DIR}/f00000001")
+            assert info.size == 1024 and info.checksums == {"ADLER32": mock.adler32(1024)}
+            assert await webdav.locality(f"{base}{DIR}/f00000001") == info.locality
+            assert await webdav.adler32(f"{base}{DIR}/f00000001") == mock.adler32(1024)
+            assert await webdav.exists(f"{base}{DIR}/f00000001")
+            assert not await webdav.exists(f"{base}{DIR}/missing-file")
+            assert await webdav.download(f"{base}{DATA}/download-5000", localfile) == localfile
+            assert pathlib.Path(localfile).read_bytes() == content(0, 5000)
+            for method in (webdav.stat, webdav.adler32):
+                with pytest.raises(FileNotFoundError):
+                    await method(f"{base}{DIR}/missing-file")
+
+    asyncio.run(run())
+
+
+def test_webdav_download_errors(mock_dcache: Tuple[MockDcache, str], tmp_path: pathlib.Path) -> None:
+    _, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+
+    async def run() -> None:
+        async with AsyncWebDav(http2=False, verify=False) as webdav:
+            with pytest.raises(FileNotFoundError):
+                await webdav.download(f"{base}{DATA}/missing-file", localfile)
+            # the local file is only created once the server answered
+            assert not os.path.exists(localfile)
+            with pytest.raises(transfer.ChecksumMismatchError):
+                await webdav.download(f"{base}{DATA}/corrupt-5000", localfile)
+            assert not os.path.exists(localfile)
+
+    asyncio.run(run())
+
+
+def test_shared_client(mock_dcache: Tuple[MockDcache, str]) -> None:
+    _, base = mock_dcache
+
+    async def run() -> None:
+        async with httpx.AsyncClient() as client:
+            async with AsyncWebDav(client=client) as webdav:
+                assert webdav.client is client
+                assert await webdav.size(f"{base}{DIR}/f00000001") == 1024
+            # closing the WebDAV client leaves a client that was passed in open
+            assert not client.is_closed
+            async with AsyncDcacheApy(api=base + API, client=client) as dcache:
+                assert (await dcache.stat(f"{DIR}/f00000001")).size == 1024
+        assert client.is_closed
+
+    asyncio.run(run())
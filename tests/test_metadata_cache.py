@@ -0,0 +1,84 @@
+import os
+import pathlib
+from typing import List
+
+from mock_dcache import FakeClock
+
+from pmgridtools.api_dcache import dcacheapy
+from pmgridtools.metadata_cache import MetadataCache, cache_key
+
+
+def test_cache_key() -> None:
+    assert cache_key("/pnfs/a/b/") == "/pnfs/a/b"
+    assert cache_key("https://door:2880/pnfs/a%20b") == "/pnfs/a b"
+    assert cache_key("https://door:2880/") == "/"
+
+
+def test_ttl_per_field(clock: FakeClock) -> None:
+    cache: MetadataCache = MetadataCache(ttls={"locality": 10, "exists": 0}, clock=clock)
+    cache.set("locality", "/a", "NEARLINE")
+    cache.set("size", "/a", 5)
+    cache.set("exists", "/a", True)
+    assert cache.get("exists", "/a") == (False, None)
+    clock.advance(11)
+    assert cache.get("locality", "/a") == (False, None)
+    assert cache.get("size", "/a") == (True, 5)
+
+
+def test_lookup_computes_once(clock: FakeClock) -> None:
+    cache: MetadataCache = MetadataCache(clock=clock)
+    calls: List[int] = []
+
+    def compute() -> int:
+        calls.append(1)
+        return 42
+
+    assert cache.lookup("size", "https://door/pnfs/a", compute) == 42
+    assert cache.lookup("size", "/pnfs/a", compute) == 42
+    assert len(calls) == 1
+
+
+def test_lru_eviction(clock: FakeClock) -> None:
+    cache: MetadataCache = MetadataCache(maxsize=2, clock=clock)
+    cache.set("size", "/a", 1)
+    cache.set("size", "/b", 2)
+    assert cache.get("size", "/a") == (True, 1)
+    cache.set("size", "/c", 3)
+    # /b was used least recently
+    assert cache.get("size", "/b") == (False, None)
+    assert cache.get("size", "/a") == (True, 1)
+    assert cache.get("size", "/c") == (True, 3)
+
+
+def test_invalidate_children(clock: FakeClock) -> None:
+    cache: MetadataCache = MetadataCache(clock=clock)
+    for key in ("/d", "/d/a", "/d/sub/b", "/d2/c"):
+        cache.set("size", key, 1)
+    cache.invalidate("/d/a")
+    assert cache.get("size", "/d/a") == (False, None)
+    assert cache.get("size", "/d/sub/b") == (True, 1)
+    cache.invalidate("https://door/d/", children=True)
+    assert [cache.get("size", key)[0] for key in ("/d", "/d/sub/b", "/d2/c")] == [False, False, True]
+
+
+def test_shared_file(tmp_path: pathlib.Path, clock: FakeClock) -> None:
+    path: str = os.path.join(tmp_path, "cache.db")
+    writer: MetadataCache = MetadataCache(path=path, clock=clock)
+    writer.set("adler32", "/d/a", "0a0b0c0d")
+    writer.set("locality", "/d/b", "ONLINE")
+    writer.set("size", "/e/c", 3)
+    reader: MetadataCache = MetadataCache(path=path, clock=clock)
+    assert reader.get("adler32", "/d/a") == (True, "0a0b0c0d")
+    clock.advance(3600)
+    assert reader.get("locality", "/d/b") == (False, None)
+    writer.invalidate("/d", children=True)
+    assert MetadataCache(path=path, clock=clock).get("adler32", "/d/a") == (False, None)
+    assert MetadataCache(path=path, clock=clock).get("size", "/e/c") == (True, 3)
+
+
+def test_client_fills_cache(dcache: dcacheapy) -> None:
+    dcache.cache = MetadataCache()
+    dcache.stat("/pnfs/grid.sara.nl/data/cache/f00000001")
+    # the entry cached under the pnfs path is found with the door URL of the same file
+    assert dcache.cache.get("size", "https://door/pnfs/grid.sara.nl/data/cache/f00000001") == (True, 1024)
+    assert dcache.cache.get("locality", "/pnfs/grid.sara.nl/data/cache/f00000001/") == (True, "NEARLINE")
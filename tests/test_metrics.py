@@ -0,0 +1,92 @@
+import json
+import os
+import pathlib
+import stat
+from typing import Any, Dict, Tuple
+
+from mock_dcache import MockDcache
+
+import pmgridtools.transport as transport
+from pmgridtools.metrics import Metrics, RequestEvent
+
+
+def recorded() -> Metrics:
+    metrics: Metrics = Metrics(buckets=(0.1, 1))
+    metrics(RequestEvent("GET", "https://door:2880/pnfs/a", 200, 0.05, bytes_received=100))
+    metrics(RequestEvent("GET", "https://door:2880/pnfs/b", 503, 0.5, retries=2, in_flight=3))
+    metrics(RequestEvent("PUT", "https://door:2880/pnfs/c", None, 2, bytes_sent=10, error="ReadTimeout"))
+    return metrics
+
+
+def test_prometheus_format() -> None:
+    labels: str = 'method="GET",endpoint="https://door:2880"'
+    put: str = 'method="PUT",endpoint="https://door:2880"'
+    assert recorded().to_prometheus(prefix="pm").splitlines() == [
+        "# TYPE pm_request_duration_seconds histogram",
+        f'pm_request_duration_seconds_bucket{{{labels},le="0.1"}} 1',
+        f'pm_request_duration_seconds_bucket{{{labels},le="1"}} 2',
+        f'pm_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2',
+        f"pm_request_duration_seconds_sum{{{labels}}} 0.55",
+        f"pm_request_duration_seconds_count{{{labels}}} 2",
+        f'pm_request_duration_seconds_bucket{{{put},le="0.1"}} 0',
+        f'pm_request_duration_seconds_bucket{{{put},le="1"}} 0',
+        f'pm_request_duration_seconds_bucket{{{put},le="+Inf"}} 1',
+        f"pm_request_duration_seconds_sum{{{put}}} 2",
+        f"pm_request_duration_seconds_count{{{put}}} 1",
+        "# TYPE pm_requests_total counter",
+        f'pm_requests_total{{{labels},status="200"}} 1',
+        f'pm_requests_total{{{labels},status="503"}} 1',
+        f'pm_requests_total{{{put},status="ReadTimeout"}} 1',
+        "# TYPE pm_request_retries_total counter",
+        f"pm_request_retries_total{{{labels}}} 2",
+        f"pm_request_retries_total{{{put}}} 0",
+        "# TYPE pm_bytes_sent_total counter",
+        f"pm_bytes_sent_total{{{labels}}} 0",
+        f"pm_bytes_sent_total{{{put}}} 10",
+        "# TYPE pm_bytes_received_total counter",
+        f"pm_bytes_received_total{{{labels}}} 100",
+        f"pm_bytes_received_total{{{put}}} 0",
+        "# TYPE pm_max_in_flight gauge",
+        "pm_max_in_flight 3",
+    ]
+
+
+def test_json_format(tmp_path: pathlib.Path) -> None:
+    path: str = os.path.join(tmp_path, "metrics.json")
+    recorded().write(path)
+    data: Dict[str, Any] = json.loads(pathlib.Path(path).read_text())
+    assert data["max_in_flight"] == 3 and data["bucket_bounds"] == [0.1, 1]
+    assert data["requests"][0] == {
+        "method": "GET",
+        "endpoint": "https://door:2880",
+        "count": 2,
+        "seconds": 0.55,
+        "buckets": [1, 1, 0],
+        "retries": 2,
+        "bytes_sent": 0,
+        "bytes_received": 100,
+        "statuses": {"200": 1, "503": 1},
+    }
+    assert data["requests"][1]["statuses"] == {"ReadTimeout": 1}
+
+
+def test_write_prometheus_textfile(tmp_path: pathlib.Path) -> None:
+    path: str = os.path.join(tmp_path, "pmgridtools.prom")
+    metrics: Metrics = recorded()
+    metrics.write(path)
+    assert pathlib.Path(path).read_text() == metrics.to_prometheus()
+    # readable by the collector, no temporary files left behind
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(tmp_path) == ["pmgridtools.prom"]
+
+
+def test_session_hook(mock_dcache: Tuple[MockDcache, str]) -> None:
+    _, base = mock_dcache
+    metrics: Metrics = Metrics()
+    session = transport.make_session(None, hooks=[metrics])
+    for _ in range(3):
+        session.get(f"{base}/pnfs/grid.sara.nl/data/metrics/download-100")
+    series: Dict[str, Any] = metrics.snapshot()["requests"][0]
+    assert (series["method"], series["endpoint"], series["count"]) == ("GET", base, 3)
+    assert series["statuses"] == {"200": 3} and series["bytes_received"] == 300
+    assert "GET" in metrics.summary() and metrics.summary().endswith("maximum requests in flight: 1")
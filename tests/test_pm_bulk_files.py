@@ -0,0 +1,84 @@
+import functools
+import io
+import sys
+from typing import Iterator, List, Tuple
+
+import pytest
+from mock_dcache import API, MockDcache
+
+from pmgridtools import pm_bulk_files
+from pmgridtools.api_dcache import dcacheapy
+
+DIR: str = "/pnfs/grid.sara.nl/data/bulk/dir1"
+
+
+class Stdin:
+    """Standard input that can only be iterated line by line, so it must be read lazily."""
+
+    def __init__(self, text: str = "", tty: bool = False) -> None:
+        self.lines: io.StringIO = io.StringIO(text)
+        self.tty: bool = tty
+
+    def isatty(self) -> bool:
+        return self.tty
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.lines)
+
+
+@pytest.fixture(autouse=True)
+def client(mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch) -> None:
+    """Point the script at the mock dCache."""
+    monkeypatch.setenv("X509_USER_PROXY", "")
+    monkeypatch.setattr(pm_bulk_files, "dcacheapy", functools.partial(dcacheapy, api=mock_dcache[1] + API))
+
+
+def run(monkeypatch: pytest.MonkeyPatch, argv: List[str], stdin: Stdin) -> None:
+    monkeypatch.setattr(sys, "argv", ["pm_bulk_files", *argv])
+    monkeypatch.setattr(sys, "stdin", stdin)
+    pm_bulk_files.main()
+
+
+def test_unpin_from_stdin(
+    mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    mock, _ = mock_dcache
+    files: List[str] = [f"{DIR}/f0000000{i}" for i in range(3)]
+    stdin = Stdin("\n".join([*files, "", "/home/user/file", files[0]]) + "\n")
+    run(monkeypatch, ["unpin", "--pin-id", "pin-1", "--chunk-size", "2"], stdin)
+    out, err = capsys.readouterr()
+    request_ids: List[str] = out.split()
+    # duplicates are dropped, the rest goes in chunks of two
+    assert [mock.bulk[request_id][:2] for request_id in request_ids] == [("UNPIN", files[0:2]), ("UNPIN", files[2:])]
+    assert err == "invalid path: /home/user/file. skipped\n"
+
+
+def test_qos_from_arguments(
+    mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    mock, _ = mock_dcache
+    run(
+        monkeypatch,
+        ["qos", "tape", f"{DIR}/f00000001", f"{DIR}/f00000002", "--wait", "--poll-interval", "0"],
+        Stdin(tty=True),
+    )
+    out, err = capsys.readouterr()
+    assert mock.bulk[out.strip()][:2] == ("UPDATE_QOS", [f"{DIR}/f00000001", f"{DIR}/f00000002"])
+    assert err == ""
+
+
+def test_delete_wait_reports_failures(
+    mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]
+) -> None:
+    mock, _ = mock_dcache
+    with pytest.raises(SystemExit) as exit_info:
+        run(monkeypatch, ["delete", "--wait", "--poll-interval", "0"], Stdin(f"{DIR}/f00000001\n{DIR}/missing-1\n"))
+    assert exit_info.value.code == 1
+    out, err = capsys.readouterr()
+    assert mock.bulk[out.strip()][0] == "DELETE"
+    assert err.splitlines() == [f"{DIR}/missing-1: No such file or directory", "1 of 2 targets failed"]
+
+
+def test_no_valid_input(monkeypatch: pytest.MonkeyPatch) -> None:
+    with pytest.raises(SystemExit, match="no valid input files"):
+        run(monkeypatch, ["delete"], Stdin("/home/user/file\n"))
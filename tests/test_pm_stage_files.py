@@ -0,0 +1,495 @@
+import argparse
+import functools
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pytest
+from mock_dcache import FakeClock, FakeDcache, MockDcache, content
+
+from pmgridtools import pm_stage_files
+from pmgridtools.api_dcache import FileInfo, dcacheapy
+from pmgridtools.pm_stage_files import (
+    DirectoryListings,
+    InputPipeline,
+    PollScheduler,
+    ReleaseHandler,
+    StageManager,
+    TapeOrder,
+    _feed,
+    _input_ready,
+    dedupe,
+    lookup_records,
+    precheck_files,
+)
+from pmgridtools.stage_coordinator import Coordinator
+from pmgridtools.stage_state import PENDING, RELEASED, STAGING, FileRecord, StageState
+from pmgridtools.webdav_dcache import WebDav
+
+GB: int = 1024 * 1024 * 1024
+
+
+def make_manager(dcache: FakeDcache, max_stage_gb: float = 10, lookahead: int = 1000) -> StageManager:
+    """StageManager polling every bulk request on every cycle."""
+    scheduler: PollScheduler = PollScheduler(min_interval=0, jitter=0, slack=0)
+    return StageManager(dcache, scheduler, max_stage_gb=max_stage_gb, lookahead=lookahead)  # type: ignore[arg-type]
+
+
+def gets(mock: MockDcache) -> int:
+    """Number of GET requests the mock dCache served so far."""
+    return mock.requests.get("GET", 0)
+
+
+def test_precheck_lists_dense_directories(mock_dcache: Tuple[MockDcache, str], dcache: dcacheapy) -> None:
+    mock, _ = mock_dcache
+    directory: str = "/pnfs/grid.sara.nl/data/precheck/dir1"
+    files: List[str] = [f"{directory}/f{i:08d}" for i in range(4)] + [f"{directory}/missing-1"]
+    before: int = gets(mock)
+    infos: List[FileInfo] = list(precheck_files(dcache, files, listing_threshold=5))
+    # the missing file is not in the complete listing, so it is skipped without a stat
+    assert [info.path for info in infos] == files[:4]
+    assert gets(mock) - before == 1
+    before = gets(mock)
+    assert [info.path for info in precheck_files(dcache, files, listing_threshold=6)] == files[:4]
+    assert gets(mock) - before == 5
+
+
+def test_precheck_listing_costs_no_more_than_stats(mock_dcache: Tuple[MockDcache, str], dcache: dcacheapy) -> None:
+    mock, _ = mock_dcache
+    directory: str = "/pnfs/grid.sara.nl/data/spread/dir1"
+    files: List[str] = [f"{directory}/f00000000", f"{directory}/f00000024"]
+    before: int = gets(mock)
+    listings: DirectoryListings = DirectoryListings(dcache, page_size=10)
+    infos: List[FileInfo] = list(precheck_files(dcache, files, listing_threshold=2, listings=listings))
+    assert [info.path for info in infos] == files
+    # two pages for two files, the file beyond them is checked on its own
+    assert gets(mock) - before == 3
+
+
+def test_failed_targets_are_recorded(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.add_files({"/a": 1, "/b": 1, "/c": 1})
+    manager.stage()
+    fake_dcache.complete("/a")
+    fake_dcache.complete("/b", state="FAILED")
+    released, size = manager.checkstaged()
+    assert released == {"/a"} and size == 1
+    assert manager.failed == {"/b": "FAILED"}
+    assert list(manager.staging) == ["/c"] and manager.staging_bytes == 1
+    fake_dcache.complete("/c", state="CANCELLED")
+    manager.checkstaged()
+    assert manager.remaining == 0 and not manager.requests and len(manager.scheduler) == 0
+
+
+def test_finished_request_fails_missing_targets(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.add_files({"/a": 1, "/b": 1})
+    manager.stage()
+    # dCache finished the request without reporting /b
+    del fake_dcache.requests["fake-0"]["/b"]
+    fake_dcache.complete("/a")
+    released, _ = manager.checkstaged()
+    assert released == {"/a"} and manager.failed == {"/b": "not part of bulk request"}
+    assert manager.remaining == 0
+
+
+def test_byte_counters_follow_the_queues(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache, max_stage_gb=2)
+    manager.add_files({"/a": GB, "/b": GB, "/c": GB})
+    manager.add_files({"/a": GB})
+    assert manager.pending_bytes == 3 * GB and manager.remaining == 3
+    manager.stage()
+    assert (manager.pending_bytes, manager.staging_bytes) == (GB, 2 * GB)
+    fake_dcache.complete("/a", "/b")
+    manager.checkstaged()
+    manager.stage()
+    assert (manager.pending_bytes, manager.staging_bytes) == (0, GB)
+    assert manager.staging == {"/c": GB} and not manager.pending
+
+
+def test_failed_submission_keeps_files_pending(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.add_files({"/a": 1, "/b": 1})
+    fake_dcache.fail_stage = True
+    with pytest.raises(RuntimeError):
+        manager.stage()
+    assert list(manager.pending) == ["/a", "/b"] and not manager.staging and not manager.requests
+    fake_dcache.fail_stage = False
+    manager.stage()
+    assert list(manager.staging) == ["/a", "/b"] and manager.pending_bytes == 0
+
+
+def test_scheduler_backs_off_without_progress(clock: FakeClock) -> None:
+    scheduler: PollScheduler = PollScheduler(min_interval=10, max_interval=35, jitter=0, slack=0, clock=clock)
+    scheduler.add("a")
+    assert scheduler.due() == []
+    intervals: List[float] = []
+    for _ in range(4):
+        due_at: Optional[float] = scheduler.next_due()
+        assert due_at is not None
+        intervals.append(due_at - clock.now)
+        clock.advance(intervals[-1])
+        assert scheduler.due() == ["a"]
+        scheduler.reschedule("a", progressed=False)
+    assert intervals == [10, 20, 35, 35]
+    clock.advance(35)
+    assert scheduler.due() == ["a"]
+    scheduler.reschedule("a", progressed=True)
+    assert scheduler.next_due() == clock.now + 10
+
+
+def test_scheduler_slack_and_remove(clock: FakeClock) -> None:
+    scheduler: PollScheduler = PollScheduler(min_interval=10, jitter=0, slack=5, clock=clock)
+    scheduler.add("a")
+    clock.advance(3)
+    scheduler.add("b")
+    scheduler.add("c")
+    scheduler.remove("c")
+    assert len(scheduler) == 2
+    clock.advance(7)
+    # b is due within the slack period and polled together with a
+    assert scheduler.due() == ["a", "b"]
+    assert scheduler.next_due() is None
+
+
+def test_scheduler_jitter(clock: FakeClock) -> None:
+    scheduler: PollScheduler = PollScheduler(min_interval=100, jitter=0.1, clock=clock)
+    for key in range(50):
+        scheduler.add(str(key))
+    due: List[float] = sorted(scheduler._due_at.values())
+    assert clock.now + 90 <= due[0] < due[-1] <= clock.now + 110
+
+
+def test_budget_admits_files_as_others_come_online(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache, max_stage_gb=3)
+    manager.add_files({f"/f{i}": GB for i in range(5)})
+    manager.stage()
+    assert list(manager.staging) == ["/f0", "/f1", "/f2"]
+    fake_dcache.complete("/f0")
+    released, size = manager.checkstaged()
+    assert released == {"/f0"} and size == GB
+    # the freed budget is refilled by the next stage call
+    manager.stage()
+    assert list(manager.staging) == ["/f1", "/f2", "/f3"]
+    assert list(manager.pending) == ["/f4"]
+
+
+def test_lookahead_skips_files_that_do_not_fit() -> None:
+    jobs: Dict[str, int] = {"/a": 2 * GB, "/big1": 2 * GB, "/big2": 2 * GB, "/small": GB}
+    manager: StageManager = make_manager(FakeDcache(), max_stage_gb=3, lookahead=2)
+    manager.add_files(jobs)
+    manager.stage()
+    # the search stops after two skipped files, before /small is reached
+    assert list(manager.staging) == ["/a"]
+    manager = make_manager(FakeDcache(), max_stage_gb=3, lookahead=3)
+    manager.add_files(jobs)
+    manager.stage()
+    assert list(manager.staging) == ["/a", "/small"]
+    assert list(manager.pending) == ["/big1", "/big2"]
+
+
+def test_file_larger_than_budget_staged_alone(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache, max_stage_gb=1)
+    manager.add_files({"/small": GB, "/huge": 5 * GB})
+    manager.stage()
+    fake_dcache.complete("/small")
+    manager.checkstaged()
+    manager.stage()
+    assert list(manager.staging) == ["/huge"]
+    manager.add_files({"/next": GB})
+    manager.stage()
+    assert list(manager.staging) == ["/huge"]
+    fake_dcache.complete("/huge")
+    manager.checkstaged()
+    manager.stage()
+    assert list(manager.staging) == ["/next"]
+
+
+def test_tape_order_groups_by_hint() -> None:
+    order: TapeOrder = TapeOrder({"/d2/a": "tape1", "/d1/b": "tape1", "/d1/a": "tape2"})
+    jobs: Dict[str, int] = {"/d1/a": 1, "/d3/x": 2, "/d2/a": 3, "/d1/b": 4}
+    assert list(order.order(jobs)) == ["/d3/x", "/d1/b", "/d2/a", "/d1/a"]
+    assert order.order(jobs)["/d2/a"] == 3
+    assert order.group("/d2/a") == order.group("/d1/b") != order.group("/d1/a")
+
+
+def test_tape_order_one_request_per_group(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.order = TapeOrder({"/a": "t1", "/b": "t2", "/c": "t1"})
+    manager.add_files({"/b": 1, "/c": 1, "/a": 1})
+    manager.stage()
+    assert fake_dcache.staged() == [["/a", "/c"], ["/b"]]
+
+
+def test_tape_hints_from_lookup(dcache: dcacheapy) -> None:
+    files: List[str] = [f"/pnfs/grid.sara.nl/data/hints/dir{i}/f00000000" for i in range(3)]
+    records: List[Tuple[FileRecord, bool]] = list(lookup_records(dcache, files, {}))
+    hints: List[Optional[str]] = [record.hint for record, _ in records]
+    assert all(hint is not None and hint.endswith("@osm") for hint in hints)
+
+
+def test_feed_restores_staging_records(fake_dcache: FakeDcache, tmp_path: pathlib.Path) -> None:
+    state: StageState = StageState(os.path.join(tmp_path, "state.db"))
+    manager: StageManager = make_manager(fake_dcache)
+    manager.state = state
+    records: List[Tuple[FileRecord, bool]] = [
+        (FileRecord("/staging", 5, STAGING, "tape1", "old-1"), False),
+        (FileRecord("/online", 7, RELEASED), False),
+        (FileRecord("/new", 3, PENDING, "tape2"), True),
+    ]
+    hints: Dict[str, str] = {}
+    assert _feed(manager, records, hints, state) == 8
+    assert manager.requests == {"old-1": {"/staging"}} and manager.staging == {"/staging": 5}
+    assert list(manager.pending) == ["/new"] and hints == {"/staging": "tape1", "/new": "tape2"}
+    assert state.load() == {"/new": FileRecord("/new", 3, PENDING, "tape2")}
+    state.close()
+
+
+def test_stale_bulk_request_is_requeued(fake_dcache: FakeDcache, tmp_path: pathlib.Path) -> None:
+    state: StageState = StageState(os.path.join(tmp_path, "state.db"))
+    state.save([FileRecord("/a", 1, STAGING, request_id="old-1"), FileRecord("/b", 1, STAGING, request_id="old-1")])
+    manager: StageManager = make_manager(fake_dcache)
+    manager.state = state
+    manager.restore("old-1", {"/a": 1, "/b": 1})
+    # the request is unknown on the server, its files go back to the front of the queue
+    manager.add_files({"/c": 1})
+    manager.max_stage_bytes = 0
+    manager.checkstaged()
+    assert not manager.requests and not manager.staging
+    assert sorted(list(manager.pending)[:2]) == ["/a", "/b"] and list(manager.pending)[2] == "/c"
+    assert {record.state for record in state.load().values()} == {PENDING}
+    manager.max_stage_bytes = 10
+    manager.stage()
+    assert sorted(fake_dcache.staged()[0]) == ["/a", "/b", "/c"]
+    assert state.load()["/a"].request_id == "fake-0"
+    state.close()
+
+
+def test_reused_request_id_keeps_restored_files(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.restore("fake-0", {"/old": 1})
+    manager.add_files({"/new": 1})
+    manager.stage()
+    assert manager.requests == {"fake-0": {"/old", "/new"}}
+    # the server only knows the new files, the restored one fails once the request is finished
+    fake_dcache.complete("/new")
+    released, _ = manager.checkstaged()
+    assert released == {"/new"} and manager.failed == {"/old": "not part of bulk request"}
+    assert manager.remaining == 0
+
+
+def test_dedupe() -> None:
+    items: List[str] = [f"/f{i % 7}" for i in range(30)]
+    expected: List[str] = [f"/f{i}" for i in range(7)]
+    assert list(dedupe(items)) == expected
+    # beyond the memory limit the items seen are looked up on disk
+    assert list(dedupe(items, memory_limit=3)) == expected
+
+
+def test_precheck_lists_directories_once(mock_dcache: Tuple[MockDcache, str], dcache: dcacheapy) -> None:
+    mock, _ = mock_dcache
+    directory: str = "/pnfs/grid.sara.nl/data/precheck/dir1"
+    files: List[str] = [f"{directory}/f{i:08d}" for i in range(0, 25, 2)] + [f"{directory}/missing-1"]
+    listings: DirectoryListings = DirectoryListings(dcache, page_size=10)
+    before: int = gets(mock)
+    infos: List[FileInfo] = list(precheck_files(dcache, files[:6], listing_threshold=4, listings=listings))
+    assert [info.path for info in infos] == files[:6]
+    # six files in the first page and a half, the rest of the page is kept for later batches
+    assert gets(mock) - before == 2
+    infos = list(precheck_files(dcache, files[6:], listing_threshold=4, listings=listings))
+    assert [info.path for info in infos] == files[6:-1]
+    assert gets(mock) - before == 3
+
+
+def test_listings_share_the_entry_limit(dcache: dcacheapy) -> None:
+    listings: DirectoryListings = DirectoryListings(dcache, page_size=10, maxentries=15)
+    directories: List[str] = [f"/pnfs/grid.sara.nl/data/shared/dir{i}" for i in range(6)]
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda directory: listings.resolve(directory, {f"{directory}/f00000000"}, 1), directories))
+    # every listing keeps the other nine entries of its first page, until the limit of all listings together
+    assert listings.kept == 15
+    assert sum(len(entries) for entries in listings._entries.values()) == 15
+    assert sum(listings.known(directory) for directory in directories) == len(listings._entries) >= 2
+
+
+def test_lookup_records(dcache: dcacheapy) -> None:
+    directory: str = "/pnfs/grid.sara.nl/data/lookup/dir1"
+    files: List[str] = [f"{directory}/f{i:08d}" for i in range(5)]
+    known: Dict[str, FileRecord] = {files[1]: FileRecord(files[1], 1024, RELEASED, None)}
+    records: List[Tuple[FileRecord, bool]] = list(lookup_records(dcache, files, known, batch_size=2))
+    assert [(record.pnfs, new) for record, new in records] == [(path, path != files[1]) for path in files]
+    assert all(record.state == PENDING and record.hint for record, new in records if new)
+
+
+def test_iter_released_yields_online_and_staged_files(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    manager.add_files({"/a": 1, "/b": 1})
+    manager.add_online(["/online"])
+    feeds: List[int] = []
+
+    def feed() -> None:
+        feeds.append(len(feeds))
+        fake_dcache.complete(*manager.staging)
+
+    released: List[str] = list(manager.iter_released(feed))
+    assert released[0] == "/online" and sorted(released[1:]) == ["/a", "/b"]
+    assert manager.released_bytes == 2 and manager.remaining == 0
+    assert len(feeds) == 2
+
+
+def test_iter_released_waits_for_more_input(fake_dcache: FakeDcache) -> None:
+    manager: StageManager = make_manager(fake_dcache)
+    inputs: List[Tuple[str, int]] = [("/a", 1), ("/b", 1), ("/c", 1)]
+
+    def feed() -> None:
+        fake_dcache.complete(*manager.staging)
+        if inputs:
+            manager.add_files(dict([inputs.pop(0)]))
+
+    released: List[str] = list(manager.iter_released(feed, lambda: bool(inputs)))
+    assert sorted(released) == ["/a", "/b", "/c"]
+
+
+def test_iter_released_with_mock(dcache: dcacheapy) -> None:
+    files: List[str] = [f"/pnfs/grid.sara.nl/data/iter/dir1/f{i:08d}" for i in range(6)]
+    scheduler: PollScheduler = PollScheduler(min_interval=0.1, max_interval=0.2, jitter=0, slack=0)
+    manager: StageManager = StageManager(dcache, scheduler, max_stage_gb=3 * 1024 / GB)
+    manager.add_files(dict.fromkeys(files, 1024))
+    assert sorted(manager.iter_released()) == files
+    assert manager.released_bytes == 6 * 1024 and not manager.failed
+
+
+def test_input_pipeline() -> None:
+    release: threading.Event = threading.Event()
+
+    def items() -> Iterator[int]:
+        yield from range(5)
+        release.wait(5)
+        raise ValueError("stage failed")
+
+    pipeline: InputPipeline[int] = InputPipeline(items(), maxsize=2)
+    # the producer blocks on the full queue
+    time.sleep(0.05)
+    assert pipeline.running and pipeline.available() == 2
+    assert pipeline.take(1) == [0]
+    taken: List[int] = [0]
+    while len(taken) < 5:
+        taken += pipeline.take(10)
+    assert taken == list(range(5)) and not pipeline.finished
+    release.set()
+    # the error of the stages is raised by the take that reaches the end
+    with pytest.raises(ValueError, match="stage failed"):
+        while True:
+            pipeline.take(10)
+    assert pipeline.finished and pipeline.take(10) == []
+
+
+def test_input_ready(fake_dcache: FakeDcache) -> None:
+    release: threading.Event = threading.Event()
+
+    def items() -> Iterator[int]:
+        yield from range(3)
+        release.wait(5)
+
+    pipeline: InputPipeline[int] = InputPipeline(items())
+    manager: StageManager = make_manager(fake_dcache, max_stage_gb=2 / GB)
+    time.sleep(0.05)
+    # three waiting items are not a batch of four while more may follow
+    assert not _input_ready(pipeline, manager, batch=4, window=10)
+    assert _input_ready(pipeline, manager, batch=3, window=10)
+    manager.add_files({"/a": 1})
+    assert not _input_ready(pipeline, manager, batch=3, window=1)
+    # nothing is taken while the staging budget is used up
+    manager.add_files({"/b": 1})
+    manager.stage()
+    assert manager.staging_bytes == 2 and not _input_ready(pipeline, manager, batch=3, window=10)
+    fake_dcache.complete("/a", "/b")
+    manager.checkstaged()
+    release.set()
+    pipeline._thread.join(5)
+    # the last input is worth a cycle even when it is less than a batch
+    assert _input_ready(pipeline, manager, batch=4, window=10)
+    while not pipeline.finished:
+        pipeline.take(10)
+    assert not _input_ready(pipeline, manager, batch=4, window=10)
+
+
+class BlockingWebDav:
+    """Stand-in for WebDav whose downloads wait until they are let through."""
+
+    def __init__(self) -> None:
+        self.started: List[str] = []
+        self.go: threading.Event = threading.Event()
+
+    def download(self, url: str, localfile: str) -> str:
+        self.started.append(url)
+        self.go.wait(5)
+        return localfile
+
+
+def test_release_handler_bounds_the_backlog(tmp_path: pathlib.Path) -> None:
+    webdav: BlockingWebDav = BlockingWebDav()
+    handler: ReleaseHandler = ReleaseHandler(
+        download_to=str(tmp_path), webdav=webdav, door="http://door", workers=1, backlog=2  # type: ignore[arg-type]
+    )
+    handler("/pnfs/a")
+    handler("/pnfs/b")
+    third: threading.Thread = threading.Thread(target=handler, args=("/pnfs/c",))
+    third.start()
+    # one download running and one waiting, the third file is held up
+    third.join(0.2)
+    assert third.is_alive() and webdav.started == ["http://door/pnfs/a"]
+    webdav.go.set()
+    third.join(5)
+    assert not third.is_alive()
+    assert handler.close() == 0
+    assert webdav.started == ["http://door/pnfs/a", "http://door/pnfs/b", "http://door/pnfs/c"]
+
+
+def test_release_handler_downloads(
+    mock_dcache: Tuple[MockDcache, str],
+    dcache: dcacheapy,
+    tmp_path: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    _, base = mock_dcache
+    webdav: WebDav = WebDav(session=dcache.session)
+    handler: ReleaseHandler = ReleaseHandler(True, str(tmp_path), webdav, base, workers=2)
+    files: List[str] = [f"/pnfs/grid.sara.nl/data/release/download-{size}" for size in (100, 0, 5000)]
+    for pnfs in [*files, "/pnfs/grid.sara.nl/data/release/missing-1"]:
+        handler(pnfs)
+    assert handler.close() == 1
+    for pnfs in files:
+        size: int = int(pnfs.rpartition("-")[2])
+        assert pathlib.Path(tmp_path, pnfs.lstrip("/")).read_bytes() == content(0, size)
+    out, err = capsys.readouterr()
+    assert out.split() == [*files, "/pnfs/grid.sara.nl/data/release/missing-1"]
+    assert "download of /pnfs/grid.sara.nl/data/release/missing-1 failed" in err
+
+
+def test_run_worker(
+    mock_dcache: Tuple[MockDcache, str],
+    dcache: dcacheapy,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    # poll the mock often, its files come online after 0.2 seconds
+    monkeypatch.setattr(
+        pm_stage_files, "PollScheduler", functools.partial(PollScheduler, min_interval=0.05, jitter=0, slack=0)
+    )
+    coordinator: Coordinator = Coordinator(os.path.join(tmp_path, "coordinator.db"), max_stage_bytes=3 * 1024)
+    files: List[str] = [f"/pnfs/grid.sara.nl/data/worker/dir1/f{i:08d}" for i in range(6)]
+    files.append("/pnfs/grid.sara.nl/data/worker/dir1/missing-1")
+    assert coordinator.submit(files, chunk_size=4) == 2
+    args = argparse.Namespace(order="tape", batch_size=4, concurrency=4, listing_threshold=16, metrics_file=None)
+    pm_stage_files.run_worker(coordinator, dcache, args, None, ReleaseHandler(emit=True))
+    out, err = capsys.readouterr()
+    # every chunk is done and the whole budget is free again
+    assert sorted(out.split()) == files[:-1]
+    assert coordinator.remaining() == 0 and coordinator.available() == 3 * 1024
+    assert "staging done" in err
+    coordinator.close()
@@ -0,0 +1,72 @@
+from typing import List, Tuple
+
+from mock_dcache import MockDcache
+
+import pmgridtools.transport as transport
+from pmgridtools.pm_verify_manifest import (
+    CHECKSUM_MISMATCH,
+    ERROR,
+    MISSING,
+    OK,
+    SIZE_MISMATCH,
+    ManifestEntry,
+    VerifyResult,
+    read_manifest,
+    read_report,
+    verify_manifest,
+)
+
+
+def test_read_manifest() -> None:
+    lines: List[str] = [
+        "# path size adler32\n",
+        "\n",
+        "/pnfs/a\n",
+        "/pnfs/b 100\n",
+        "/pnfs/c - 0a0b0c0d\n",
+        "/pnfs/d 7 0a0b0c0d extra columns\n",
+    ]
+    assert list(read_manifest(lines)) == [
+        ManifestEntry("/pnfs/a"),
+        ManifestEntry("/pnfs/b", 100),
+        ManifestEntry("/pnfs/c", None, "0a0b0c0d"),
+        ManifestEntry("/pnfs/d", 7, "0a0b0c0d"),
+    ]
+
+
+def test_read_manifest_malformed_lines() -> None:
+    entries: List[ManifestEntry] = list(read_manifest(["/pnfs/a 1k\n", "/pnfs/b 1 xyz\n", "/pnfs/c 1\n"]))
+    assert [entry.path for entry in entries] == ["/pnfs/a", "/pnfs/b", "/pnfs/c"]
+    assert entries[0].error == "malformed manifest line: /pnfs/a 1k"
+    assert entries[1].error is not None and entries[1].size is None
+    assert entries[2].error is None
+
+
+def test_read_report() -> None:
+    lines: List[str] = [
+        str(VerifyResult("/pnfs/a", OK)) + "\n",
+        str(VerifyResult("/pnfs/b", MISSING)) + "\n",
+        str(VerifyResult("/pnfs/c", ERROR, "timeout")) + "\n",
+        str(VerifyResult("/pnfs/d", SIZE_MISMATCH, "expected 1, found 2")),
+        "garbage\n",
+    ]
+    assert read_report(lines) == {"/pnfs/a", "/pnfs/b", "/pnfs/d"}
+
+
+def test_verify_manifest(mock_dcache: Tuple[MockDcache, str]) -> None:
+    mock, base = mock_dcache
+    checksum: str = mock.adler32(1024)
+    wrong: str = f"{int(checksum, 16) ^ 1:08x}"
+    entries: List[ManifestEntry] = [
+        ManifestEntry("/pnfs/grid.sara.nl/data/ok", 1024, checksum),
+        ManifestEntry("/pnfs/grid.sara.nl/data/missing-1"),
+        ManifestEntry("/pnfs/grid.sara.nl/data/size", 1000),
+        ManifestEntry(f"{base}/pnfs/grid.sara.nl/data/sum", None, wrong),
+        ManifestEntry("/home/user/file"),
+        ManifestEntry("/pnfs/grid.sara.nl/data/bad", error="malformed manifest line: bad"),
+    ]
+    session = transport.make_session(None, pool_size=4)
+    results: List[VerifyResult] = list(verify_manifest(session, entries, door=base, concurrency=4))
+    assert [result.path for result in results] == [entry.path for entry in entries]
+    assert [result.status for result in results] == [OK, MISSING, SIZE_MISMATCH, CHECKSUM_MISMATCH, ERROR, ERROR]
+    assert results[5].detail == "malformed manifest line: bad"
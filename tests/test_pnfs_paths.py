@@ -0,0 +1,92 @@
+import os
+import pathlib
+from typing import Optional
+
+import pytest
+
+from pmgridtools.pnfs_paths import (
+    DEFAULT_RULES,
+    PathNormaliser,
+    PrefixRule,
+    load_normaliser,
+)
+
+PROJECT: str = "/pnfs/grid.sara.nl/data/lsgrid/Project_MinE/"
+
+
+@pytest.mark.parametrize(
+    "url,expected",
+    [
+        ("srm://srm.grid.sara.nl:8443/srm/managerv2?SFN=/pnfs/grid.sara.nl/data/a/b", "/pnfs/grid.sara.nl/data/a/b"),
+        ("gsiftp://gridftp.grid.sara.nl:2811/pnfs/grid.sara.nl/data/a", "/pnfs/grid.sara.nl/data/a"),
+        ("https://webdav.grid.surfsara.nl:2880/pnfs/grid.sara.nl/data/a", "/pnfs/grid.sara.nl/data/a"),
+        ("  /pnfs/grid.sara.nl/data/a\n", "/pnfs/grid.sara.nl/data/a"),
+        ("/pnfs/grid.sara.nl/data/x/../a", "/pnfs/grid.sara.nl/data/a"),
+        ("/project/projectmine/Data/GridStorage/sample/1.bam", PROJECT + "sample/1.bam"),
+        ("/projectmine-nfs/sample/1.bam", PROJECT + "sample/1.bam"),
+        ("/home/user/file", None),
+        ("http://example.org/file", None),
+    ],
+)
+def test_default_rules(url: str, expected: Optional[str]) -> None:
+    assert PathNormaliser().normalise(url) == expected
+
+
+def test_relative_paths_use_cwd() -> None:
+    normaliser: PathNormaliser = PathNormaliser(cwd="/projectmine-nfs/sample")
+    assert normaliser.normalise("1.bam") == PROJECT + "sample/1.bam"
+    assert normaliser.normalise("../other/2.bam") == PROJECT + "other/2.bam"
+
+
+def test_first_rule_wins() -> None:
+    rules = [PrefixRule.literal("/data/special/", "/pnfs/special/"), PrefixRule.literal("/data/", "/pnfs/data/")]
+    normaliser: PathNormaliser = PathNormaliser(rules)
+    assert normaliser.normalise("/data/special/a") == "/pnfs/special/a"
+    assert normaliser.normalise("/data/a") == "/pnfs/data/a"
+    # literal prefixes are escaped
+    assert PathNormaliser([PrefixRule.literal("/a.b/", "/x/")]).normalise("/aXb/c") is None
+
+
+def test_normalise_many() -> None:
+    valid, rejected = PathNormaliser().normalise_many(
+        ["/pnfs/grid.sara.nl/a", "", "/elsewhere ", "/pnfs/grid.sara.nl/./a", "/pnfs/grid.sara.nl/b"]
+    )
+    assert valid == ["/pnfs/grid.sara.nl/a", "/pnfs/grid.sara.nl/b"]
+    assert rejected == ["/elsewhere"]
+
+
+def test_rule_from_dict() -> None:
+    assert PrefixRule.from_dict({"prefix": "/a.", "replacement": "/b/"}) == PrefixRule(r"/a\.", "/b/")
+    assert PrefixRule.from_dict({"pattern": "/a+", "replacement": "/b/"}) == PrefixRule("/a+", "/b/")
+    for rule in ({"prefix": "/a"}, {"replacement": "/b"}, {"prefix": "/a", "pattern": "/a", "replacement": "/b"}):
+        with pytest.raises(ValueError):
+            PrefixRule.from_dict(rule)
+    with pytest.raises(ValueError):
+        PathNormaliser([])
+
+
+def test_config_file(tmp_path: pathlib.Path) -> None:
+    config: str = os.path.join(tmp_path, "paths.toml")
+    pathlib.Path(config).write_text(
+        "[[rules]]\n"
+        'prefix = "/scratch/mine/"\n'
+        'replacement = "/pnfs/grid.sara.nl/data/mine/"\n'
+        "\n"
+        "[[rules]]\n"
+        'pattern = "/mnt/disk[0-9]+/"\n'
+        'replacement = "/pnfs/grid.sara.nl/data/disks/"\n'
+    )
+    normaliser: PathNormaliser = load_normaliser(config)
+    assert normaliser.rules[2:] == DEFAULT_RULES
+    assert normaliser.normalise("/scratch/mine/a") == "/pnfs/grid.sara.nl/data/mine/a"
+    assert normaliser.normalise("/mnt/disk12/a") == "/pnfs/grid.sara.nl/data/disks/a"
+    assert normaliser.normalise("/projectmine-nfs/a") == PROJECT + "a"
+
+
+def test_config_file_without_defaults(tmp_path: pathlib.Path) -> None:
+    config: str = os.path.join(tmp_path, "paths.toml")
+    pathlib.Path(config).write_text('defaults = false\n[[rules]]\nprefix = "/x/"\nreplacement = "/pnfs/x/"\n')
+    normaliser: PathNormaliser = PathNormaliser.from_config(config)
+    assert len(normaliser.rules) == 1
+    assert normaliser.normalise("/projectmine-nfs/a") is None
+    assert load_normaliser().rules == DEFAULT_RULES
@@ -0,0 +1,108 @@
+import io
+from typing import Tuple
+
+import pytest
+import requests
+from mock_dcache import MockDcache, content
+
+import pmgridtools.transport as transport
+from pmgridtools import remote_file
+
+DATA: str = "/pnfs/grid.sara.nl/data/remote"
+
+
+@pytest.fixture
+def session() -> requests.Session:
+    return transport.make_session(None, pool_size=4, retries=0)
+
+
+def gets(mock: MockDcache) -> int:
+    return mock.requests.get("GET", 0)
+
+
+def test_small_reads_share_a_block(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    mock, base = mock_dcache
+    with remote_file.open_remote(session, f"{base}{DATA}/download-5000", block_size=1000) as f:
+        assert f.size == 5000
+        before: int = gets(mock)
+        assert f.read(10) == content(0, 10)
+        assert f.read(10) == content(10, 20)
+        assert gets(mock) - before == 1
+        # a read across a block boundary takes the rest of one block and the start of the next
+        f.seek(990)
+        assert f.read(20) == content(990, 1010)
+        assert gets(mock) - before == 2 and f.tell() == 1010
+
+
+def test_large_reads_bypass_the_cache(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    mock, base = mock_dcache
+    with remote_file.open_remote(session, f"{base}{DATA}/download-5000", size=5000, block_size=1000) as f:
+        before: int = gets(mock)
+        buffer: bytearray = bytearray(2500)
+        assert f.readinto(buffer) == 2500 and bytes(buffer) == content(0, 2500)
+        assert gets(mock) - before == 1 and not f._blocks
+        # at the end of the file the read is cut short, after it nothing is left
+        f.seek(-100, io.SEEK_END)
+        assert f.readinto(buffer) == 100 and bytes(buffer[:100]) == content(4900, 5000)
+        assert f.readinto(buffer) == 0 and f.read() == b""
+
+
+def test_block_cache_is_lru(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    mock, base = mock_dcache
+    with remote_file.open_remote(
+        session, f"{base}{DATA}/download-5000", size=5000, block_size=1000, cache_blocks=2
+    ) as f:
+        before: int = gets(mock)
+        for pos in (0, 1000, 0, 2000):
+            f.seek(pos)
+            assert f.read(1) == content(pos, pos + 1)
+        assert gets(mock) - before == 3 and list(f._blocks) == [0, 2]
+        # block 0 was used recently and is still cached, block 1 was evicted
+        f.seek(0)
+        f.read(1)
+        assert gets(mock) - before == 3
+        f.seek(1000)
+        f.read(1)
+        assert gets(mock) - before == 4 and list(f._blocks) == [0, 1]
+
+
+def test_seek(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    mock, base = mock_dcache
+    f = remote_file.RemoteFile(session, f"{base}{DATA}/download-5000", size=5000)
+    before: int = gets(mock)
+    assert f.seekable() and f.readable()
+    assert f.seek(100) == 100
+    assert f.seek(50, io.SEEK_CUR) == 150
+    assert f.seek(-10, io.SEEK_END) == 4990
+    # seeking beyond the end is allowed, reads there return nothing
+    assert f.seek(6000) == 6000 and f.read(10) == b""
+    with pytest.raises(ValueError):
+        f.seek(-1)
+    with pytest.raises(ValueError):
+        f.seek(0, 3)
+    # seeking sends no request
+    assert gets(mock) == before
+    f.close()
+    with pytest.raises(ValueError):
+        f.read(1)
+
+
+def test_buffered_reader(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    _, base = mock_dcache
+    raw = remote_file.open_remote(session, f"{base}{DATA}/download-3000", block_size=1000)
+    with io.BufferedReader(raw, buffer_size=512) as f:
+        assert f.read() == content(0, 3000)
+    assert raw.closed
+
+
+def test_missing_file(mock_dcache: Tuple[MockDcache, str], session: requests.Session) -> None:
+    _, base = mock_dcache
+    with pytest.raises(FileNotFoundError):
+        remote_file.open_remote(session, f"{base}{DATA}/missing-file")
+    # with a known size the file is first requested by the read
+    f = remote_file.open_remote(session, f"{base}{DATA}/missing-file", size=100)
+    with pytest.raises(FileNotFoundError):
+        f.read(10)
+    with pytest.raises(FileNotFoundError):
+        remote_file.cat(session, f"{base}{DATA}/missing-file")
+    assert remote_file.cat(session, f"{base}{DATA}/download-100") == content(0, 100)
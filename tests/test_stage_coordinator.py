@@ -0,0 +1,143 @@
+import os
+import pathlib
+from typing import Iterator, List
+
+import pytest
+from mock_dcache import FakeClock, FakeDcache
+
+from pmgridtools.pm_stage_files import PollScheduler, StageManager
+from pmgridtools.stage_coordinator import ChunkTracker, Coordinator
+
+
+@pytest.fixture
+def dbpath(tmp_path: pathlib.Path) -> str:
+    """Path of a new coordination file."""
+    return os.path.join(tmp_path, "coordinator.db")
+
+
+@pytest.fixture
+def workers(dbpath: str, clock: FakeClock) -> Iterator[List[Coordinator]]:
+    """Two workers sharing a coordination file with a budget of 100 bytes and leases of 60 seconds."""
+    coordinators: List[Coordinator] = [
+        Coordinator(dbpath, max_stage_bytes=100, worker=name, lease_seconds=60, clock=clock) for name in ("a", "b")
+    ]
+    yield coordinators
+    for coordinator in coordinators:
+        coordinator.close()
+
+
+def test_budget_is_required(dbpath: str) -> None:
+    with pytest.raises(ValueError):
+        Coordinator(dbpath)
+    Coordinator(dbpath, max_stage_bytes=10).close()
+    # the budget is stored on creation, later values are ignored
+    coordinator: Coordinator = Coordinator(dbpath, max_stage_bytes=20)
+    assert coordinator.max_stage_bytes == 10
+    coordinator.close()
+
+
+def test_submit_skips_queued_files(workers: List[Coordinator]) -> None:
+    a, _ = workers
+    assert a.submit([f"/f{i}" for i in range(5)], chunk_size=2) == 3
+    assert a.submit(["/f0", "/f1"], chunk_size=2) == 0
+    assert a.submit(["/f1", "/f5"], chunk_size=2) == 1
+    assert a.remaining() == 4
+
+
+def test_workers_lease_different_chunks(workers: List[Coordinator]) -> None:
+    a, b = workers
+    a.submit(["/f0", "/f1", "/f2"], chunk_size=2)
+    lease_a = a.lease()
+    lease_b = b.lease()
+    assert lease_a is not None and lease_b is not None
+    assert sorted(lease_a[1]) == ["/f0", "/f1"] and lease_b[1] == ["/f2"]
+    assert a.lease() is None
+    a.complete(lease_b[0])
+    assert a.remaining() == 2
+    b.complete(lease_b[0])
+    assert a.remaining() == 1
+
+
+def test_expired_lease_is_taken_over(workers: List[Coordinator], clock: FakeClock) -> None:
+    a, b = workers
+    a.submit(["/f0", "/f1"])
+    lease = a.lease()
+    assert lease is not None
+    assert a.reserve({"/f0": 40, "/f1": 40}) == ["/f0", "/f1"]
+    clock.advance(50)
+    a.renew()
+    clock.advance(50)
+    assert b.lease() is None
+    clock.advance(20)
+    takeover = b.lease()
+    assert takeover is not None and takeover[0] == lease[0]
+    # the reservations of the previous owner are dropped, and it can no longer complete the chunk
+    assert b.available() == 100
+    a.complete(lease[0])
+    assert b.remaining() == 1
+    b.complete(lease[0])
+    assert b.remaining() == 0
+
+
+def test_own_expired_lease_keeps_reservations(workers: List[Coordinator], clock: FakeClock) -> None:
+    a, b = workers
+    a.submit(["/f0", "/f1"])
+    lease = a.lease()
+    assert lease is not None
+    assert a.reserve({"/f0": 40}) == ["/f0"]
+    # the worker stalled past its lease and takes its own chunk back, the file it reserved may still be staging
+    clock.advance(120)
+    again = a.lease()
+    assert again is not None and again[0] == lease[0]
+    assert b.available() == 60
+    assert b.lease() is None
+    a.release(["/f0"])
+    assert b.available() == 100
+
+
+def test_reserve_shares_one_budget(workers: List[Coordinator]) -> None:
+    a, b = workers
+    assert a.reserve({"/f0": 60, "/f1": 50, "/f2": 30}) == ["/f0", "/f2"]
+    assert b.available() == 10
+    assert b.reserve({"/f3": 20}) == []
+    a.release(["/f0"])
+    assert b.reserve({"/f3": 20}) == ["/f3"]
+    # a worker only releases its own reservations
+    a.release(["/f3"])
+    assert a.available() == 50
+
+
+def test_oversized_file_only_reserved_alone(workers: List[Coordinator]) -> None:
+    a, b = workers
+    assert a.reserve({"/f0": 10}) == ["/f0"]
+    assert b.reserve({"/huge": 500}) == []
+    a.release(["/f0"])
+    assert b.reserve({"/huge": 500, "/f1": 1}) == ["/huge"]
+    assert a.available() == -400
+
+
+def test_chunk_tracker() -> None:
+    tracker: ChunkTracker = ChunkTracker()
+    tracker.add(1, ["/a", "/b"])
+    tracker.add(2, [])
+    tracker.add(3, ["/c"])
+    assert sorted(tracker.chunks) == [1, 3]
+    assert tracker.finish(["/a", "/unknown"]) == []
+    assert tracker.finish(["/c", "/b"]) == [3, 1]
+    assert not tracker.chunks and not tracker.chunk_of
+
+
+def test_stage_manager_uses_shared_budget(workers: List[Coordinator]) -> None:
+    a, b = workers
+    b.reserve({"/other": 70})
+    manager: StageManager = StageManager(
+        FakeDcache("all"), PollScheduler(min_interval=0, jitter=0, slack=0), budget=a  # type: ignore[arg-type]
+    )
+    manager.add_files({"/f0": 20, "/f1": 20})
+    manager.stage()
+    assert list(manager.staging) == ["/f0"] and a.available() == 10
+    released, _ = manager.checkstaged()
+    # the budget of released files is given back at the end of the cycle
+    assert released == {"/f0"} and a.available() == 30
+    manager.stage()
+    assert list(manager.staging) == ["/f1"]
@@ -0,0 +1,42 @@
+import os
+import pathlib
+from typing import Dict
+
+from pmgridtools.stage_state import (
+    FAILED,
+    PENDING,
+    RELEASED,
+    STAGING,
+    FileRecord,
+    StageState,
+)
+
+
+def test_save_and_load(tmp_path: pathlib.Path) -> None:
+    path: str = os.path.join(tmp_path, "state.db")
+    state: StageState = StageState(path)
+    state.save([FileRecord("/a", 1, PENDING, "tape1"), FileRecord("/b", 2, PENDING)])
+    state.set_state(["/a"], STAGING, "req-1")
+    state.set_state(["/a"], RELEASED)
+    state.set_state(["/b"], FAILED, error="no such file")
+    state.close()
+    state = StageState(path, resume=True)
+    records: Dict[str, FileRecord] = state.load()
+    assert records == {
+        "/a": FileRecord("/a", 1, RELEASED, "tape1", "req-1"),
+        "/b": FileRecord("/b", 2, FAILED, None, None, "no such file"),
+    }
+    # saving a record again replaces it
+    state.save([FileRecord("/b", 3, PENDING)])
+    assert state.load()["/b"] == FileRecord("/b", 3, PENDING)
+    state.close()
+
+
+def test_new_run_empties_the_store(tmp_path: pathlib.Path) -> None:
+    path: str = os.path.join(tmp_path, "state.db")
+    state: StageState = StageState(path)
+    state.save([FileRecord("/a", 1, STAGING, request_id="req-1")])
+    state.close()
+    state = StageState(path)
+    assert state.load() == {}
+    state.close()
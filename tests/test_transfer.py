@@ -0,0 +1,193 @@
+import os
+import pathlib
+import random
+import zlib
+from typing import Tuple
+
+import pytest
+import requests
+from mock_dcache import MockDcache, content
+
+import pmgridtools.transport as transport
+from pmgridtools import transfer
+
+DATA: str = "/pnfs/grid.sara.nl/data/transfer"
+
+
+@pytest.fixture
+def session() -> requests.Session:
+    """Session without retries of its own, so only the retries of the download code are exercised."""
+    return transport.make_session(None, pool_size=4, retries=0)
+
+
+def test_segments() -> None:
+    assert transfer.segments(0, 10) == []
+    assert transfer.segments(25, 10) == [(0, 10), (10, 20), (20, 25)]
+
+
+def test_ranged_download(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    _, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    size: int = 3 * 1024 * 1024 + 17
+    transfer.ranged_download(session, f"{base}{DATA}/download-{size}", localfile, segment_size=1024 * 1024)
+    assert pathlib.Path(localfile).read_bytes() == content(0, size)
+
+
+def test_segment_resumes_after_dropped_connection(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    url: str = f"{base}{DATA}/download-{4096}"
+    mock.drops = 1
+    before: int = mock.requests.get("GET", 0)
+    fd: int = os.open(localfile, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        checksum: int = transfer.download_segment(session, url, fd, 1000, 3000)
+    finally:
+        os.close(fd)
+    assert checksum == zlib.adler32(content(1000, 3000))
+    assert pathlib.Path(localfile).read_bytes()[1000:3000] == content(1000, 3000)
+    assert mock.requests["GET"] - before == 2
+
+
+def test_segment_gives_up_after_retries(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    mock, base = mock_dcache
+    fd: int = os.open(os.path.join(tmp_path, "file"), os.O_WRONLY | os.O_CREAT, 0o644)
+    mock.drops = 2
+    try:
+        with pytest.raises(IOError):
+            transfer.download_segment(session, f"{base}{DATA}/download-4096", fd, 0, 4096, retries=1)
+        # client errors are not retried
+        with pytest.raises(requests.HTTPError):
+            transfer.download_segment(session, f"{base}{DATA}/missing-1", fd, 0, 10)
+    finally:
+        os.close(fd)
+        mock.drops = 0
+
+
+def test_ranged_download_of_empty_file(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    _, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    pathlib.Path(localfile).write_bytes(b"old content")
+    transfer.ranged_download(session, f"{base}{DATA}/download-0", localfile)
+    assert pathlib.Path(localfile).read_bytes() == b""
+
+
+@pytest.mark.parametrize("len1,len2", [(0, 0), (1, 0), (0, 1), (1000, 7), (70000, 65521), (5, 300000)])
+def test_adler32_combine_matches_zlib(len1: int, len2: int) -> None:
+    rng: random.Random = random.Random(len1 * 31 + len2)
+    block1: bytes = rng.randbytes(len1)
+    block2: bytes = rng.randbytes(len2)
+    combined: int = transfer.adler32_combine(zlib.adler32(block1), zlib.adler32(block2), len2)
+    assert combined == zlib.adler32(block1 + block2)
+
+
+def test_parse_digest() -> None:
+    assert transfer.parse_digest("ADLER32=0a1b2c3d, md5=abc==") == {"adler32": "0a1b2c3d", "md5": "abc=="}
+    assert transfer.parse_digest("") == {}
+
+
+def test_stream_download(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    _, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    size: int = 2 * 1024 * 1024 + 5
+    assert transfer.stream_download(session, f"{base}{DATA}/download-{size}", localfile) == localfile
+    assert pathlib.Path(localfile).read_bytes() == content(0, size)
+    transfer.stream_download(session, f"{base}{DATA}/download-0", localfile)
+    assert pathlib.Path(localfile).read_bytes() == b""
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_checksum_mismatch_removes_file(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path, parallel: bool
+) -> None:
+    _, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    url: str = f"{base}{DATA}/corrupt-5000"
+    with pytest.raises(transfer.ChecksumMismatchError):
+        if parallel:
+            transfer.ranged_download(session, url, localfile, segment_size=1024)
+        else:
+            transfer.stream_download(session, url, localfile)
+    assert not os.path.exists(localfile)
+    # without verification the data is kept
+    transfer.stream_download(session, url, localfile, verify=False)
+    assert pathlib.Path(localfile).read_bytes() == content(0, 5000)
+
+
+def test_verify_without_digest(tmp_path: pathlib.Path) -> None:
+    localfile: str = os.path.join(tmp_path, "file")
+    pathlib.Path(localfile).write_bytes(b"data")
+    transfer.verify_adler32("url", localfile, zlib.adler32(b"data"), None)
+    transfer.verify_adler32("url", localfile, zlib.adler32(b"data"), f"{zlib.adler32(b'data'):08X}")
+    assert os.path.exists(localfile)
+
+
+def test_file_adler32(tmp_path: pathlib.Path) -> None:
+    empty: str = os.path.join(tmp_path, "empty")
+    full: str = os.path.join(tmp_path, "full")
+    pathlib.Path(empty).write_bytes(b"")
+    pathlib.Path(full).write_bytes(b"pmgridtools" * 1000)
+    assert transfer.file_adler32(empty) == 1
+    assert transfer.file_adler32(full) == zlib.adler32(b"pmgridtools" * 1000)
+
+
+@pytest.mark.parametrize("expect_continue", [True, False])
+def test_upload_file(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path, expect_continue: bool
+) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    pathlib.Path(localfile).write_bytes(content(0, 5000))
+    path: str = f"{DATA}/upload-{expect_continue}"
+    checksum: str = transfer.upload_file(
+        session, localfile, f"{base}{path}", expect_continue=expect_continue, buffer_size=1024
+    )
+    assert int(checksum, 16) == zlib.adler32(content(0, 5000))
+    assert mock.uploads[path] == (content(0, 5000), "100-continue" if expect_continue else None)
+
+
+def test_upload_empty_file_without_expect(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "empty")
+    pathlib.Path(localfile).write_bytes(b"")
+    assert transfer.upload_file(session, localfile, f"{base}{DATA}/upload-empty") == "00000001"
+    assert mock.uploads[f"{DATA}/upload-empty"] == (b"", None)
+
+
+def test_upload_final_status_before_body(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    pathlib.Path(localfile).write_bytes(content(0, 5000))
+    with open(localfile, "rb") as f:
+        reader = transfer.UploadReader(f, 5000, 1024)
+        # a final 2xx instead of 100 ends the upload, it must not wait for a response to a body it did not send
+        transfer.put_expect_continue(session, f"{base}{DATA}/early-upload", reader, {}, timeout=2, continue_timeout=2)
+    assert f"{DATA}/early-upload" not in mock.uploads
+    with pytest.raises(PermissionError):
+        transfer.upload_file(session, localfile, f"{base}{DATA}/forbidden-upload", timeout=2)
+    assert f"{DATA}/forbidden-upload" not in mock.uploads
+
+
+def test_upload_follows_redirect(
+    mock_dcache: Tuple[MockDcache, str], session: requests.Session, tmp_path: pathlib.Path
+) -> None:
+    mock, base = mock_dcache
+    localfile: str = os.path.join(tmp_path, "file")
+    pathlib.Path(localfile).write_bytes(content(0, 5000))
+    transfer.upload_file(session, localfile, f"{base}{DATA}/redirect-pool")
+    assert f"{DATA}/redirect-pool" not in mock.uploads
+    assert mock.uploads[f"{DATA}/pool"] == (content(0, 5000), "100-continue")
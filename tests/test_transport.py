@@ -0,0 +1,98 @@
+import socket
+import time
+from typing import Iterator, List, Tuple
+
+import pytest
+import requests
+from mock_dcache import API, FakeClock, MockDcache
+
+import pmgridtools.transport as transport
+from pmgridtools.metrics import RequestEvent
+
+FILE: str = "/pnfs/grid.sara.nl/data/transport/file"
+
+
+@pytest.fixture
+def mock(mock_dcache: Tuple[MockDcache, str]) -> Iterator[MockDcache]:
+    """The shared mock dCache, with scripted responses left by a failing test removed."""
+    yield mock_dcache[0]
+    mock_dcache[0].scripted.clear()
+
+
+def test_token_bucket(clock: FakeClock) -> None:
+    bucket = transport.TokenBucket(2, burst=3, clock=clock, sleep=clock.advance)
+    # the bucket starts full, a burst goes through without waiting
+    for _ in range(3):
+        bucket.acquire()
+    assert clock() == 1000
+    bucket.acquire()
+    assert clock() == pytest.approx(1000.5)
+    # tokens do not pile up beyond the burst size
+    clock.advance(60)
+    start: float = clock()
+    for _ in range(5):
+        bucket.acquire()
+    assert clock() - start == pytest.approx(1)
+
+
+def test_rate_limit_per_endpoint(mock_dcache: Tuple[MockDcache, str]) -> None:
+    _, base = mock_dcache
+    adapter = transport.TransportAdapter(rate_limit=20, burst=1)
+    assert adapter._bucket(f"{base}/a") is adapter._bucket(f"{base}/b?x=1")
+    assert adapter._bucket(f"{base}/a") is not adapter._bucket("https://other:2880/a")
+    session: requests.Session = transport.make_session(None, rate_limit=20, burst=1)
+    start: float = time.monotonic()
+    for _ in range(5):
+        assert session.head(f"{base}{FILE}").status_code == 200
+    # one request right away, four more at 20 per second
+    assert time.monotonic() - start >= 0.19
+
+
+def test_retries_on_429_and_5xx(mock_dcache: Tuple[MockDcache, str], mock: MockDcache) -> None:
+    _, base = mock_dcache
+    events: List[RequestEvent] = []
+    session: requests.Session = transport.make_session(None, retries=3, backoff_factor=0, hooks=[events.append])
+    mock.scripted.extend([(429, {}), (500, {}), (503, {})])
+    assert session.head(f"{base}{FILE}").status_code == 200
+    assert events[-1].retries == 3 and events[-1].status == 200
+    # when the retries are used up the last error response is returned
+    mock.scripted.extend([(502, {}), (502, {})])
+    session = transport.make_session(None, retries=1, backoff_factor=0)
+    assert session.head(f"{base}{FILE}").status_code == 502
+    assert not mock.scripted
+
+
+def test_retry_after(mock_dcache: Tuple[MockDcache, str], mock: MockDcache) -> None:
+    _, base = mock_dcache
+    session: requests.Session = transport.make_session(None, retries=1, backoff_factor=0)
+    mock.scripted.append((503, {"Retry-After": "1"}))
+    start: float = time.monotonic()
+    assert session.head(f"{base}{FILE}").status_code == 200
+    assert time.monotonic() - start >= 1
+
+
+def test_post_and_delete_not_retried(mock_dcache: Tuple[MockDcache, str], mock: MockDcache) -> None:
+    _, base = mock_dcache
+    session: requests.Session = transport.make_session(None, retries=3, backoff_factor=0)
+    submitted: int = len(mock.bulk)
+    mock.scripted.extend([(503, {}), (503, {})])
+    response: requests.Response = session.post(f"{base}{API}/bulk-requests", json={"activity": "PIN", "target": [FILE]})
+    assert response.status_code == 503 and len(mock.bulk) == submitted
+    assert session.delete(f"{base}{FILE}").status_code == 503
+    assert not mock.scripted
+    assert session.delete(f"{base}{FILE}").status_code == 204
+
+
+def test_default_timeout() -> None:
+    # a server that accepts connections but never answers
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        url: str = f"http://127.0.0.1:{server.getsockname()[1]}/"
+        session: requests.Session = transport.make_session(None, retries=0, timeout=0.2)
+        start: float = time.monotonic()
+        # the adapter always has a Retry configuration, so the read timeout comes wrapped in a ConnectionError
+        with pytest.raises(requests.exceptions.ConnectionError, match="read timeout=0.2"):
+            session.get(url)
+        assert time.monotonic() - start < 5
+        # an explicit timeout wins over the default
+        with pytest.raises(requests.exceptions.ConnectionError, match="read timeout=0.1"):
+            session.get(url, timeout=0.1)
@@ -0,0 +1,124 @@
+import xml.etree.ElementTree as ET
+from typing import List, Optional, Tuple
+
+import pytest
+from mock_dcache import MockDcache
+
+import pmgridtools.transport as transport
+from pmgridtools.api_dcache import FileInfo
+from pmgridtools.webdav_dcache import WebDav
+
+DIR: str = "/pnfs/grid.sara.nl/data/webdav/dir1"
+
+
+@pytest.fixture
+def webdav(mock_dcache: Tuple[MockDcache, str], monkeypatch: pytest.MonkeyPatch) -> WebDav:
+    """WebDAV client talking to the mock dCache over plain HTTP."""
+    monkeypatch.setenv("X509_USER_PROXY", "")
+    return WebDav(session=transport.make_session(None, pool_size=4))
+
+
+def propfinds(mock: MockDcache) -> int:
+    return mock.requests.get("PROPFIND", 0)
+
+
+def test_stat(mock_dcache: Tuple[MockDcache, str], webdav: WebDav) -> None:
+    mock, base = mock_dcache
+    info: FileInfo = webdav.stat(f"{base}{DIR}/f00000001")
+    assert info == FileInfo(
+        path=f"{base}{DIR}/f00000001",
+        size=1024,
+        locality="NEARLINE",
+        access_latency="NEARLINE",
+        checksums={"ADLER32": mock.adler32(1024)},
+    )
+    assert not info.online
+    assert webdav.stat(f"{base}{DIR}").file_type == "DIR"
+    with pytest.raises(FileNotFoundError):
+        webdav.stat(f"{base}{DIR}/missing-file")
+
+
+def test_stat_quoted_name(mock_dcache: Tuple[MockDcache, str], webdav: WebDav) -> None:
+    _, base = mock_dcache
+    # the mock percent-encodes hrefs, the path of the record is the encoded one whichever way it was requested
+    for url in (f"{base}{DIR}/a file%231", f"{base}{DIR}/a%20file%231"):
+        info: FileInfo = webdav.stat(url)
+        assert info.path == f"{base}{DIR}/a%20file%231" and info.size == 1024
+
+
+def test_list_dir(mock_dcache: Tuple[MockDcache, str], webdav: WebDav) -> None:
+    mock, base = mock_dcache
+    before: int = propfinds(mock)
+    names: List[str] = [info.path.rpartition("/")[2] for info in webdav.list_dir(f"{base}{DIR}")]
+    # the directory itself is not an entry
+    assert names == [f"f{i:08d}" for i in range(25)]
+    assert propfinds(mock) == before + 1
+    with pytest.raises(FileNotFoundError):
+        list(webdav.list_dir(f"{base}/pnfs/grid.sara.nl/data/webdav/missing-dir"))
+
+
+@pytest.mark.parametrize("threshold, expected", [(4, 2), (5, 5)])
+def test_stat_many_listing_threshold(
+    mock_dcache: Tuple[MockDcache, str], webdav: WebDav, threshold: int, expected: int
+) -> None:
+    mock, base = mock_dcache
+    # the same file twice, differently encoded, and a missing file, which is skipped
+    urls: List[str] = [f"{base}{DIR}/f0000000{i}" for i in range(3)]
+    urls += [f"{base}{DIR}/f%300000002", f"{base}{DIR}/missing-file", f"{base}/pnfs/grid.sara.nl/data/webdav/other"]
+    before: int = propfinds(mock)
+    infos: List[FileInfo] = list(webdav.stat_many(urls, listing_threshold=threshold))
+    assert sorted(info.path.rpartition("/")[2] for info in infos) == ["f00000000", "f00000001", "f00000002", "other"]
+    # a listing of dir1 and a stat of other, or a stat of every distinct file in dir1 and of other
+    assert propfinds(mock) == before + expected
+
+
+def response(href: str, props: str, status: str = "HTTP/1.1 200 OK", extra: str = "") -> ET.Element:
+    return ET.fromstring(
+        '<d:response xmlns:d="DAV:" xmlns:s="http://srm.lbl.gov/StorageResourceManager" '
+        f'xmlns:c="http://www.dcache.org/2013/webdav"><d:href>{href}</d:href>'
+        f"<d:propstat><d:prop>{props}</d:prop><d:status>{status}</d:status></d:propstat>{extra}</d:response>"
+    )
+
+
+def test_parse_response() -> None:
+    props: str = (
+        "<d:resourcetype/><d:getcontentlength>42</d:getcontentlength>"
+        "<s:FileLocality>ONLINE_AND_NEARLINE</s:FileLocality><s:AccessLatency>NEARLINE</s:AccessLatency>"
+        "<c:Checksums>adler32=0a0b0c0d,md5=Ob6Xb5a+P0L0sc3jZ9y8ew==</c:Checksums>"
+    )
+    # properties the server does not know come back in a propstat of their own, with a 404 status
+    missing: str = "<d:propstat><d:prop><c:Other/></d:prop><d:status>HTTP/1.1 404 Not Found</d:status></d:propstat>"
+    info: Optional[FileInfo] = WebDav._parse_response(
+        "https://door:2880/pnfs/dir/", response("/pnfs/dir/my%20file", props, extra=missing)
+    )
+    assert info == FileInfo(
+        path="https://door:2880/pnfs/dir/my%20file",
+        size=42,
+        locality="ONLINE_AND_NEARLINE",
+        access_latency="NEARLINE",
+        checksums={"ADLER32": "0a0b0c0d", "MD5": "Ob6Xb5a+P0L0sc3jZ9y8ew=="},
+    )
+    assert info.online
+    directory: Optional[FileInfo] = WebDav._parse_response(
+        "https://door:2880/pnfs/dir", response("/pnfs/dir/", "<d:resourcetype><d:collection/></d:resourcetype>")
+    )
+    assert directory is not None and directory.file_type == "DIR" and directory.path == "https://door:2880/pnfs/dir"
+    assert directory.checksums == {} and directory.locality == ""
+
+
+@pytest.mark.parametrize(
+    "elem",
+    [
+        response("/pnfs/dir/file", "<d:getcontentlength>42</d:getcontentlength>", status="HTTP/1.1 403 Forbidden"),
+        ET.fromstring('<d:response xmlns:d="DAV:"><d:status>HTTP/1.1 200 OK</d:status></d:response>'),
+    ],
+)
+def test_parse_response_without_properties(elem: ET.Element) -> None:
+    assert WebDav._parse_response("https://door:2880/pnfs/dir/file", elem) is None
+
+
+def test_parse_response_checksum_case() -> None:
+    info: Optional[FileInfo] = WebDav._parse_response(
+        "https://door/f", response("/f", "<c:Checksums>ADLER32=0000002a</c:Checksums>")
+    )
+    assert info is not None and info.checksums == {"ADLER32": "0000002a"}